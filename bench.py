@@ -0,0 +1,275 @@
+"""Бенчмарк обработчиков бота на синтетическом складе.
+
+Обработчики из warehouse.py вызываются напрямую с поддельными Update и
+CallbackContext, без Telegram: измеряется время обработчика вместе с
+запросами к базе. Синтетическая база строится один раз и переиспользуется,
+каждый прогон работает на ее копии.
+
+    python bench.py                                   # 50k позиций, 1M броней, 5k пользователей
+    python bench.py --items 5000 --reservations 100000 --runs 100
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json    # сравнение с сохраненным прогоном
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import warehouse
+
+class FakeMessage:
+    def __init__(self, text=None):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+class FakeCallbackQuery:
+    def __init__(self, data):
+        self.data = data
+        self.replies = []
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kwargs):
+        pass
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = f"Имя {user_id}"
+
+class FakeUpdate:
+    def __init__(self, user_id, text=None, data=None):
+        self.message = FakeMessage(text) if data is None else None
+        self.callback_query = FakeCallbackQuery(data) if data is not None else None
+        self.effective_user = FakeUser(user_id)
+        self.effective_message = self.message
+
+    @property
+    def replies(self):
+        return (self.message or self.callback_query).replies
+
+class FakeContext:
+    def __init__(self, user_data=None):
+        self.user_data = user_data or {}
+        self.bot_data = {}
+        self.bot = None
+        self.application = None
+
+class Scenarios:
+    """Вызовы обработчиков со случайными, но воспроизводимыми аргументами"""
+
+    def __init__(self, conn, users, seed):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.users = users
+        self.item_ids = [row[0] for row in conn.execute("SELECT id FROM items")]
+        self.category_ids = [row[0] for row in conn.execute("SELECT id FROM categories")]
+        self.search_terms = ["Кабель", "микро", "Колонка 12", "штатив", "Экр", "Пульт 4", "нет такого"]
+
+    def current_stock(self):
+        # Кэш ответа сбрасывается, чтобы каждый вызов строил список заново
+        warehouse.inventory_changed()
+        return warehouse.current_stock, FakeUpdate(self.user()), FakeContext()
+
+    def current_stock_cached(self):
+        return warehouse.current_stock, FakeUpdate(self.user()), FakeContext()
+
+    def reserve_item_start(self):
+        return warehouse.reserve_item_start, FakeUpdate(self.user()), FakeContext()
+
+    def view_category_selection(self):
+        data = f"viewcat_{self.rng.choice(self.category_ids)}"
+        return warehouse.view_category_selection, FakeUpdate(self.user(), data=data), FakeContext()
+
+    def date_stock_check(self):
+        day = warehouse.today_iso(self.rng.randint(0, 60))
+        return warehouse.date_stock_check, FakeUpdate(self.user(), data=f"date_check_{day}"), FakeContext()
+
+    def reserve_event_input(self):
+        start = datetime.now().date() + timedelta(days=self.rng.randint(0, 90))
+        end = start + timedelta(days=self.rng.randint(0, 5))
+        context = FakeContext({
+            "reserve_item_id": self.rng.choice(self.item_ids),
+            "reserve_quantity": 1,
+            "reserve_start_date": start.isoformat(),
+            "reserve_end_date": end.isoformat(),
+        })
+        return warehouse.reserve_event_input, FakeUpdate(self.user(), text="Бенчмарк"), context
+
+    def search_item_input(self):
+        return warehouse.search_item_input, FakeUpdate(self.user(), text=self.rng.choice(self.search_terms)), FakeContext()
+
+    def my_reservations(self):
+        return warehouse.my_reservations, FakeUpdate(self.user()), FakeContext()
+
+    def start(self, name):
+        """Свой генератор на каждый обработчик: результаты не зависят от набора --handlers"""
+        self.rng = random.Random(f"{self.seed}:{name}")
+
+    def user(self):
+        return self.rng.randint(1, self.users)
+
+SCENARIOS = ["current_stock", "current_stock_cached", "reserve_item_start", "view_category_selection",
+             "date_stock_check", "reserve_event_input", "search_item_input", "my_reservations"]
+
+def build_template(path, items, reservations, users, seed):
+    """Создает синтетическую базу (один раз на набор параметров)"""
+    print(f"Создание базы {path}: {items} позиций, {reservations} броней, {users} пользователей...")
+    started = time.perf_counter()
+    build_path = path + ".building"
+    if os.path.exists(build_path):
+        os.remove(build_path)
+    warehouse.DB_NAME = build_path
+    if not warehouse.init_db() or not warehouse.migrate_database():
+        raise RuntimeError("Не удалось создать схему базы")
+    warehouse.create_search_index()
+    conn = warehouse.get_db_connection()
+    try:
+        warehouse.seed_synthetic_data(conn, items, reservations, users, seed)
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    os.replace(build_path, path)
+    print(f"База создана за {time.perf_counter() - started:.1f} с")
+
+async def run_scenario(name, scenarios, runs, warmup):
+    """Время (мс), затронутые строки и ошибки по вызовам одного обработчика"""
+    timings, rows, errors = [], [], 0
+    scenarios.start(name)
+    for n in range(warmup + runs):
+        handler, update, context = getattr(scenarios, name)()
+        rows_before = warehouse.metrics.db_rows.total()
+        started = time.perf_counter()
+        await handler(update, context)
+        elapsed = (time.perf_counter() - started) * 1000
+        if n < warmup:
+            continue
+        timings.append(elapsed)
+        rows.append(warehouse.metrics.db_rows.total() - rows_before)
+        if any(reply.startswith("❌ Произошла ошибка") for reply in update.replies):
+            errors += 1
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99])
+    return {
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "rows": round(float(np.mean(rows)), 1),
+        "errors": errors,
+    }
+
+async def run_suite(db_path, names, users, runs, warmup, seed):
+    warehouse.DB_NAME = db_path
+    await warehouse.db.open()
+    await warehouse.inventory.load()
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            scenarios = Scenarios(conn, users, seed)
+        finally:
+            conn.close()
+        results = {}
+        for name in names:
+            results[name] = await run_scenario(name, scenarios, runs, warmup)
+            print(format_row(name, results[name]))
+        return results
+    finally:
+        await warehouse.write_batcher.close()
+        await warehouse.db.close()
+
+def format_row(name, result, baseline=None):
+    row = (f"{name:<22} p50 {result['p50_ms']:>9.2f}  p95 {result['p95_ms']:>9.2f}  "
+           f"p99 {result['p99_ms']:>9.2f} мс  строк {result['rows']:>9.1f}")
+    if result["errors"]:
+        row += f"  ошибок {result['errors']}"
+    if baseline:
+        row += f"  (p95 {change(baseline['p95_ms'], result['p95_ms']):+.0f}%)"
+    return row
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+def compare(results, baseline, tolerance):
+    """Печатает сравнение с базовым прогоном; возвращает обработчики с регрессией p95"""
+    if baseline["config"] != results["config"]:
+        print(f"Внимание: параметры базового прогона отличаются: {baseline['config']}")
+    print("\nСравнение с базовым прогоном:")
+    regressions = []
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(format_row(name, result) + "  (нет в базовом прогоне)")
+            continue
+        print(format_row(name, result, before))
+        if change(before["p95_ms"], result["p95_ms"]) > tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков бота на синтетическом складе")
+    parser.add_argument("--items", type=int, default=50000)
+    parser.add_argument("--reservations", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=50, help="измеряемых вызовов на обработчик")
+    parser.add_argument("--warmup", type=int, default=3, help="вызовов прогрева, не входящих в замер")
+    parser.add_argument("--handlers", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--data-dir", default=tempfile.gettempdir(), help="где хранить синтетическую базу")
+    parser.add_argument("--rebuild", action="store_true", help="пересоздать синтетическую базу")
+    parser.add_argument("--save-baseline", metavar="FILE", help="сохранить результаты как базовые")
+    parser.add_argument("--baseline", metavar="FILE", help="сравнить с базовым прогоном")
+    parser.add_argument("--tolerance", type=float, default=20.0, help="допустимый рост p95 в процентах")
+    args = parser.parse_args()
+
+    # Журнал бота - только предупреждения (медленные запросы) и ошибки
+    logging.getLogger("warehouse").setLevel(logging.WARNING)
+
+    config = {"items": args.items, "reservations": args.reservations, "users": args.users, "seed": args.seed}
+    template = os.path.join(args.data_dir, f"warehouse_bench_{args.items}_{args.reservations}_{args.users}_{args.seed}.db")
+    if args.rebuild or not os.path.exists(template):
+        build_template(template, args.items, args.reservations, args.users, args.seed)
+
+    # Обработчики пишут в базу (брони), поэтому каждый прогон идет на свежей копии
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+        shutil.copyfile(template, db_path)
+        results = {
+            "config": config,
+            "runs": args.runs,
+            "results": asyncio.run(run_suite(db_path, args.handlers, args.users, args.runs, args.warmup, args.seed)),
+        }
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Базовый прогон сохранен в {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Рост p95 больше {args.tolerance:.0f}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
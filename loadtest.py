@@ -0,0 +1,533 @@
+"""Сквозной нагрузочный тест бота против локальной имитации Bot API.
+
+Бот запускается отдельным процессом (python warehouse.py) на заполненной
+синтетической базе и ходит не в Telegram, а в имитацию Bot API из этого
+скрипта. Имитация отвечает с заданной задержкой и может отдавать 429.
+Виртуальные пользователи проходят настоящие диалоги бота: добавление
+позиции, бронирование с листанием календаря, возврат брони и просмотр
+позиции. Время шага - от появления обновления в getUpdates до ответа бота
+в этот чат.
+
+    python loadtest.py                                  # 200 пользователей, 60 с
+    python loadtest.py --users 500 --duration 120 --latency-ms 80 --rate-429 0.01
+    python loadtest.py --report loadtest.json           # отчет еще и в JSON
+"""
+import argparse
+import asyncio
+import collections
+import email
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import date, timedelta
+
+import numpy as np
+
+import warehouse
+
+TOKEN = "123456:loadtest"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Склад", "username": "warehouse_loadtest_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": True}
+# Методы, которыми бот отвечает пользователю; только они получают задержку 429
+REPLY_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "sendPhoto"}
+# Виртуальные пользователи не пересекаются с владельцами синтетических броней
+SEEDED_USERS = 500
+VIRTUAL_USER_BASE = 10_000_000
+
+class Reply:
+    """Сообщение бота, отправленное или отредактированное в чате пользователя"""
+
+    def __init__(self, method, message_id, text, markup):
+        self.method = method
+        self.message_id = message_id
+        self.text = text or ""
+        self.buttons = [
+            button["callback_data"]
+            for row in (markup or {}).get("inline_keyboard", [])
+            for button in row
+            if "callback_data" in button
+        ]
+
+    def find(self, prefix):
+        return [data for data in self.buttons if data.startswith(prefix)]
+
+class FakeBotAPI(warehouse.HTTPServer):
+    """Имитация Bot API на HTTP-сервере бота: getUpdates, отправка и правка сообщений, getFile.
+
+    Ответы бота пересылаются в очереди виртуальных пользователей по chat_id.
+    """
+
+    def __init__(self, host, port, latency_ms, rate_429, retry_after, seed):
+        super().__init__(host, port, {("POST", f"/bot{TOKEN}/{method}"): self._api_method(method) for method in (
+            "getMe", "getUpdates", "deleteWebhook", "sendMessage", "editMessageText",
+            "editMessageReplyMarkup", "sendPhoto", "getFile", "answerCallbackQuery",
+        )})
+        self.latency = latency_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+        self.polling = asyncio.Event()
+        self.listeners = {}
+        self._updates = []
+        self._update_id = 0
+        self._new_update = asyncio.Event()
+        self._message_id = 0
+        self._files = {}
+        self._forced_429 = 0
+
+    def throttle(self, count=1):
+        """Следующие count ответов пользователям получат 429 независимо от rate_429"""
+        self._forced_429 += count
+
+    def push_update(self, update):
+        self._update_id += 1
+        update["update_id"] = self._update_id
+        self._updates.append(update)
+        self._new_update.set()
+
+    def register_file(self, file_id, data):
+        self._files[file_id] = data
+
+    def _api_method(self, method):
+        async def handler(headers, body):
+            self.calls[method] += 1
+            params = self._parse(headers.get("content-type", ""), body)
+            if method == "getUpdates":
+                return 200, self._ok(await self._get_updates(params))
+            if self.latency:
+                await asyncio.sleep(max(0.0, self.rng.gauss(self.latency, self.latency / 4)))
+            if method in REPLY_METHODS and (self._forced_429 or self.rng.random() < self.rate_429):
+                self._forced_429 = max(0, self._forced_429 - 1)
+                self.throttled[method] += 1
+                return 429, json.dumps({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }).encode()
+            return 200, self._ok(self._dispatch(method, params))
+        return handler
+
+    @staticmethod
+    def _parse(content_type, body):
+        if content_type.startswith("multipart/form-data"):
+            message = email.message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in message.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename() is None:
+                    params[name] = part.get_payload(decode=True).decode()
+                else:
+                    params[name] = part.get_payload(decode=True)
+            return params
+        return dict(urllib.parse.parse_qsl(body.decode()))
+
+    @staticmethod
+    def _ok(result):
+        return json.dumps({"ok": True, "result": result}).encode()
+
+    async def _get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
+
+    def _dispatch(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getFile":
+            file_id = params["file_id"]
+            path = f"photos/{file_id}.jpg"
+            data = self._files.get(file_id, b"")
+            # Бот запрашивает файл по адресу с экранированным путем (двоеточие токена - %3A)
+            self.routes[("GET", urllib.parse.quote(f"/file/bot{TOKEN}/{path}"))] = lambda headers, body: self._file(data)
+            return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(data), "file_path": path}
+        if method not in REPLY_METHODS:
+            return True
+        chat_id = int(params["chat_id"])
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        if method.startswith("edit"):
+            message_id = int(params["message_id"])
+        else:
+            self._message_id += 1
+            message_id = self._message_id
+        message = {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                   "chat": {"id": chat_id, "type": "private"}}
+        if method == "sendPhoto":
+            photo = params["photo"]
+            file_id = photo if isinstance(photo, str) else f"sent{message_id}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 800, "height": 600}]
+            text = params.get("caption")
+        else:
+            text = params.get("text")
+            message["text"] = text or ""
+        if markup:
+            message["reply_markup"] = markup
+        listener = self.listeners.get(chat_id)
+        if listener is not None:
+            listener.put_nowait(Reply(method, message_id, text, markup))
+        return message
+
+    async def _file(self, data):
+        return 200, data
+
+    async def stop(self):
+        # Ожидающий getUpdates отвечает сразу, чтобы соединение закрылось вместе с сервером
+        self._new_update.set()
+        await asyncio.sleep(0.1)
+        await super().stop()
+
+class StepFailed(Exception):
+    pass
+
+class Stats:
+    """Задержки шагов и сценариев; пропускная способность считается только по окну нагрузки"""
+
+    def __init__(self, stop_at):
+        self.stop_at = stop_at
+        self.steps = collections.defaultdict(list)
+        self.step_failures = collections.Counter()
+        self.flows = collections.defaultdict(list)
+        self.flow_outcomes = collections.Counter()
+        self.window_steps = 0
+        self.window_flows = 0
+
+    def step_done(self, step, seconds):
+        self.steps[step].append(seconds)
+        self.window_steps += time.perf_counter() <= self.stop_at
+
+    def flow_done(self, flow, seconds):
+        self.flows[flow].append(seconds)
+        self.window_flows += time.perf_counter() <= self.stop_at
+
+class VirtualUser:
+    """Пользователь, проходящий диалоги бота кнопками и текстом"""
+
+    def __init__(self, api, user_id, stats, rng, timeout):
+        self.api = api
+        self.user_id = user_id
+        self.stats = stats
+        self.rng = rng
+        self.timeout = timeout
+        self.replies = asyncio.Queue()
+        self.counter = 0
+        api.listeners[user_id] = self.replies
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"Нагрузка {self.user_id}",
+                "username": f"load{self.user_id}"}
+
+    def _message(self, **fields):
+        self.counter += 1
+        return {"message_id": self.counter, "date": int(time.time()), "from": self._user(),
+                "chat": {"id": self.user_id, "type": "private"}, **fields}
+
+    async def _step(self, step, update, expect):
+        """Отправляет обновление и ждет подходящий ответ бота"""
+        # Запоздавшие ответы на прошлые шаги (например, вторая часть длинного списка) не учитываются
+        while not self.replies.empty():
+            self.replies.get_nowait()
+        started = time.perf_counter()
+        self.api.push_update(update)
+        deadline = started + self.timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            try:
+                reply = await asyncio.wait_for(self.replies.get(), remaining) if remaining > 0 else None
+            except asyncio.TimeoutError:
+                reply = None
+            if reply is None:
+                self.stats.step_failures[step] += 1
+                raise StepFailed(step)
+            if expect is None or expect(reply):
+                self.stats.step_done(step, time.perf_counter() - started)
+                return reply
+
+    async def text(self, step, text, expect=None):
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return await self._step(step, {"message": self._message(**fields)}, expect)
+
+    async def photo(self, step, expect=None):
+        file_id = f"load{self.user_id}_{self.counter}"
+        self.api.register_file(file_id, f"фото {file_id}".encode() * 64)
+        photo = [{"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 1280, "height": 960}]
+        return await self._step(step, {"message": self._message(photo=photo)}, expect)
+
+    async def click(self, step, reply, data, expect=None):
+        self.counter += 1
+        query = {
+            "id": f"{self.user_id}_{self.counter}",
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {"message_id": reply.message_id, "date": int(time.time()), "from": BOT_USER,
+                        "chat": {"id": self.user_id, "type": "private"}, "text": reply.text},
+        }
+        return await self._step(step, {"callback_query": query}, expect)
+
+    async def pick_date(self, step, reply, kind, day):
+        """Выбирает дату в календаре бота, листая месяцы вперед"""
+        target = f"date_{kind}_{day.isoformat()}"
+        while target not in reply.buttons:
+            forward = reply.find(f"nav_{kind}_")
+            if not forward:
+                raise StepFailed(step)
+            reply = await self.click(f"{step}_nav", reply, forward[-1], has_buttons(f"date_{kind}_"))
+        return await self.click(step, reply, target)
+
+    async def cancel(self):
+        try:
+            await self.text("cancel", "/cancel")
+        except StepFailed:
+            pass
+
+def has_buttons(prefix):
+    return lambda reply: bool(reply.find(prefix))
+
+async def flow_view(user):
+    reply = await user.text("view_start", "Просмотр позиции", has_buttons("view_categories"))
+    reply = await user.click("view_categories", reply, "view_categories", has_buttons("viewcat_"))
+    reply = await user.click("view_category", reply, user.rng.choice(reply.find("viewcat_")))
+    items = reply.find("viewitem_")
+    if not items:
+        return "пусто"
+    await user.click("view_item", reply, user.rng.choice(items))
+    return "ok"
+
+async def flow_reserve(user):
+    reply = await user.text("reserve_start", "Забронировать")
+    if reply.find("pg_ritem_n") and user.rng.random() < 0.3:
+        reply = await user.click("reserve_page", reply, reply.find("pg_ritem_n")[0], has_buttons("ritem_"))
+    items = reply.find("ritem_")
+    if not items:
+        return "пусто"
+    await user.click("reserve_item", reply, user.rng.choice(items))
+    reply = await user.text("reserve_quantity", "1")
+    if not reply.find("date_start_"):
+        await user.cancel()
+        return "отказ"
+    start = date.today() + timedelta(days=user.rng.randint(0, 45))
+    reply = await user.pick_date("reserve_start_date", reply, "start", start)
+    if not reply.find("date_end_"):
+        await user.cancel()
+        return "отказ"
+    # Окончание брони - строго после начала
+    await user.pick_date("reserve_end_date", reply, "end", start + timedelta(days=user.rng.randint(1, 5)))
+    reply = await user.text("reserve_event", f"Нагрузочный тест {user.counter}")
+    if not reply.text.startswith("✅"):
+        await user.cancel()
+        return "отказ"
+    return "ok"
+
+async def flow_return(user):
+    reply = await user.text("return_start", "Вернуть бронь")
+    reservations = reply.find("ret_")
+    if not reservations:
+        return "пусто"
+    await user.click("return_select", reply, user.rng.choice(reservations))
+    return "ok"
+
+async def flow_add(user, photo_share):
+    reply = await user.text("add_start", "Добавить позицию", has_buttons("cat_"))
+    await user.click("add_category", reply, user.rng.choice(reply.find("cat_")))
+    await user.text("add_name", f"Нагрузка {user.user_id}-{user.counter}")
+    await user.text("add_quantity", str(user.rng.randint(1, 20)))
+    if user.rng.random() < photo_share:
+        await user.photo("add_photo")
+    else:
+        await user.text("add_photo", "пропустить")
+    reply = await user.text("add_comment", "Добавлено нагрузочным тестом")
+    return "ok" if reply.text.startswith("✅") else "отказ"
+
+FLOWS = {"view": flow_view, "reserve": flow_reserve, "return": flow_return, "add": flow_add}
+
+async def run_user(user, stop_at, mix, think, photo_share):
+    names, weights = zip(*mix.items())
+    # Пользователи начинают вразнобой, а не одной волной
+    await asyncio.sleep(user.rng.uniform(0, think * 2))
+    while time.perf_counter() < stop_at:
+        name = user.rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            args = (photo_share,) if name == "add" else ()
+            outcome = await FLOWS[name](user, *args)
+        except StepFailed:
+            outcome = "сбой"
+            await user.cancel()
+        user.stats.flow_outcomes[name, outcome] += 1
+        if outcome == "ok":
+            user.stats.flow_done(name, time.perf_counter() - started)
+        await asyncio.sleep(user.rng.expovariate(1 / think) if think else 0)
+
+def seed_database(path, items, reservations, users, seed):
+    """Синтетический склад для бота (брони принадлежат пользователям 1..users)"""
+    warehouse.DB_NAME = path
+    if not warehouse.init_db() or not warehouse.migrate_database():
+        raise RuntimeError("Не удалось создать схему базы")
+    warehouse.create_search_index()
+    conn = warehouse.get_db_connection()
+    try:
+        warehouse.seed_synthetic_data(conn, items, reservations, users, seed)
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+async def start_bot(workdir, api):
+    env = {key: value for key, value in os.environ.items()
+           if key not in ("WEBHOOK_URL", "RENDER_EXTERNAL_URL", "RENDER", "PORT", "DATABASE_URL")}
+    env.update({
+        "BOT_TOKEN": TOKEN,
+        "BOT_MODE": "polling",
+        "BOT_API_URL": f"http://{api.host}:{api.port}/bot",
+        "BOT_API_FILE_URL": f"http://{api.host}:{api.port}/file/bot",
+    })
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(warehouse.__file__),
+        cwd=workdir, env=env, stdout=log, stderr=asyncio.subprocess.STDOUT,
+    )
+    log.close()
+    polling = asyncio.create_task(api.polling.wait())
+    exited = asyncio.create_task(process.wait())
+    await asyncio.wait({polling, exited}, timeout=60, return_when=asyncio.FIRST_COMPLETED)
+    if not polling.done():
+        polling.cancel()
+        exited.cancel()
+        process.kill()
+        raise RuntimeError(f"Бот не начал получать обновления, журнал: {os.path.join(workdir, 'bot.log')}")
+    exited.cancel()
+    return process
+
+async def stop_bot(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), 40)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+def percentiles(samples):
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+    return {"count": len(samples), "p50_ms": round(float(p50), 1), "p95_ms": round(float(p95), 1),
+            "p99_ms": round(float(p99), 1)}
+
+def build_report(stats, api, elapsed, args):
+    steps = sum(len(samples) for samples in stats.steps.values())
+    return {
+        "config": {key: getattr(args, key) for key in
+                   ("users", "duration", "latency_ms", "rate_429", "think_ms", "items", "reservations")},
+        "elapsed_s": round(elapsed, 1),
+        "steps_per_s": round(stats.window_steps / args.duration, 1),
+        "flows_per_s": round(stats.window_flows / args.duration, 2),
+        "steps": {name: percentiles(samples) for name, samples in sorted(stats.steps.items())},
+        "all_steps": percentiles([s for samples in stats.steps.values() for s in samples]) if steps else None,
+        "step_failures": dict(stats.step_failures),
+        "flows": {name: percentiles(samples) for name, samples in sorted(stats.flows.items())},
+        "flow_outcomes": {f"{name}:{outcome}": count for (name, outcome), count in sorted(stats.flow_outcomes.items())},
+        "api_calls": dict(api.calls.most_common()),
+        "api_429": dict(api.throttled),
+    }
+
+def print_report(report):
+    print(f"\nШагов {report['steps_per_s']}/с, завершенных сценариев {report['flows_per_s']}/с "
+          f"(прогон с завершением начатых сценариев - {report['elapsed_s']} с)")
+    print(f"\n{'Шаг':<26}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9} мс  сбоев")
+    rows = list(report["steps"].items())
+    if report["all_steps"]:
+        rows.append(("все шаги", report["all_steps"]))
+    for name, row in rows:
+        failures = report["step_failures"].get(name, 0) if name != "все шаги" else sum(report["step_failures"].values())
+        print(f"{name:<26}{row['count']:>7}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}     {failures}")
+    print(f"\n{'Сценарий (целиком)':<26}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9} мс")
+    for name, row in report["flows"].items():
+        print(f"{name:<26}{row['count']:>7}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}")
+    print("\nИсходы сценариев: " + ", ".join(f"{key} {count}" for key, count in report["flow_outcomes"].items()))
+    print("Вызовы Bot API: " + ", ".join(f"{method} {count}" for method, count in report["api_calls"].items()))
+    if report["api_429"]:
+        print("Ответы 429: " + ", ".join(f"{method} {count}" for method, count in report["api_429"].items()))
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in FLOWS:
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+async def run(args):
+    api = FakeBotAPI("127.0.0.1", args.port, args.latency_ms, args.rate_429, args.retry_after, args.seed)
+    await api.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"Заполнение базы: {args.items} позиций, {args.reservations} броней...")
+        await asyncio.to_thread(
+            seed_database, os.path.join(workdir, "warehouse.db"), args.items, args.reservations, SEEDED_USERS, args.seed
+        )
+        process = await start_bot(workdir, api)
+        print(f"Бот запущен, {args.users} пользователей на {args.duration} с...")
+        started = time.perf_counter()
+        stop_at = started + args.duration
+        stats = Stats(stop_at)
+        users = [
+            VirtualUser(api, VIRTUAL_USER_BASE + n, stats, random.Random(f"{args.seed}:{n}"), args.step_timeout)
+            for n in range(args.users)
+        ]
+        await asyncio.gather(*(
+            run_user(user, stop_at, args.mix, args.think_ms / 1000, args.photo_share) for user in users
+        ))
+        elapsed = time.perf_counter() - started
+        await stop_bot(process)
+        if args.keep_log:
+            with open(os.path.join(workdir, "bot.log"), "rb") as src, open(args.keep_log, "wb") as dst:
+                dst.write(src.read())
+    await api.stop()
+    return build_report(stats, api, elapsed, args)
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота против имитации Bot API")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=60, help="секунд нагрузки")
+    parser.add_argument("--think-ms", type=float, default=1000, help="средняя пауза пользователя между сценариями")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("view=4,reserve=3,return=1.5,add=1.5"),
+                        help="доли сценариев, например view=4,reserve=3,return=1.5,add=1.5")
+    parser.add_argument("--photo-share", type=float, default=0.5, help="доля добавлений позиции с фото")
+    parser.add_argument("--latency-ms", type=float, default=50, help="средняя задержка ответа Bot API")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 на отправку сообщений")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--step-timeout", type=float, default=15, help="сколько ждать ответа бота на шаг")
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--reservations", type=int, default=50000)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report", metavar="FILE", help="сохранить отчет в JSON")
+    parser.add_argument("--keep-log", metavar="FILE", help="сохранить журнал бота")
+    args = parser.parse_args()
+
+    # Журнал имитации и заполнения базы - только предупреждения и ошибки
+    logging.getLogger("warehouse").setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,844 @@
+"""Проверки бота на временной базе SQLite"""
+import asyncio
+import collections
+import contextlib
+import functools
+import logging
+import math
+import os
+import random
+import re
+import socket
+import time
+import uuid
+from datetime import date, timedelta
+
+import pytest
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+import loadtest
+import warehouse
+from bench import FakeContext, FakeMessage, FakeUpdate
+
+logging.getLogger("warehouse").setLevel(logging.WARNING)
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """Чистая база во временной папке и свои экземпляры глобальных объектов бота"""
+    monkeypatch.setattr(warehouse, "DB_NAME", str(tmp_path / "warehouse.db"))
+    monkeypatch.setattr(warehouse, "db", warehouse.create_backend(""))
+    monkeypatch.setattr(warehouse, "write_batcher", warehouse.WriteBatcher())
+    monkeypatch.setattr(warehouse, "inventory", warehouse.Inventory())
+    monkeypatch.setattr(warehouse, "reminders", warehouse.ReminderSchedule())
+    monkeypatch.setattr(warehouse, "inventory_generation", 0)
+    monkeypatch.setattr(warehouse, "response_cache", warehouse.ResponseCache())
+    monkeypatch.setattr(warehouse, "inline_cache", warehouse.ResponseCache(warehouse.INLINE_CACHE_SIZE))
+    return warehouse
+
+def run(storage, scenario):
+    """Выполняет scenario() с открытым хранилищем и закрывает его после"""
+    async def wrapper():
+        await storage.db.open()
+        try:
+            return await scenario()
+        finally:
+            await storage.write_batcher.close()
+            await storage.db.close()
+    return asyncio.run(wrapper())
+
+async def category_ids(storage):
+    return [category_id for category_id, _ in await storage.db.fetchall(storage.SQL_CATEGORIES_ALL)]
+
+def test_write_batcher_isolates_failed_operation(storage):
+    """Ошибка одной операции группы откатывает только ее, остальные фиксируются в той же транзакции"""
+    async def scenario():
+        category_id = (await category_ids(storage))[0]
+        transactions = 0
+        transaction = storage.db.transaction
+
+        def counting_transaction():
+            nonlocal transactions
+            transactions += 1
+            return transaction()
+        storage.db.transaction = counting_transaction
+
+        async def failing(tx):
+            await tx.execute("INSERT INTO categories (name) VALUES ('Откатится')")
+            raise ValueError("ошибка операции")
+
+        results = await asyncio.gather(
+            storage.add_stock(category_id, "Первая", 1),
+            storage.write_batcher.run(failing),
+            storage.add_stock(category_id, "Вторая", 2),
+            return_exceptions=True,
+        )
+        categories = await storage.db.fetchall("SELECT id FROM categories WHERE name = 'Откатится'")
+        items = await storage.db.fetchall("SELECT name, quantity FROM items ORDER BY name")
+        return transactions, results, categories, items
+
+    transactions, results, categories, items = run(storage, scenario)
+    assert transactions == 1
+    assert results[0][1] == 1 and results[2][1] == 2
+    assert isinstance(results[1], ValueError)
+    assert categories == []
+    assert items == [("Вторая", 2), ("Первая", 1)]
+
+def brute_force_available(quantity, bookings, start, end):
+    """Свободное количество на период перебором: остаток минус пик суммы пересекающихся броней по дням"""
+    peak = 0
+    for day in warehouse.reservation_days(start, end):
+        peak = max(peak, sum(amount for first, last, amount in bookings if first <= day <= last))
+    return max(0, quantity - peak)
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_booking_matches_brute_force_peak(storage, seed):
+    """Решения book_reservation и item_day_usage совпадают с перебором по дням"""
+    rng = random.Random(seed)
+    total = 10
+
+    async def scenario():
+        category_id = (await category_ids(storage))[0]
+        item_id, _ = await storage.add_stock(category_id, "Колонка", total)
+        accepted = []
+        for _ in range(60):
+            first = rng.randint(0, 20)
+            start, end = storage.today_iso(first), storage.today_iso(first + rng.randint(0, 6))
+            quantity = rng.randint(1, 4)
+            expected = brute_force_available(total, accepted, start, end)
+            reservation_id, _, available = await storage.book_reservation(
+                item_id, quantity, start, end, 1, "user", "User", "Мероприятие"
+            )
+            assert (reservation_id is not None) == (quantity <= expected)
+            if reservation_id is not None:
+                accepted.append((start, end, quantity))
+                assert available == expected - quantity
+            else:
+                assert available == expected
+        usage = dict(await storage.db.fetchall("SELECT day, reserved FROM item_day_usage WHERE item_id = ?", (item_id,)))
+        return accepted, usage
+
+    accepted, usage = run(storage, scenario)
+    expected_usage = {}
+    for start, end, quantity in accepted:
+        for day in warehouse.reservation_days(start, end):
+            expected_usage[day] = expected_usage.get(day, 0) + quantity
+    assert usage == expected_usage
+
+def test_concurrent_bookings_never_overbook(storage):
+    """Одновременные брони одних дней не превышают остаток"""
+    async def scenario():
+        category_id = (await category_ids(storage))[0]
+        item_id, _ = await storage.add_stock(category_id, "Микрофон", 5)
+        start, end = storage.today_iso(1), storage.today_iso(3)
+        results = await asyncio.gather(*[
+            storage.book_reservation(item_id, 1, start, end, user_id, "user", "User", "Мероприятие")
+            for user_id in range(20)
+        ])
+        usage = await storage.db.fetchall("SELECT MAX(reserved) FROM item_day_usage WHERE item_id = ?", (item_id,))
+        return results, usage[0][0]
+
+    results, peak = run(storage, scenario)
+    assert sum(reservation_id is not None for reservation_id, _, _ in results) == 5
+    assert peak == 5
+
+def fill_inventory(storage, categories, rng, count):
+    names = ["Кабель", "Колонка", "Микрофон", "Пульт", "Стойка", "Штатив"]
+    return [
+        storage.add_stock(rng.choice(categories), f"{rng.choice(names)} {rng.randint(1, 40)}", rng.randint(0, 9))
+        for _ in range(count)
+    ]
+
+def walk_pages(inventory, ids, size, where=None):
+    """Проходит ids страницами вперед до конца и обратно до начала; возвращает оба прохода"""
+    forward = []
+    cursor = None
+    while True:
+        page, has_more = inventory.page(ids, cursor, size=size, where=where)
+        forward.extend(item.id for item in page)
+        if not has_more:
+            break
+        cursor = page[-1].id
+    pages = [page]
+    while True:
+        page, has_more = inventory.page(ids, pages[-1][0].id, backward=True, size=size, where=where)
+        if not page:
+            break
+        pages.append(page)
+        if not has_more:
+            break
+    backward = [item.id for page in reversed(pages) for item in page]
+    return forward, backward
+
+def test_inventory_keyset_paging_both_directions(storage):
+    """Страницы вперед и назад проходят склад в порядке (категория, название, id) без пропусков и повторов"""
+    rng = random.Random(7)
+
+    async def scenario():
+        categories = await category_ids(storage)
+        await asyncio.gather(*fill_inventory(storage, categories, rng, 150))
+        await storage.inventory.load()
+        return categories
+
+    categories = run(storage, scenario)
+    inventory = storage.inventory
+    expected = sorted(inventory.items, key=inventory.order_key)
+    for size in (1, 7, 20, len(expected) + 1):
+        forward, backward = walk_pages(inventory, inventory.ordered, size)
+        assert forward == expected
+        assert backward == expected
+    in_stock = [item_id for item_id in expected if inventory.items[item_id].quantity > 0]
+    forward, backward = walk_pages(inventory, inventory.ordered, 6, where=lambda item: item.quantity > 0)
+    assert forward == in_stock and backward == in_stock
+    for category_id in categories:
+        ids = inventory.category_items(category_id)
+        if not ids:
+            continue
+        expected = sorted(ids, key=inventory.category_key)
+        forward, backward = walk_pages(inventory, ids, 5)
+        assert forward == expected and backward == expected
+    assert inventory.page(inventory.ordered, cursor=10 ** 9) == ([], False)
+
+def test_sorted_ids_matches_sorted_list(monkeypatch):
+    """Куски SortedIds дают тот же порядок, что и сплошной отсортированный список, при вставках и удалениях"""
+    monkeypatch.setattr(warehouse.SortedIds, "CHUNK_SIZE", 4)
+    rng = random.Random(5)
+    names = {}
+    key = lambda item_id: (names[item_id], item_id)
+    ids = warehouse.SortedIds(key)
+    for step in range(3000):
+        if names and rng.random() < 0.45:
+            item_id = rng.choice(sorted(names))
+            ids.remove(item_id)
+            del names[item_id]
+        else:
+            item_id = rng.randrange(10 ** 6)
+            if item_id in names:
+                continue
+            names[item_id] = rng.choice("абвгд") * rng.randint(1, 3)
+            ids.add(item_id)
+        if step % 50:
+            continue
+        expected = sorted(names, key=key)
+        assert list(ids) == expected and len(ids) == len(expected)
+        for n, item_id in enumerate(expected):
+            assert list(ids.walk(item_id)) == expected[n + 1:]
+            assert list(ids.walk(item_id, backward=True)) == expected[:n][::-1]
+        for name in ("а", "вв", "д", "е"):
+            following = [item_id for item_id in expected if key(item_id) >= (name,)]
+            assert ids.ceiling((name,)) == (following[0] if following else None)
+    names[-1] = "в"
+    assert ids.walk(-1) is None
+    del names[-1]
+    rebuilt = warehouse.SortedIds(key, names)
+    assert list(rebuilt) == sorted(names, key=key)
+
+def test_inventory_write_through_matches_fresh_load(storage):
+    """Модель после записей обработчиков совпадает с заново загруженной из базы"""
+    rng = random.Random(11)
+
+    async def scenario():
+        categories = await category_ids(storage)
+        await asyncio.gather(*fill_inventory(storage, categories, rng, 60))
+        await storage.inventory.load()
+        await asyncio.gather(*fill_inventory(storage, categories, rng, 40))
+        for item_id in rng.sample(sorted(storage.inventory.items), 15):
+            if await storage.apply_item_delete(item_id) is not None:
+                storage.inventory.remove(item_id)
+        fresh = storage.Inventory()
+        await fresh.load()
+        return storage.inventory, fresh
+
+    live, fresh = run(storage, scenario)
+    assert list(live.ordered) == list(fresh.ordered)
+    assert {category_id: list(ids) for category_id, ids in live.by_category.items()} == {
+        category_id: list(ids) for category_id, ids in fresh.by_category.items()
+    }
+    assert live.postings == fresh.postings
+    assert {item_id: (item.name, item.quantity) for item_id, item in live.items.items()} == {
+        item_id: (item.name, item.quantity) for item_id, item in fresh.items.items()
+    }
+
+async def remote_insert(storage, category_id, name, quantity):
+    """Позиция, добавленная другой репликой: в базе есть, в модели этого процесса - нет"""
+    return await storage.db.insert(
+        "INSERT INTO items (category_id, name, quantity) VALUES (?, ?, ?)", (category_id, name, quantity)
+    )
+
+async def stock_listing(storage):
+    update = FakeUpdate(1)
+    await storage.current_stock(update, FakeContext())
+    return "".join(update.replies)
+
+def test_listing_read_during_reload_is_not_cached_past_it(storage):
+    """Остатки, прочитанные пока идет перезагрузка по оповещению реплики, не скрывают новую позицию после нее"""
+    async def scenario():
+        category_id = (await category_ids(storage))[0]
+        await storage.add_stock(category_id, "Старая", 1)
+        await storage.inventory.load()
+        item_id = await remote_insert(storage, category_id, "Новая", 3)
+        storage.inventory_changed(item_id, remote=True)
+        # Перезагрузка еще не прочитала базу: ответ строится по старой модели
+        during = await stock_listing(storage)
+        await asyncio.gather(*storage.reload_tasks)
+        return during, await stock_listing(storage)
+
+    during, after = run(storage, scenario)
+    assert "Новая" not in during
+    assert "Новая: 3шт" in after
+
+class FakeInlineQuery:
+    def __init__(self, query):
+        self.query = query
+        self.results = None
+
+    async def answer(self, results, **kwargs):
+        self.results = results
+
+async def inline_titles(storage, query):
+    update = FakeUpdate(1)
+    update.inline_query = FakeInlineQuery(query)
+    await storage.inline_search(update, FakeContext())
+    return [result.title for result in update.inline_query.results]
+
+def test_inline_results_read_during_reload_are_not_cached_past_it(storage):
+    """Inline-ответ, построенный пока идет перезагрузка, не скрывает новую позицию после нее"""
+    async def scenario():
+        category_id = (await category_ids(storage))[0]
+        await storage.add_stock(category_id, "Прожектор 1", 1)
+        await storage.inventory.load()
+        item_id = await remote_insert(storage, category_id, "Прожектор 2", 1)
+        storage.inventory_changed(item_id, remote=True)
+        during = await inline_titles(storage, "прожектор")
+        await asyncio.gather(*storage.reload_tasks)
+        return during, await inline_titles(storage, "прожектор")
+
+    during, after = run(storage, scenario)
+    assert during == ["Прожектор 1"]
+    assert after == ["Прожектор 1", "Прожектор 2"]
+
+@functools.lru_cache(maxsize=None)
+def item_trigrams(name, category):
+    return warehouse.word_trigrams(f"{name} {category}")
+
+def brute_force_search(inventory, text, limit=warehouse.INLINE_RESULTS_LIMIT, min_share=0.5):
+    """id позиций поиска перебором: по убыванию совпавших триграмм, затем в порядке остатков"""
+    trigrams = warehouse.word_trigrams(text, prefix=True)
+    if not trigrams:
+        return []
+    needed = max(1, math.ceil(len(trigrams) * min_share))
+    ranked = []
+    for item_id, item in inventory.items.items():
+        count = len(trigrams & item_trigrams(item.name, inventory.categories[item.category_id]))
+        if count >= needed:
+            ranked.append((-count, inventory.order_key(item_id)))
+    return [key[-1] for _, key in sorted(ranked)[:limit]]
+
+def test_search_matches_brute_force_while_typing(storage):
+    """Поиск при посимвольном наборе (от совпадений префикса и заново) и после записей совпадает с перебором"""
+    rng = random.Random(5)
+    categories = {1: "Звук", 2: "Свет", 3: "Сцена"}
+    words = ["Кабель", "Колонка", "Микрофон", "Прожектор", "Пульт", "Штатив", "Удлинитель"]
+    inventory = storage.Inventory()
+    inventory._build(categories, [
+        (item_id, rng.choice(list(categories)), f"{rng.choice(words)} {rng.randint(1, 99999)}", 1, None)
+        for item_id in range(1, 2001)
+    ])
+    queries = ["Колонка 12", "кабель 4521", "колонка 12345 звук", "кбель 45", "прожектор 25 свет", "сцена", "нет такого", "Пульт  1"]
+    for round_number in range(3):
+        for query in queries:
+            for end in range(1, len(query) + 1):
+                assert [row[0] for row in inventory.search(query[:end])] == brute_force_search(inventory, query[:end])
+        inventory._search_matches.clear()
+        for query in queries:
+            assert [row[0] for row in inventory.search(query)] == brute_force_search(inventory, query)
+        # Записи между наборами: совпадения префиксов прежней модели не используются
+        for item_id in rng.sample(sorted(inventory.items), 200):
+            inventory.remove(item_id)
+        for item_id in range(2001 + round_number * 300, 2301 + round_number * 300):
+            inventory.put(item_id, rng.choice(list(categories)), f"{rng.choice(words)} {rng.randint(1, 99999)}", 1, None)
+
+def test_search_from_prefix_adds_items_matched_by_new_trigrams():
+    """Продолжение запроса находит позиции, которые не совпали с префиксом, но совпали с добавленными триграммами"""
+    inventory = warehouse.Inventory()
+    rows = [(item_id, 1, f"Кабель {item_id}", 1, None) for item_id in range(1, 501)]
+    inventory._build({1: "Звук"}, rows + [(501, 1, "Каток 1234", 1, None)])
+    assert 501 not in [row[0] for row in inventory.search("кабель 12", limit=1000)]
+    assert [row[0] for row in inventory.search("кабель 1234")] == brute_force_search(inventory, "кабель 1234")
+    assert 501 in [row[0] for row in inventory.search("кабель 1234", limit=1000)]
+    # Удаление сбрасывает совпадения префиксов: удаленная позиция не возвращается
+    inventory.search("кабель 12")
+    inventory.remove(12)
+    assert [row[0] for row in inventory.search("кабель 123")] == brute_force_search(inventory, "кабель 123")
+
+async def walk_picker(picker, params):
+    """Проходит список выбора страницами вперед до конца и обратно до начала; возвращает id строк обоих проходов"""
+    forward = []
+    rows, has_more = await picker.fetch(params)
+    forward.extend(row[0] for row in rows)
+    while has_more:
+        rows, has_more = await picker.fetch(params, forward[-1])
+        forward.extend(row[0] for row in rows)
+    backward = forward[-len(rows):] if rows else []
+    has_more = bool(backward)
+    while has_more:
+        rows, has_more = await picker.fetch(params, backward[0], backward=True)
+        backward[:0] = [row[0] for row in rows]
+    return forward, backward
+
+def test_return_picker_pages_active_reservations_by_start_date(storage, monkeypatch):
+    """Список возврата проходит брони, не закончившиеся к сегодня, по (дата начала, id) в обе стороны"""
+    monkeypatch.setattr(storage, "PICKER_PAGE_SIZE", 3)
+    rng = random.Random(3)
+
+    async def scenario():
+        category_id = (await category_ids(storage))[0]
+        item_id, _ = await storage.add_stock(category_id, "Колонка", 1000)
+        reservations = []
+        for _ in range(40):
+            start = storage.today_iso(rng.randint(-10, 10))
+            end = (date.fromisoformat(start) + timedelta(days=rng.randint(0, 5))).isoformat()
+            reservation_id = await storage.db.insert(
+                "INSERT INTO reservations (item_id, quantity, start_date, end_date, user_id, username, first_name, event_name) "
+                "VALUES (?, 1, ?, ?, 1, 'user', 'User', 'Мероприятие')",
+                (item_id, start, end),
+            )
+            reservations.append((start, reservation_id, end))
+        picker = storage.PICKERS["ret"]
+        return reservations, await walk_picker(picker, picker.params("", FakeContext()))
+
+    reservations, (forward, backward) = run(storage, scenario)
+    today = storage.today_iso()
+    expected = [reservation_id for start, reservation_id, end in sorted(reservations) if end >= today]
+    assert 0 < len(expected) < len(reservations)
+    assert forward == expected and backward == expected
+
+def matches_term(term, *fields):
+    return any(term.casefold() in (field or "").casefold() for field in fields)
+
+@pytest.mark.parametrize("term", ["КОЛ", "олонка 1", "ШНУР", "ко", "Ш"])
+def test_search_pickers_match_substrings_in_both_directions(storage, monkeypatch, term):
+    """Поиск (FTS5 от трех символов, LIKE короче) находит подстроки без учета регистра и листается в обе стороны"""
+    monkeypatch.setattr(storage, "PICKER_PAGE_SIZE", 4)
+    rng = random.Random(9)
+
+    async def scenario():
+        categories = dict(await storage.db.fetchall(storage.SQL_CATEGORIES_ALL))
+        words = ["Колонка", "колонна", "Шнур", "Кабель", "Микшер"]
+        for n in range(60):
+            comment = rng.choice([None, "шнур в комплекте", "Запасная"])
+            await storage.add_stock(rng.choice(list(categories)), f"{rng.choice(words)} {n}", 1, comment=comment)
+        items = await storage.db.fetchall("SELECT id, category_id, name, comment FROM items")
+        kind = "fts" if storage.db.fts_enabled and len(term) >= 3 else "like"
+        picker = storage.PICKERS[kind]
+        params = picker.params("", FakeContext({"search_term": term}))
+        walked = await walk_picker(picker, params)
+        full = await storage.db.fetchall(picker._queries[False, False], (*params, 1000))
+        return categories, items, kind, walked, [row[0] for row in full]
+
+    categories, items, kind, (forward, backward), full = run(storage, scenario)
+    expected = {
+        item_id for item_id, category_id, name, comment in items
+        if matches_term(term, name, comment, categories[category_id])
+    }
+    assert expected
+    assert set(forward) == expected
+    if kind == "like":
+        by_category = {item_id: (categories[category_id], name, item_id) for item_id, category_id, name, _ in items}
+        assert forward == sorted(expected, key=by_category.get)
+    else:
+        # Порядок по релевантности bm25 - тот же, что у запроса без страниц
+        assert forward == full
+    assert backward == forward
+
+def test_reminder_schedule_pops_due_deadlines_like_brute_force():
+    """pop_due по дням с пропусками (бот не работал) совпадает с перебором сроков всех броней"""
+    rng = random.Random(4)
+    offsets = [3, 1, -1]
+    schedule = warehouse.ReminderSchedule(offsets)
+    first_day = date(2026, 1, 1)
+    ends = {reservation_id: first_day + timedelta(days=rng.randint(-5, 40)) for reservation_id in range(1, 201)}
+    for reservation_id, end in ends.items():
+        schedule.reservation_added(reservation_id, end.isoformat())
+    # Первый вызов снимает и сроки, пропущенные до запуска
+    previous = date.min
+    day = first_day
+    while day <= first_day + timedelta(days=50):
+        expected = {}
+        for reservation_id, end in ends.items():
+            # Бронь, закончившаяся раньше окна (schedule.window дней назад), не напоминается
+            if end < day - timedelta(days=schedule.window):
+                continue
+            passed = [offset for offset in offsets if previous < end - timedelta(days=offset) <= day]
+            if passed:
+                expected[reservation_id] = min(passed)
+        assert schedule.pop_due(day.isoformat()) == expected
+        previous = day
+        day += timedelta(days=rng.choice([1, 1, 1, 2, 5]))
+    assert len(schedule) == 0
+
+def test_reminder_schedule_requeue_and_repeated_add():
+    """Повтор недоставленного напоминания приходит в назначенный день; повторная загрузка брони не дублирует сроки"""
+    schedule = warehouse.ReminderSchedule([3, 1, -1])
+    schedule.reservation_added(1, "2026-01-10")
+    schedule.reservation_added(1, "2026-01-10")
+    assert len(schedule) == 3
+    assert schedule.pop_due("2026-01-07") == {1: 3}
+    schedule.requeue(1, 3, "2026-01-08")
+    assert schedule.pop_due("2026-01-08") == {1: 3}
+    assert schedule.pop_due("2026-01-11") == {1: -1}
+    assert len(schedule) == 0
+
+class ChatMessage(FakeMessage):
+    """Сообщение бота, которое обработчик потом правит (ход рассылки)"""
+
+    async def edit_text(self, text, **kwargs):
+        self.replies.append(text)
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+class Deliveries:
+    """Очередь слушателя FakeBotAPI: запоминает время и чат каждого сообщения бота"""
+
+    def __init__(self, chat_id, log, on_delivery):
+        self.chat_id = chat_id
+        self.log = log
+        self.on_delivery = on_delivery
+
+    def put_nowait(self, reply):
+        self.log.append((time.monotonic(), self.chat_id, reply))
+        self.on_delivery(len(self.log))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def test_notify_all_paces_sends_and_waits_out_retry_after(storage, monkeypatch):
+    """/notify_all через имитацию Bot API: темп не выше лимита, пауза на 429 и ровно одно сообщение каждому"""
+    users = 30
+    rate = 40
+    retry_after = 1
+    monkeypatch.setattr(storage, "send_limiter", storage.SendLimiter(rate=rate, chat_interval=1.0))
+    monkeypatch.setattr(storage, "current_broadcast", None)
+
+    async def scenario():
+        category_id = (await category_ids(storage))[0]
+        item_id, _ = await storage.add_stock(category_id, "Колонка", users)
+        for user_id in range(1, users + 1):
+            await storage.book_reservation(item_id, 1, storage.today_iso(1), storage.today_iso(2), user_id, "user", "User", "")
+        api = loadtest.FakeBotAPI("127.0.0.1", free_port(), latency_ms=0, rate_429=0, retry_after=retry_after, seed=1)
+        log = []
+
+        def throttle_halfway(delivered):
+            if delivered == users // 2:
+                api.throttle()
+        api.listeners = {user_id: Deliveries(user_id, log, throttle_halfway) for user_id in range(1, users + 1)}
+        await api.start()
+        try:
+            bot = Bot(loadtest.TOKEN, base_url=f"http://127.0.0.1:{api.port}/bot",
+                      request=HTTPXRequest(connection_pool_size=storage.BROADCAST_WORKERS))
+            async with bot:
+                update = FakeUpdate(1)
+                update.message = update.effective_message = ChatMessage()
+                context = FakeContext()
+                context.bot = bot
+                context.application = FakeApplication()
+                started = time.monotonic()
+                await storage.notify_all_users(update, context)
+                await asyncio.gather(*context.application.tasks)
+                elapsed = time.monotonic() - started
+        finally:
+            await api.stop()
+        return api, log, elapsed, update.message.replies
+
+    api, log, elapsed, replies = run(storage, scenario)
+    assert api.throttled["sendMessage"] == 1
+    assert collections.Counter(chat_id for _, chat_id, _ in log) == {user_id: 1 for user_id in range(1, users + 1)}
+    assert replies[-1] == f"✅ Уведомления отправлены {users} пользователям!"
+    # Вся рассылка стоит на паузе retry_after, остальное время сообщения идут не чаще rate в секунду
+    times = [moment for moment, _, _ in log]
+    assert max(later - earlier for earlier, later in zip(times, times[1:])) >= retry_after * 0.9
+    assert elapsed >= retry_after + (users - 2) / rate
+    for n, moment in enumerate(times):
+        assert sum(1 for other in times[n:] if other - moment < 0.5) <= rate * 0.5 + 2
+
+def test_send_limiter_spaces_sends_per_bot_and_per_chat():
+    """Общий поток не быстрее rate, один чат - не чаще chat_interval, пауза останавливает выдачу"""
+    async def timed(limiter, chats):
+        started = time.monotonic()
+        moments = {}
+        async def send(n, chat_id):
+            await limiter.acquire(chat_id)
+            moments[n] = time.monotonic() - started
+        await asyncio.gather(*[send(n, chat_id) for n, chat_id in enumerate(chats)])
+        return [moments[n] for n in range(len(chats))]
+
+    async def scenario():
+        spread = await timed(warehouse.SendLimiter(rate=50, chat_interval=1.0), range(20))
+        same_chat = await timed(warehouse.SendLimiter(rate=50, chat_interval=0.2), [7, 7, 7])
+        paused = warehouse.SendLimiter(rate=50, chat_interval=0.0)
+        paused.pause(0.3)
+        return spread, same_chat, await timed(paused, [1])
+
+    spread, same_chat, paused = asyncio.run(scenario())
+    assert max(spread) >= 19 / 50 * 0.95
+    assert max(spread) < 1.0
+    ordered = sorted(same_chat)
+    assert ordered[1] - ordered[0] >= 0.19 and ordered[2] - ordered[1] >= 0.19
+    assert paused[0] >= 0.29
+
+def test_http_server_rejects_bad_content_length():
+    """Нечисловой или отрицательный Content-Length - 400 и закрытие соединения, корректный запрос обслуживается"""
+    async def echo(headers, body):
+        return 200, body
+
+    async def request(port, raw):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(raw)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response
+
+    async def scenario():
+        server = warehouse.HTTPServer("127.0.0.1", free_port(), {("POST", "/echo"): echo})
+        await server.start()
+        try:
+            responses = []
+            for length in ("abc", "-5", "1e3", "+4"):
+                responses.append(await request(server.port, (
+                    f"POST /echo HTTP/1.1\r\nContent-Length: {length}\r\n\r\nping"
+                ).encode("latin-1")))
+            responses.append(await request(server.port, (
+                b"POST /echo HTTP/1.1\r\nContent-Length: 4\r\nConnection: close\r\n\r\nping"
+            )))
+            return responses
+        finally:
+            await server.stop()
+
+    *rejected, accepted = asyncio.run(scenario())
+    for response in rejected:
+        assert response.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+        assert b"Connection: close" in response
+    assert accepted.startswith(b"HTTP/1.1 200 OK\r\n") and accepted.endswith(b"\r\n\r\nping")
+
+def test_to_postgres_sql_numbers_every_placeholder():
+    """Каждый '?' запросов реестра становится $1, $2, ... по порядку"""
+    assert warehouse.to_postgres_sql("SELECT id FROM items WHERE category_id = ? AND name IN (?, ?)") == (
+        "SELECT id FROM items WHERE category_id = $1 AND name IN ($2, $3)"
+    )
+    for query in warehouse.QUERIES.values():
+        sql = warehouse.with_placeholders(query, 3)
+        converted = warehouse.to_postgres_sql(sql)
+        assert "?" not in converted
+        assert re.findall(r"\$(\d+)", converted) == [str(n) for n in range(1, sql.count("?") + 1)]
+
+class PostgresStandIn:
+    """Заменитель сервера PostgreSQL для asyncpg поверх файла SQLite.
+
+    Принимает только запросы с плейсхолдерами $n (ровно по одному на аргумент)
+    и выполняет их в SQLite как ?n. Схему PostgreSQL пропускает - таблицы уже
+    созданы init_db. pg_notify внутри транзакции доставляется слушателям
+    только после фиксации, при откате пропадает - как на настоящем сервере.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.listeners = []
+        self.pids = iter(range(1, 10 ** 6))
+
+    async def create_pool(self, dsn, **kwargs):
+        return StandInPool(self)
+
+    async def connect(self, dsn):
+        return StandInConnection(self)
+
+    def deliver(self, notifications):
+        loop = asyncio.get_running_loop()
+        for pid, channel, payload in notifications:
+            for connection, listened, callback in self.listeners:
+                if listened == channel:
+                    loop.call_soon(callback, connection, pid, channel, payload)
+
+class StandInConnection:
+    def __init__(self, server):
+        self.server = server
+        self.pid = next(server.pids)
+        self.conn = warehouse.get_db_connection()
+        self.conn.isolation_level = None
+        self.savepoints = []
+        self.notifications = []
+
+    def _run(self, sql, args):
+        self.server.statements.append(sql)
+        assert "?" not in sql, sql
+        assert {int(n) for n in re.findall(r"\$(\d+)", sql)} == set(range(1, len(args) + 1)), sql
+        statement = " ".join(sql.split())
+        if statement.startswith(("CREATE ", "ALTER ", "SELECT pg_advisory_xact_lock")):
+            return [], 0
+        if statement.startswith("SELECT to_regclass"):
+            return [(True,)], 1
+        if statement.startswith("SELECT pg_notify"):
+            self.notifications.append((self.pid, *args))
+            if not self.savepoints:
+                self.server.deliver(self.notifications)
+                self.notifications = []
+            return [("",)], 1
+        cursor = self.conn.execute(re.sub(r"\$(\d+)", r"?\1", statement.replace(" FOR UPDATE", "")), args)
+        return cursor.fetchall(), cursor.rowcount
+
+    async def execute(self, sql, *args):
+        rows, rowcount = self._run(sql, args)
+        return f"{sql.split()[0].upper()} {max(rowcount, len(rows), 0)}"
+
+    async def executemany(self, sql, rows):
+        for args in rows:
+            self._run(sql, args)
+
+    async def fetch(self, sql, *args):
+        return self._run(sql, args)[0]
+
+    async def fetchrow(self, sql, *args):
+        rows = self._run(sql, args)[0]
+        return rows[0] if rows else None
+
+    async def fetchval(self, sql, *args):
+        row = await self.fetchrow(sql, *args)
+        return row[0] if row else None
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        name = f"sp{len(self.savepoints)}"
+        self.conn.execute(f"SAVEPOINT {name}")
+        self.savepoints.append(len(self.notifications))
+        try:
+            yield
+        except BaseException:
+            self.conn.execute(f"ROLLBACK TO {name}")
+            del self.notifications[self.savepoints[-1]:]
+            raise
+        finally:
+            self.savepoints.pop()
+            self.conn.execute(f"RELEASE {name}")
+        if not self.savepoints:
+            self.server.deliver(self.notifications)
+            self.notifications = []
+
+    async def add_listener(self, channel, callback):
+        self.server.listeners.append((self, channel, callback))
+
+    async def close(self):
+        self.server.listeners = [entry for entry in self.server.listeners if entry[0] is not self]
+        self.conn.close()
+
+class StandInPool:
+    def __init__(self, server):
+        self.server = server
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        connection = StandInConnection(self.server)
+        try:
+            yield connection
+        finally:
+            await connection.close()
+
+    async def _once(self, method, sql, *args):
+        async with self.acquire() as connection:
+            return await getattr(connection, method)(sql, *args)
+
+    async def execute(self, sql, *args):
+        return await self._once("execute", sql, *args)
+
+    async def fetch(self, sql, *args):
+        return await self._once("fetch", sql, *args)
+
+    async def fetchrow(self, sql, *args):
+        return await self._once("fetchrow", sql, *args)
+
+    async def close(self):
+        pass
+
+async def postgres_replicas_scenario(dsn, changes):
+    """Две реплики над одной базой: фиксация, откат, точка сохранения, блокировка и оповещения"""
+    first = warehouse.PostgresBackend(dsn, min_size=1, max_size=2)
+    second = warehouse.PostgresBackend(dsn, min_size=1, max_size=2)
+    await first.open()
+    await second.open()
+    update = "UPDATE items SET quantity = ? WHERE id = ?"
+    try:
+        async with first.transaction() as tx:
+            category_id = await tx.insert("INSERT INTO categories (name) VALUES (?)", (f"Проверка {uuid.uuid4().hex}",))
+            item_id = await tx.insert(
+                "INSERT INTO items (category_id, name, quantity, comment) VALUES (?, ?, ?, ?)",
+                (category_id, "Стул", 5, ""),
+            )
+        with pytest.raises(RuntimeError):
+            async with first.transaction() as tx:
+                await tx.lock_item(item_id)
+                assert await tx.execute(update, (0, item_id)) == 1
+                raise RuntimeError("откат транзакции")
+        after_rollback = await second.fetchone(warehouse.SQL_ITEM_QUANTITY_NAME, (item_id,))
+        async with first.transaction() as tx:
+            await tx.execute(update, (4, item_id))
+            with pytest.raises(ValueError):
+                async with tx.savepoint():
+                    await tx.execute(update, (0, item_id))
+                    raise ValueError("откат точки сохранения")
+        after_savepoint = await second.fetchone(warehouse.SQL_ITEM_QUANTITY_NAME, (item_id,))
+        await first.notify_change(item_id)
+        await second.notify_change()
+        deadline = time.monotonic() + 5
+        while len(changes) < 2 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        await first.execute("DELETE FROM items WHERE id = ?", (item_id,))
+        await first.execute("DELETE FROM categories WHERE id = ?", (category_id,))
+        return item_id, after_rollback, after_savepoint
+    finally:
+        await first.close()
+        await second.close()
+
+def check_postgres_replicas(monkeypatch, dsn, run_scenario):
+    changes = []
+    recorded = []
+    record_query = warehouse.record_query
+
+    def recording(sql, *args):
+        recorded.append(getattr(sql, "name", None))
+        return record_query(sql, *args)
+
+    monkeypatch.setattr(warehouse, "record_query", recording)
+    monkeypatch.setattr(warehouse, "inventory_changed", lambda item_id, remote=False: changes.append((item_id, remote)))
+    item_id, after_rollback, after_savepoint = run_scenario(postgres_replicas_scenario(dsn, changes))
+    assert after_rollback == (5, "Стул")
+    assert after_savepoint == (4, "Стул")
+    # Свое оповещение реплика пропускает, чужое сбрасывает ее модель
+    assert sorted(changes, key=repr) == sorted([(item_id, True), (None, True)], key=repr)
+    assert "pg_lock_item" in recorded and "pg_notify_change" in recorded
+
+def test_postgres_backend_against_stand_in(storage, monkeypatch):
+    """PostgresBackend на заменителе сервера: $n в каждом запросе, транзакции и LISTEN/NOTIFY между репликами"""
+    asyncpg = pytest.importorskip("asyncpg")
+    server = PostgresStandIn()
+    monkeypatch.setattr(asyncpg, "create_pool", server.create_pool)
+    monkeypatch.setattr(asyncpg, "connect", server.connect)
+    check_postgres_replicas(monkeypatch, "postgresql://stand-in/warehouse", lambda scenario: run(storage, lambda: scenario))
+    assert any(statement.endswith("WHERE id = $1 FOR UPDATE") for statement in server.statements)
+    assert "SELECT pg_notify($1, $2)" in server.statements
+
+def test_postgres_backend_against_server(monkeypatch):
+    """То же на настоящем сервере: WAREHOUSE_TEST_POSTGRES_URL=postgresql://... (база с правом создавать таблицы)"""
+    dsn = os.environ.get("WAREHOUSE_TEST_POSTGRES_URL")
+    if not dsn:
+        pytest.skip("WAREHOUSE_TEST_POSTGRES_URL не задан")
+    pytest.importorskip("asyncpg")
+    check_postgres_replicas(monkeypatch, dsn, asyncio.run)
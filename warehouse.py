@@ -8,26 +8,115 @@ from telegram import (
     ReplyKeyboardMarkup,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
 )
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackContext,
     ConversationHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     filters
 )
-from datetime import datetime, timedelta
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from datetime import date, datetime, timedelta, time as dtime
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
 import calendar
+import numpy as np
+import array
 import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
+import json
+import itertools
+import math
+import queue
+import random
+import re
 import signal
 import sys
+import tempfile
+import time
+import uuid
 
 # Настройки - получаем токен из переменных окружения
 TOKEN = os.environ.get('BOT_TOKEN', '7576912897:AAGdkGgBYLrh1jjIUwvskqh6Ptqk-fcCqPM')
 DB_NAME = "warehouse.db"
 IMAGES_DIR = "images"
+DB_READ_WORKERS = int(os.environ.get('DB_READ_WORKERS', '4'))
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', '512'))
+DB_CACHE_KB = int(os.environ.get('DB_CACHE_KB', '16384'))
+DB_MMAP_BYTES = int(os.environ.get('DB_MMAP_BYTES', str(128 * 1024 * 1024)))
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+PICKER_PAGE_SIZE = int(os.environ.get('PICKER_PAGE_SIZE', '20'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '256'))
+# Из присланных размеров фото сохраняется наименьший с большей стороной не меньше цели
+IMAGE_TARGET_SIDE = int(os.environ.get('IMAGE_TARGET_SIDE', '800'))
+IMAGES_BUDGET_BYTES = int(os.environ.get('IMAGES_BUDGET_MB', '50')) * 1024 * 1024
+INLINE_RESULTS_LIMIT = 20
+INLINE_CACHE_SIZE = int(os.environ.get('INLINE_CACHE_SIZE', '1024'))
+INLINE_CACHE_SECONDS = 10
+TIMELINE_DEFAULT_DAYS = 60
+TIMELINE_MAX_DAYS = 365
+TIMELINE_ITEMS_PER_CATEGORY = 15
+
+# Рассылка: Telegram допускает около 30 сообщений в секунду и 1 в секунду в один чат
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '30'))
+BROADCAST_CHAT_INTERVAL = float(os.environ.get('BROADCAST_CHAT_INTERVAL', '1.0'))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', '8'))
+BROADCAST_RETRIES = 3
+BROADCAST_PROGRESS_SECONDS = 5
+
+# Автоматические напоминания: за сколько дней до окончания брони (-1 - на день позже) и во сколько (UTC)
+REMINDER_OFFSETS = [int(offset) for offset in os.environ.get('REMINDER_OFFSETS', '3,1,-1').split(',')]
+REMINDER_TIME = dtime.fromisoformat(os.environ.get('REMINDER_TIME', '07:00'))
+
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя - всегда по очереди)
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', '16'))
+UPDATE_MAX_PENDING = int(os.environ.get('UPDATE_MAX_PENDING', '1024'))
+
+# Запросы дольше порога пишутся в журнал вместе с параметрами
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+
+# Запись: сколько писатель ждет блокировку SQLite и сколько раз повторяет транзакцию при занятой базе
+DB_WRITE_BUSY_MS = int(os.environ.get('DB_WRITE_BUSY_MS', '2000'))
+WRITE_RETRIES = 4
+WRITE_RETRY_SECONDS = 0.05
+# Групповая фиксация: записи, пришедшие в течение WRITE_BATCH_MS, идут одной транзакцией
+WRITE_BATCH_MS = float(os.environ.get('WRITE_BATCH_MS', '2'))
+WRITE_BATCH_MAX = int(os.environ.get('WRITE_BATCH_MAX', '64'))
+
+# Сколько секунд при остановке ждать завершения начатых обновлений (Render дает 30 с до SIGKILL)
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get('SHUTDOWN_DRAIN_SECONDS', '20'))
+
+# Адрес Bot API (например, локальный сервер или имитация для нагрузочных тестов)
+BOT_API_URL = os.environ.get('BOT_API_URL', 'https://api.telegram.org/bot')
+BOT_API_FILE_URL = os.environ.get('BOT_API_FILE_URL', 'https://api.telegram.org/file/bot')
+
+# Режим получения обновлений: webhook, если известен внешний адрес (на Render - RENDER_EXTERNAL_URL), иначе polling
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or os.environ.get('RENDER_EXTERNAL_URL', '')
+BOT_MODE = os.environ.get('BOT_MODE', 'webhook' if WEBHOOK_URL else 'polling')
+PORT = int(os.environ.get('PORT', '8080'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+# В режиме polling HTTP-сервер (/metrics, /healthz) поднимается, если задан PORT (на Render задан всегда)
+SERVE_HTTP = 'PORT' in os.environ
+
+# DATABASE_URL вида postgresql://... включает PostgreSQL, иначе используется SQLite
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
 
 # Для Render используем абсолютные пути
 if os.environ.get('RENDER'):
@@ -54,20 +143,277 @@ if os.environ.get('RENDER'):
     SEARCH_ITEM,
 ) = range(16)
 
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("/tmp/warehouse_bot.log") if os.environ.get('RENDER') else logging.FileHandler("warehouse_bot.log")
-    ]
-)
 logger = logging.getLogger(__name__)
 
+def setup_logging():
+    """Настройка логирования: вывод в консоль и в файл (только при запуске бота, не при импорте)"""
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
+        level=logging.INFO,
+        handlers=[
+            logging.StreamHandler(sys.stdout),
+            logging.FileHandler("/tmp/warehouse_bot.log") if os.environ.get('RENDER') else logging.FileHandler("warehouse_bot.log")
+        ]
+    )
+
 # Глобальная переменная для управления состоянием бота
 bot_application = None
 
+# Метрики в текстовом формате Prometheus (/metrics)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+class Histogram:
+    """Гистограмма длительностей с одной меткой"""
+
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, label_value, seconds):
+        series = self._series.get(label_value)
+        if series is None:
+            # Счетчики по бакетам (последний - +Inf), сумма и количество
+            series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {count}')
+        return lines
+
+class Counter:
+    """Счетчик с набором меток"""
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = collections.Counter()
+
+    def inc(self, label_values, amount=1):
+        self._values[label_values] += amount
+
+    def total(self):
+        return sum(self._values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            labels = ",".join(f'{label}="{value}"' for label, value in zip(self.labels, label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return lines
+
+class Metrics:
+    """Все метрики бота; значения очередей и диалогов снимаются в момент запроса"""
+
+    def __init__(self):
+        self.handler_seconds = Histogram(
+            "warehouse_handler_seconds", "Длительность обработчиков обновлений", "handler")
+        self.handler_exceptions = Counter(
+            "warehouse_handler_exceptions_total", "Исключения, вышедшие из обработчиков", ("handler",))
+        self.db_seconds = Histogram(
+            "warehouse_db_seconds", "Длительность запросов чтения и транзакций записи", "op")
+        self.db_rows = Counter(
+            "warehouse_db_rows_total", "Прочитанные и измененные строки", ("op",))
+        self.query_seconds = Histogram(
+            "warehouse_query_seconds", "Длительность запросов по именам из реестра", "query")
+        self.write_batch_size = Histogram(
+            "warehouse_write_batch_size", "Записей в одной групповой транзакции", "dialect", BATCH_BUCKETS)
+        self.api_seconds = Histogram(
+            "warehouse_telegram_api_seconds", "Длительность вызовов Bot API", "method")
+        self.api_errors = Counter(
+            "warehouse_telegram_api_errors_total", "Ошибки вызовов Bot API", ("method", "error"))
+
+    def render(self, application=None):
+        lines = []
+        for metric in (self.handler_seconds, self.handler_exceptions, self.db_seconds, self.db_rows,
+                       self.query_seconds, self.write_batch_size, self.api_seconds, self.api_errors):
+            lines += metric.render()
+        if application is not None:
+            for name, help_text, value in self._gauges(application):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _gauges(application):
+        processor = application.update_processor
+        running = waiting = 0
+        if isinstance(processor, PerUserUpdateProcessor):
+            running, waiting = processor.load()
+        conversations = 0
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    conversations += len(getattr(handler, "_conversations", {}))
+        return [
+            ("warehouse_update_queue_depth", "Обновления в очереди приложения", application.update_queue.qsize()),
+            ("warehouse_updates_running", "Обновления в обработке", running),
+            ("warehouse_updates_waiting", "Обновления, ждущие своей очереди", waiting),
+            ("warehouse_active_conversations", "Незавершенные диалоги", conversations),
+            ("warehouse_inventory_generation", "Поколение данных склада", inventory_generation),
+        ]
+
+metrics = Metrics()
+
+def timed_handler(callback):
+    """Обертка обработчика, записывающая его длительность в метрики"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.handler_exceptions.inc((name,))
+            raise
+        finally:
+            metrics.handler_seconds.observe(name, time.perf_counter() - started)
+    return wrapper
+
+def instrument_handlers(handlers, seen=None):
+    """Оборачивает обработчики (включая вложенные в ConversationHandler) для замера длительности"""
+    seen = set() if seen is None else seen
+    for handler in handlers:
+        if id(handler) in seen:
+            continue
+        seen.add(id(handler))
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points, seen)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers, seen)
+            instrument_handlers(handler.fallbacks, seen)
+        else:
+            handler.callback = timed_handler(handler.callback)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, записывающий длительность и ошибки вызовов Bot API"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = "downloadFile" if url.startswith(BOT_API_FILE_URL) else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.api_errors.inc((api_method, type(e).__name__))
+            raise
+        finally:
+            metrics.api_seconds.observe(api_method, time.perf_counter() - started)
+        if code >= 400:
+            metrics.api_errors.inc((api_method, str(code)))
+        return code, payload
+
+# Материализованная занятость: сколько единиц позиции забронировано в каждый день.
+# Первичный ключ (day, item_id) - отчет на дату читает один диапазон индекса.
+ITEM_DAY_USAGE_DDL = """
+    CREATE TABLE IF NOT EXISTS item_day_usage (
+        day TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        reserved INTEGER NOT NULL,
+        PRIMARY KEY (day, item_id)
+    )
+"""
+
+# Слияние дублей (category_id, name) перед созданием уникального индекса: остается позиция
+# с меньшим id, количество суммируется, брони и занятость по дням переносятся на нее.
+# Запросы без параметров и одинаково выполняются в SQLite и PostgreSQL.
+ITEM_DEDUP_SQL = [
+    """
+    CREATE TEMP TABLE item_duplicates AS
+    SELECT i.id AS id, k.keep_id AS keep_id
+    FROM items i
+    JOIN (
+        SELECT category_id, name, MIN(id) AS keep_id
+        FROM items
+        GROUP BY category_id, name
+        HAVING COUNT(*) > 1
+    ) k ON i.category_id = k.category_id AND i.name = k.name
+    WHERE i.id <> k.keep_id
+    """,
+    """
+    UPDATE items SET
+        quantity = COALESCE(quantity, 0) + (
+            SELECT COALESCE(SUM(d.quantity), 0) FROM items d
+            JOIN item_duplicates m ON m.id = d.id WHERE m.keep_id = items.id
+        ),
+        image_hash = COALESCE(image_hash, (
+            SELECT MIN(d.image_hash) FROM items d
+            JOIN item_duplicates m ON m.id = d.id WHERE m.keep_id = items.id
+        )),
+        comment = COALESCE(comment, (
+            SELECT MIN(d.comment) FROM items d
+            JOIN item_duplicates m ON m.id = d.id WHERE m.keep_id = items.id
+        ))
+    WHERE id IN (SELECT keep_id FROM item_duplicates)
+    """,
+    """
+    UPDATE reservations
+    SET item_id = (SELECT keep_id FROM item_duplicates WHERE id = reservations.item_id)
+    WHERE item_id IN (SELECT id FROM item_duplicates)
+    """,
+    """
+    INSERT INTO item_day_usage (day, item_id, reserved)
+    SELECT u.day, m.keep_id, SUM(u.reserved)
+    FROM item_day_usage u
+    JOIN item_duplicates m ON m.id = u.item_id
+    WHERE true
+    GROUP BY u.day, m.keep_id
+    ON CONFLICT (day, item_id) DO UPDATE SET reserved = item_day_usage.reserved + excluded.reserved
+    """,
+    "DELETE FROM item_day_usage WHERE item_id IN (SELECT id FROM item_duplicates)",
+    "DELETE FROM items WHERE id IN (SELECT id FROM item_duplicates)",
+    "DROP TABLE item_duplicates",
+    "DROP INDEX IF EXISTS idx_items_category_name",
+    "CREATE UNIQUE INDEX idx_items_category_name_unique ON items(category_id, name)",
+]
+
+# Фотографии позиций: файл адресуется хэшем содержимого, file_id Telegram
+# позволяет отправлять фото без повторной загрузки
+IMAGES_DDL = """
+    CREATE TABLE IF NOT EXISTS images (
+        hash TEXT PRIMARY KEY,
+        file_id TEXT,
+        file_unique_id TEXT,
+        path TEXT,
+        size INTEGER,
+        last_used_at INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# Журнал отправленных напоминаний: одно напоминание на бронь и смещение
+REMINDER_LOG_DDL = """
+    CREATE TABLE IF NOT EXISTS reminder_log (
+        reservation_id INTEGER NOT NULL,
+        offset_days INTEGER NOT NULL,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (reservation_id, offset_days)
+    )
+"""
+
+# Стандартные категории
+DEFAULT_CATEGORIES = [
+    'Ткань (и изделия из ткани)',
+    'Стекло', 
+    'Искусственные цветы и зелень',
+    'Крупные конструкции',
+    'Сезонное',
+    'Фурнитура',
+    'Деревянные изделия'
+]
+
 def init_db():
     """Инициализация базы данных с обработкой ошибок"""
     max_retries = 3
@@ -78,6 +424,9 @@ def init_db():
             conn = sqlite3.connect(DB_NAME, timeout=30)
             cur = conn.cursor()
             
+            # WAL сохраняется в файле БД: читатели не блокируются писателем
+            cur.execute("PRAGMA journal_mode = WAL")
+            
             # Таблица категорий
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS categories (
@@ -94,6 +443,7 @@ def init_db():
                     name TEXT,
                     quantity INTEGER,
                     image_path TEXT,
+                    image_hash TEXT,
                     comment TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -124,19 +474,14 @@ def init_db():
             cur.execute("CREATE INDEX IF NOT EXISTS idx_reservations_item ON reservations(item_id)")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_reservations_dates ON reservations(start_date, end_date)")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations(user_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_reservations_item_end ON reservations(item_id, end_date)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_reservations_end ON reservations(end_date)")
             
-            # Стандартные категории
-            default_categories = [
-                'Ткань (и изделия из ткани)',
-                'Стекло', 
-                'Искусственные цветы и зелень',
-                'Крупные конструкции',
-                'Сезонное',
-                'Фурнитура',
-                'Деревянные изделия'
-            ]
+            cur.execute(IMAGES_DDL)
+            cur.execute(REMINDER_LOG_DDL)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_images_file_unique ON images(file_unique_id)")
             
-            for category in default_categories:
+            for category in DEFAULT_CATEGORIES:
                 cur.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (category,))
             
             conn.commit()
@@ -153,6 +498,20 @@ def init_db():
                 logger.error("Не удалось инициализировать базу данных после нескольких попыток")
                 return False
 
+def reservation_days(start, end):
+    """Все дни брони [start, end] в формате YYYY-MM-DD"""
+    first = date.fromisoformat(start)
+    last = date.fromisoformat(end)
+    return [(first + timedelta(days=n)).isoformat() for n in range((last - first).days + 1)]
+
+def day_usage_rows(reservations, today):
+    """Строки item_day_usage (item_id, day, reserved) по списку броней (item_id, start, end, quantity)"""
+    usage = collections.Counter()
+    for item_id, start, end, quantity in reservations:
+        for day in reservation_days(max(start, today), end):
+            usage[(item_id, day)] += quantity
+    return [(item_id, day, reserved) for (item_id, day), reserved in usage.items() if reserved > 0]
+
 def migrate_database():
     """Миграция базы данных для добавления новых колонок"""
     try:
@@ -188,6 +547,45 @@ def migrate_database():
             cur.execute("ALTER TABLE items ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
             logger.info("Добавлена колонка updated_at в items")
         
+        if 'image_hash' not in item_columns:
+            cur.execute("ALTER TABLE items ADD COLUMN image_hash TEXT")
+            logger.info("Добавлена колонка image_hash в items")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_items_image_hash ON items(image_hash)")
+        
+        cur.execute("PRAGMA table_info(images)")
+        if 'last_used_at' not in [column[1] for column in cur.fetchall()]:
+            cur.execute("ALTER TABLE images ADD COLUMN last_used_at INTEGER DEFAULT 0")
+            logger.info("Добавлена колонка last_used_at в images")
+        
+        # Занятость позиций по дням для отчета "Остатки на дату"
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'item_day_usage'")
+        usage_exists = cur.fetchone() is not None
+        cur.execute(ITEM_DAY_USAGE_DDL)
+        # Проверка брони читает дни одной позиции
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_day_usage_item ON item_day_usage(item_id, day)")
+        today = datetime.now().date().isoformat()
+        if not usage_exists:
+            cur.execute("SELECT item_id, start_date, end_date, quantity FROM reservations WHERE end_date >= ?", (today,))
+            cur.executemany(
+                "INSERT INTO item_day_usage (day, item_id, reserved) VALUES (?, ?, ?)",
+                [(day, item_id, reserved) for item_id, day, reserved in day_usage_rows(cur.fetchall(), today)],
+            )
+            logger.info("Создана и заполнена таблица item_day_usage")
+        cur.execute("DELETE FROM item_day_usage WHERE day < ?", (today,))
+        
+        # Одна позиция на (категорию, название): пополнение склада идет через upsert
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'idx_items_category_name_unique'")
+        if cur.fetchone() is None:
+            cur.execute("SELECT COUNT(*) - COUNT(DISTINCT category_id || ':' || name) FROM items")
+            duplicates = cur.fetchone()[0]
+            for statement in ITEM_DEDUP_SQL:
+                cur.execute(statement)
+            # Без статистики по новому индексу планировщик уходит в полный перебор категорий
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cur.fetchone() is not None:
+                cur.execute("ANALYZE idx_items_category_name_unique")
+            logger.info(f"Создан уникальный индекс позиций, объединено дублей: {duplicates}")
+        
         conn.commit()
         logger.info("Миграция базы данных завершена успешно")
         return True
@@ -199,16 +597,1621 @@ def migrate_database():
         if 'conn' in locals():
             conn.close()
 
+def sql_casefold(value):
+    return value.casefold() if isinstance(value, str) else value
+
+def create_search_index():
+    """Создание триграммного индекса FTS5 по названию, комментарию и категории позиций"""
+    try:
+        conn = sqlite3.connect(DB_NAME, timeout=30)
+        cur = conn.cursor()
+        
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'items_fts'")
+        index_exists = cur.fetchone() is not None
+        
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS items_fts
+            USING fts5(name, comment, category, tokenize = 'trigram')
+        """)
+        
+        # Триггеры поддерживают индекс синхронным с таблицей items
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+                INSERT INTO items_fts (rowid, name, comment, category)
+                VALUES (new.id, new.name, new.comment, (SELECT name FROM categories WHERE id = new.category_id));
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+                DELETE FROM items_fts WHERE rowid = old.id;
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name, comment, category_id ON items BEGIN
+                DELETE FROM items_fts WHERE rowid = old.id;
+                INSERT INTO items_fts (rowid, name, comment, category)
+                VALUES (new.id, new.name, new.comment, (SELECT name FROM categories WHERE id = new.category_id));
+            END
+        """)
+        
+        if not index_exists:
+            cur.execute("""
+                INSERT INTO items_fts (rowid, name, comment, category)
+                SELECT i.id, i.name, i.comment, c.name
+                FROM items i
+                LEFT JOIN categories c ON i.category_id = c.id
+            """)
+            logger.info("Создан полнотекстовый индекс items_fts")
+        
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Полнотекстовый поиск недоступен, используется LIKE: {e}")
+        return False
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
 def get_db_connection():
     """Создание соединения с базой данных с обработкой ошибок"""
     try:
-        conn = sqlite3.connect(DB_NAME, timeout=30)
+        conn = sqlite3.connect(
+            DB_NAME,
+            timeout=30,
+            check_same_thread=False,  # соединения из пула переходят между потоками пула
+            cached_statements=DB_STATEMENT_CACHE,
+        )
         conn.execute("PRAGMA busy_timeout = 30000")  # 30 секунд timeout
+        conn.execute("PRAGMA synchronous = NORMAL")  # в режиме WAL безопасно и без fsync на каждый commit
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # LIKE в SQLite не учитывает регистр только для ASCII - для кириллицы нужен casefold
+        conn.create_function("casefold", 1, sql_casefold, deterministic=True)
         return conn
     except sqlite3.Error as e:
         logger.error(f"Ошибка подключения к БД: {e}")
         raise
 
+# Реестр именованных запросов: имя попадает в журнал медленных запросов и метрики,
+# а `python warehouse.py --check-queries` проверяет план каждого запроса
+QUERIES = {}
+
+class NamedQuery(str):
+    """Текст SQL-запроса с именем из реестра"""
+
+    name = None
+    allow_scan = False
+    dialect = None
+
+def named_query(name, sql, allow_scan=False, dialect=None):
+    """Регистрирует запрос; allow_scan - полный просмотр таблицы ожидаем (списки целиком),
+    dialect - запрос только для одного хранилища (None - для обоих)"""
+    query = NamedQuery(sql)
+    query.name = name
+    query.allow_scan = allow_scan
+    query.dialect = dialect
+    if name in QUERIES and QUERIES[name] != query:
+        raise ValueError(f"Запрос {name} уже зарегистрирован с другим текстом")
+    QUERIES[name] = query
+    return query
+
+def with_placeholders(query, count):
+    """Запрос со списком IN ({placeholders}) из count параметров под тем же именем"""
+    expanded = NamedQuery(query.replace("{placeholders}", ", ".join("?" * count)))
+    expanded.name = query.name
+    expanded.allow_scan = query.allow_scan
+    expanded.dialect = query.dialect
+    return expanded
+
+def record_query(sql, params, started, op, rows):
+    """Учитывает выполненный запрос в метриках и журнале медленных запросов; возвращает длительность"""
+    elapsed = time.perf_counter() - started
+    name = getattr(sql, "name", None)
+    metrics.query_seconds.observe(name or "unnamed", elapsed)
+    metrics.db_rows.inc((op,), rows)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        query = name or " ".join(sql.split())[:120]
+        logger.warning(f"Медленный запрос {query}: {elapsed * 1000:.0f} мс, строк {rows}, параметры {repr(params)[:200]}")
+    return elapsed
+
+class StorageBackend:
+    """Базовый класс хранилища.
+
+    Запросы пишутся в диалекте SQLite с плейсхолдерами '?'; реализации сами
+    приводят их к своему драйверу. Строки возвращаются кортежами.
+    """
+
+    dialect = None
+    fts_enabled = False
+
+    async def open(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def fetchone(self, sql, params=()):
+        raise NotImplementedError
+
+    async def fetchall(self, sql, params=()):
+        raise NotImplementedError
+
+    def transaction(self):
+        """Асинхронный контекстный менеджер транзакции записи"""
+        raise NotImplementedError
+
+    async def notify_change(self, item_id=None):
+        """Оповещает другие процессы об изменении склада (для одного процесса - ничего)"""
+
+    def is_busy_error(self, error):
+        """Ошибка временной занятости базы, после которой транзакцию можно повторить"""
+        return False
+
+    async def execute(self, sql, params=()):
+        async with self.transaction() as tx:
+            return await tx.execute(sql, params)
+
+    async def insert(self, sql, params=()):
+        async with self.transaction() as tx:
+            return await tx.insert(sql, params)
+
+class SQLiteTransaction:
+    """Транзакция на соединении потока записи"""
+
+    def __init__(self, backend, conn):
+        self._backend = backend
+        self._conn = conn
+
+    async def fetchone(self, sql, params=()):
+        started = time.perf_counter()
+        row = await self._backend._run_writer(lambda: self._conn.execute(sql, params).fetchone())
+        record_query(sql, params, started, "read", 0 if row is None else 1)
+        return row
+
+    async def fetchall(self, sql, params=()):
+        started = time.perf_counter()
+        rows = await self._backend._run_writer(lambda: self._conn.execute(sql, params).fetchall())
+        record_query(sql, params, started, "read", len(rows))
+        return rows
+
+    async def execute(self, sql, params=()):
+        """Выполняет запрос и возвращает количество затронутых строк"""
+        started = time.perf_counter()
+        rowcount = await self._backend._run_writer(lambda: self._conn.execute(sql, params).rowcount)
+        record_query(sql, params, started, "write", max(rowcount, 0))
+        return rowcount
+
+    async def insert(self, sql, params=()):
+        """Выполняет INSERT и возвращает id новой строки"""
+        started = time.perf_counter()
+        row_id = await self._backend._run_writer(lambda: self._conn.execute(sql, params).lastrowid)
+        record_query(sql, params, started, "write", 1)
+        return row_id
+
+    async def executemany(self, sql, rows):
+        started = time.perf_counter()
+        await self._backend._run_writer(lambda: self._conn.executemany(sql, rows))
+        record_query(sql, rows, started, "write", len(rows))
+
+    async def lock_item(self, item_id):
+        """Блокирует позицию до конца транзакции (после BEGIN IMMEDIATE база и так занята ею)"""
+
+    @contextlib.asynccontextmanager
+    async def savepoint(self):
+        """Вложенная транзакция: при ошибке откатываются только ее изменения"""
+        await self._backend._run_writer(lambda: self._conn.execute("SAVEPOINT write_request"))
+        try:
+            yield self
+        except BaseException:
+            await self._backend._run_writer(lambda: self._conn.execute("ROLLBACK TO write_request"))
+            raise
+        finally:
+            await self._backend._run_writer(lambda: self._conn.execute("RELEASE write_request"))
+
+class SQLiteBackend(StorageBackend):
+    """Хранилище на SQLite.
+
+    Все запросы выполняются вне event loop: записи - в единственном потоке записи,
+    чтения - в пуле потоков. Медленный отчет или заблокированная запись не
+    останавливают получение обновлений и диалоги других пользователей.
+
+    Соединения открываются один раз в open() и живут до close(): одно соединение
+    записи и по одному соединению чтения на поток. В режиме WAL читатели
+    работают параллельно с единственным писателем.
+    """
+
+    dialect = "sqlite"
+
+    def __init__(self, read_workers=DB_READ_WORKERS):
+        self._read_workers = read_workers
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-reader")
+        self._write_lock = None
+        self._writer_conn = None
+        self._reader_conns = queue.SimpleQueue()
+
+    async def open(self):
+        """Инициализирует схему и открывает пул соединений (один раз при старте)"""
+        if self._writer_conn is not None:
+            return
+        if not await asyncio.to_thread(init_db):
+            raise RuntimeError("Не удалось инициализировать базу данных")
+        await asyncio.to_thread(migrate_database)
+        self.fts_enabled = await asyncio.to_thread(create_search_index)
+        await asyncio.to_thread(self._open_pool)
+
+    def _open_pool(self):
+        self._writer_conn = get_db_connection()
+        # Писатель не ждет чужую блокировку 30 секунд: занятая база - короткие повторы (with_write_retries)
+        self._writer_conn.execute(f"PRAGMA busy_timeout = {DB_WRITE_BUSY_MS}")
+        for _ in range(self._read_workers):
+            conn = get_db_connection()
+            conn.execute("PRAGMA query_only = ON")
+            self._reader_conns.put(conn)
+        logger.info(f"Пул соединений SQLite открыт: 1 запись, {self._read_workers} чтение")
+
+    def is_busy_error(self, error):
+        return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+    async def _run_writer(self, func):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, func)
+
+    async def _run_reader(self, func):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, func)
+
+    def _read(self, sql, params, one):
+        conn = self._reader_conns.get()
+        try:
+            cur = conn.execute(sql, params)
+            return cur.fetchone() if one else cur.fetchall()
+        finally:
+            self._reader_conns.put(conn)
+
+    async def fetchone(self, sql, params=()):
+        started = time.perf_counter()
+        row = await self._run_reader(lambda: self._read(sql, params, True))
+        metrics.db_seconds.observe("read", record_query(sql, params, started, "read", 0 if row is None else 1))
+        return row
+
+    async def fetchall(self, sql, params=()):
+        started = time.perf_counter()
+        rows = await self._run_reader(lambda: self._read(sql, params, False))
+        metrics.db_seconds.observe("read", record_query(sql, params, started, "read", len(rows)))
+        return rows
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Открывает транзакцию записи; записи выполняются строго по одной"""
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        started = time.perf_counter()
+        async with self._write_lock:
+            conn = self._writer_conn
+            try:
+                # Блокировка записи берется сразу: чтения внутри транзакции видят то, поверх чего пишут
+                await self._run_writer(lambda: conn.execute("BEGIN IMMEDIATE"))
+                yield SQLiteTransaction(self, conn)
+                await self._run_writer(conn.commit)
+            except BaseException:
+                await self._run_writer(conn.rollback)
+                raise
+            finally:
+                metrics.db_seconds.observe("transaction", time.perf_counter() - started)
+
+    async def close(self):
+        await asyncio.to_thread(self._close_pool)
+
+    def _close_pool(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        if self._writer_conn is not None:
+            # Переносит WAL в основной файл БД: после остановки файл базы самодостаточен
+            try:
+                self._writer_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при сбросе WAL: {e}")
+            self._writer_conn.close()
+            self._writer_conn = None
+        while not self._reader_conns.empty():
+            self._reader_conns.get().close()
+
+@functools.lru_cache(maxsize=512)
+def to_postgres_sql(sql):
+    """Переводит плейсхолдеры '?' в нумерованные '$1, $2, ...' для asyncpg"""
+    counter = itertools.count(1)
+    return re.sub(r"\?", lambda _: f"${next(counter)}", sql)
+
+def _rowcount(status):
+    """Количество строк из статуса команды PostgreSQL ('DELETE 3' -> 3)"""
+    try:
+        return int(status.rsplit(" ", 1)[-1])
+    except (ValueError, AttributeError):
+        return 0
+
+# Запросы только для PostgreSQL: в SQLite позицию блокирует BEGIN IMMEDIATE,
+# а оповещать некого - процесс один
+SQL_PG_LOCK_ITEM = named_query("pg_lock_item", "SELECT id FROM items WHERE id = ? FOR UPDATE", dialect="postgres")
+SQL_PG_NOTIFY_CHANGE = named_query("pg_notify_change", "SELECT pg_notify(?, ?)", dialect="postgres")
+
+class PostgresTransaction:
+    """Транзакция на соединении из пула asyncpg"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def fetchone(self, sql, params=()):
+        started = time.perf_counter()
+        row = await self._conn.fetchrow(to_postgres_sql(sql), *params)
+        record_query(sql, params, started, "read", 0 if row is None else 1)
+        return tuple(row) if row is not None else None
+
+    async def fetchall(self, sql, params=()):
+        started = time.perf_counter()
+        rows = await self._conn.fetch(to_postgres_sql(sql), *params)
+        record_query(sql, params, started, "read", len(rows))
+        return [tuple(row) for row in rows]
+
+    async def execute(self, sql, params=()):
+        """Выполняет запрос и возвращает количество затронутых строк"""
+        started = time.perf_counter()
+        rowcount = _rowcount(await self._conn.execute(to_postgres_sql(sql), *params))
+        record_query(sql, params, started, "write", rowcount)
+        return rowcount
+
+    async def insert(self, sql, params=()):
+        """Выполняет INSERT и возвращает id новой строки"""
+        started = time.perf_counter()
+        row_id = await self._conn.fetchval(to_postgres_sql(sql) + " RETURNING id", *params)
+        record_query(sql, params, started, "write", 1)
+        return row_id
+
+    async def executemany(self, sql, rows):
+        started = time.perf_counter()
+        await self._conn.executemany(to_postgres_sql(sql), rows)
+        record_query(sql, rows, started, "write", len(rows))
+
+    async def lock_item(self, item_id):
+        """Блокирует строку позиции до конца транзакции: брони одной позиции с разных реплик идут по очереди"""
+        await self.fetchone(SQL_PG_LOCK_ITEM, (item_id,))
+
+    @contextlib.asynccontextmanager
+    async def savepoint(self):
+        """Вложенная транзакция: при ошибке откатываются только ее изменения"""
+        async with self._conn.transaction():
+            yield self
+
+POSTGRES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS categories (
+        id SERIAL PRIMARY KEY,
+        name TEXT UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS items (
+        id SERIAL PRIMARY KEY,
+        category_id INTEGER REFERENCES categories (id),
+        name TEXT,
+        quantity INTEGER,
+        image_path TEXT,
+        image_hash TEXT,
+        comment TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reservations (
+        id SERIAL PRIMARY KEY,
+        item_id INTEGER REFERENCES items (id),
+        quantity INTEGER,
+        start_date TEXT,
+        end_date TEXT,
+        user_id BIGINT,
+        username TEXT,
+        first_name TEXT,
+        event_name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_items_category ON items(category_id)",
+    "CREATE INDEX IF NOT EXISTS idx_items_name ON items(name)",
+    "CREATE INDEX IF NOT EXISTS idx_reservations_item ON reservations(item_id)",
+    "CREATE INDEX IF NOT EXISTS idx_reservations_dates ON reservations(start_date, end_date)",
+    "CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_reservations_item_end ON reservations(item_id, end_date)",
+    "CREATE INDEX IF NOT EXISTS idx_reservations_end ON reservations(end_date)",
+    ITEM_DAY_USAGE_DDL,
+    "CREATE INDEX IF NOT EXISTS idx_day_usage_item ON item_day_usage(item_id, day)",
+    IMAGES_DDL,
+    REMINDER_LOG_DDL,
+    "CREATE INDEX IF NOT EXISTS idx_images_file_unique ON images(file_unique_id)",
+    "ALTER TABLE items ADD COLUMN IF NOT EXISTS image_hash TEXT",
+    "ALTER TABLE images ADD COLUMN IF NOT EXISTS last_used_at INTEGER DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS idx_items_image_hash ON items(image_hash)",
+    # Тот же casefold, что регистрируется в SQLite, чтобы запросы поиска были общими
+    "CREATE OR REPLACE FUNCTION casefold(value TEXT) RETURNS TEXT AS $$ SELECT lower(value) $$ LANGUAGE SQL IMMUTABLE",
+]
+
+class PostgresBackend(StorageBackend):
+    """Хранилище на PostgreSQL с пулом асинхронных соединений asyncpg.
+
+    Позволяет запускать несколько реплик бота над одной общей базой. Реплики
+    сообщают друг другу о записях через LISTEN/NOTIFY, чтобы сбрасывать
+    локальные кэши.
+    """
+
+    dialect = "postgres"
+    CHANGES_CHANNEL = "warehouse_changes"
+
+    def __init__(self, dsn, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX):
+        self._dsn = dsn
+        self._min_size = min_size
+        self._max_size = max_size
+        self._pool = None
+        self._listener = None
+        self._instance_id = uuid.uuid4().hex
+
+    async def open(self):
+        """Открывает пул соединений и создает схему (один раз при старте)"""
+        if self._pool is not None:
+            return
+        import asyncpg
+
+        self._pool = await asyncpg.create_pool(
+            self._dsn,
+            min_size=self._min_size,
+            max_size=self._max_size,
+            command_timeout=30,
+        )
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                # Реплики стартуют одновременно - DDL выполняется под advisory lock
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('warehouse_schema'))")
+                usage_exists = await conn.fetchval("SELECT to_regclass('item_day_usage') IS NOT NULL")
+                unique_exists = await conn.fetchval("SELECT to_regclass('idx_items_category_name_unique') IS NOT NULL")
+                for statement in POSTGRES_SCHEMA:
+                    await conn.execute(statement)
+                if not unique_exists:
+                    for statement in ITEM_DEDUP_SQL:
+                        await conn.execute(statement)
+                await conn.executemany(
+                    "INSERT INTO categories (name) VALUES ($1) ON CONFLICT DO NOTHING",
+                    [(category,) for category in DEFAULT_CATEGORIES],
+                )
+                today = today_iso()
+                if not usage_exists:
+                    reservations = await conn.fetch(
+                        "SELECT item_id, start_date, end_date, quantity FROM reservations WHERE end_date >= $1",
+                        today,
+                    )
+                    await conn.executemany(
+                        "INSERT INTO item_day_usage (day, item_id, reserved) VALUES ($1, $2, $3)",
+                        [(day, item_id, reserved) for item_id, day, reserved in day_usage_rows(reservations, today)],
+                    )
+                await conn.execute("DELETE FROM item_day_usage WHERE day < $1", today)
+        self._listener = await asyncpg.connect(self._dsn)
+        await self._listener.add_listener(self.CHANGES_CHANNEL, self._on_change)
+        logger.info(f"Пул соединений PostgreSQL открыт: {self._min_size}-{self._max_size}")
+
+    def _on_change(self, connection, pid, channel, payload):
+        instance_id, _, item_id = payload.partition(":")
+        if instance_id != self._instance_id:
+            inventory_changed(int(item_id) if item_id else None, remote=True)
+
+    def is_busy_error(self, error):
+        import asyncpg
+
+        return isinstance(error, (
+            asyncpg.exceptions.SerializationError,
+            asyncpg.exceptions.DeadlockDetectedError,
+            asyncpg.exceptions.LockNotAvailableError,
+        ))
+
+    async def notify_change(self, item_id=None):
+        payload = f"{self._instance_id}:{item_id if item_id is not None else ''}"
+        params = (self.CHANGES_CHANNEL, payload)
+        started = time.perf_counter()
+        await self._pool.execute(to_postgres_sql(SQL_PG_NOTIFY_CHANGE), *params)
+        record_query(SQL_PG_NOTIFY_CHANGE, params, started, "write", 0)
+
+    async def fetchone(self, sql, params=()):
+        started = time.perf_counter()
+        row = await self._pool.fetchrow(to_postgres_sql(sql), *params)
+        metrics.db_seconds.observe("read", record_query(sql, params, started, "read", 0 if row is None else 1))
+        return tuple(row) if row is not None else None
+
+    async def fetchall(self, sql, params=()):
+        started = time.perf_counter()
+        rows = await self._pool.fetch(to_postgres_sql(sql), *params)
+        metrics.db_seconds.observe("read", record_query(sql, params, started, "read", len(rows)))
+        return [tuple(row) for row in rows]
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        started = time.perf_counter()
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    yield PostgresTransaction(conn)
+        finally:
+            metrics.db_seconds.observe("transaction", time.perf_counter() - started)
+
+    async def close(self):
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+def create_backend(database_url=DATABASE_URL):
+    """Выбирает хранилище по DATABASE_URL (по умолчанию - локальный файл SQLite)"""
+    if database_url and database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresBackend(database_url)
+    return SQLiteBackend()
+
+db = create_backend()
+
+# Запросы обработчиков и фоновых задач. Схема и миграции (init_db, POSTGRES_SCHEMA)
+# выполняются один раз при старте и в реестр не входят
+SQL_IMAGE_BY_UNIQUE_ID = named_query("image_by_unique_id", "SELECT hash FROM images WHERE file_unique_id = ?")
+SQL_IMAGE_INSERT = named_query(
+    "image_insert",
+    "INSERT INTO images (hash, file_id, file_unique_id, path, size, last_used_at) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (hash) DO NOTHING",
+)
+SQL_IMAGE_TOUCH = named_query("image_touch", "UPDATE images SET last_used_at = ? WHERE hash = ?")
+SQL_IMAGE_FILE = named_query("image_file", "SELECT file_id, path FROM images WHERE hash = ?")
+SQL_IMAGE_RESTORE_COPY = named_query("image_restore_copy", "UPDATE images SET path = ?, size = ?, last_used_at = ? WHERE hash = ?")
+SQL_IMAGES_LOCAL_SIZE = named_query("images_local_size", "SELECT COALESCE(SUM(size), 0) FROM images WHERE path IS NOT NULL")
+SQL_IMAGES_EVICTION_CANDIDATES = named_query(
+    "images_eviction_candidates",
+    "SELECT hash, path, size FROM images WHERE path IS NOT NULL AND file_id IS NOT NULL "
+    "ORDER BY last_used_at",
+)
+SQL_IMAGE_EVICT = named_query("image_evict", "UPDATE images SET path = NULL WHERE hash = ?")
+SQL_IMAGE_FILE_ID = named_query("image_file_id", "SELECT file_id FROM images WHERE hash = ?")
+SQL_IMAGE_SET_FILE_ID = named_query("image_set_file_id", "UPDATE images SET file_id = ?, file_unique_id = ? WHERE hash = ?")
+SQL_IMAGE_PATH = named_query("image_path", "SELECT path FROM images WHERE hash = ?")
+SQL_IMAGE_RELEASE = named_query("image_release", "DELETE FROM images WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM items WHERE image_hash = ?)")
+SQL_ITEMS_LEGACY_IMAGES = named_query("items_legacy_images", "SELECT DISTINCT image_path FROM items WHERE image_hash IS NULL AND image_path IS NOT NULL", allow_scan=True)
+SQL_IMAGE_ADOPT = named_query(
+    "image_adopt",
+    "INSERT INTO images (hash, path, size, last_used_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (hash) DO NOTHING",
+)
+SQL_ITEMS_ADOPT_IMAGE = named_query("items_adopt_image", "UPDATE items SET image_hash = ?, image_path = NULL WHERE image_path = ?", allow_scan=True)
+SQL_RESERVATION_DEADLINES = named_query("reservation_deadlines", "SELECT id, end_date FROM reservations WHERE end_date >= ?")
+SQL_ITEM_RESERVATION_DEADLINES = named_query("item_reservation_deadlines", "SELECT id, end_date FROM reservations WHERE item_id = ? AND end_date >= ?")
+SQL_CATEGORIES_ALL = named_query("categories_all", "SELECT id, name FROM categories")
+SQL_INVENTORY_ITEMS = named_query("inventory_items", "SELECT id, category_id, name, quantity, comment FROM items", allow_scan=True)
+SQL_INVENTORY_ITEM = named_query("inventory_item", "SELECT id, category_id, name, quantity, comment FROM items WHERE id = ?")
+SQL_DAY_USAGE_ADD = named_query("day_usage_add", """
+    INSERT INTO item_day_usage (day, item_id, reserved) VALUES (?, ?, ?)
+    ON CONFLICT (day, item_id) DO UPDATE SET reserved = item_day_usage.reserved + excluded.reserved
+""")
+SQL_DAY_USAGE_CLEANUP = named_query("day_usage_cleanup", "DELETE FROM item_day_usage WHERE day BETWEEN ? AND ? AND item_id = ? AND reserved <= 0")
+# Пополнение склада одним запросом: новая позиция создается, у существующей растет количество
+SQL_ITEM_ADD_STOCK = named_query("item_add_stock", """
+    INSERT INTO items (category_id, name, quantity, image_hash, comment) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (category_id, name) DO UPDATE SET
+        quantity = items.quantity + excluded.quantity,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING id, quantity, comment
+""")
+SQL_ITEM_RESERVE_CARD = named_query("item_reserve_card", """
+    SELECT i.name, c.name, i.quantity
+    FROM items i
+    JOIN categories c ON i.category_id = c.id
+    WHERE i.id = ?
+""")
+SQL_ITEM_QUANTITY_NAME = named_query("item_quantity_name", "SELECT quantity, name FROM items WHERE id = ?")
+SQL_BOOKING_CHECK = named_query("booking_check", """
+    SELECT i.quantity, i.name, COALESCE(MAX(u.reserved), 0)
+    FROM items i
+    LEFT JOIN item_day_usage u ON u.item_id = i.id AND u.day BETWEEN ? AND ?
+    WHERE i.id = ?
+    GROUP BY i.id, i.quantity, i.name
+""")
+SQL_RESERVATION_INSERT = named_query("reservation_insert", "INSERT INTO reservations (item_id, quantity, start_date, end_date, user_id, username, first_name, event_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+SQL_RESERVATION_FOR_RETURN = named_query("reservation_for_return", """
+    SELECT i.name, r.username, r.event_name, r.item_id, r.start_date, r.end_date, r.quantity
+    FROM reservations r
+    JOIN items i ON r.item_id = i.id
+    WHERE r.id = ?
+""")
+SQL_RESERVATION_DELETE = named_query("reservation_delete", "DELETE FROM reservations WHERE id = ?")
+SQL_REMINDER_LOG_DELETE = named_query("reminder_log_delete", "DELETE FROM reminder_log WHERE reservation_id = ?")
+SQL_ITEM_NAME_IMAGE = named_query("item_name_image", "SELECT name, image_hash FROM items WHERE id = ?")
+SQL_REMINDER_LOG_DELETE_ITEM = named_query("reminder_log_delete_item", "DELETE FROM reminder_log WHERE reservation_id IN (SELECT id FROM reservations WHERE item_id = ?)")
+SQL_RESERVATIONS_DELETE_ITEM = named_query("reservations_delete_item", "DELETE FROM reservations WHERE item_id = ?")
+SQL_DAY_USAGE_DELETE_ITEM = named_query("day_usage_delete_item", "DELETE FROM item_day_usage WHERE item_id = ?")
+SQL_ITEM_DELETE = named_query("item_delete", "DELETE FROM items WHERE id = ?")
+SQL_STOCK_ON_DATE = named_query("stock_on_date", """
+    SELECT
+        c.name,
+        i.name,
+        i.quantity - COALESCE(u.reserved, 0) as available
+    FROM items i
+    JOIN categories c ON i.category_id = c.id
+    LEFT JOIN item_day_usage u ON u.day = ? AND u.item_id = i.id
+    ORDER BY c.name, i.name
+""", allow_scan=True)
+SQL_TIMELINE_ITEMS = named_query("timeline_items", """
+    SELECT i.id, c.name, i.name, i.quantity
+    FROM items i
+    JOIN categories c ON i.category_id = c.id
+    ORDER BY c.name, i.name
+""", allow_scan=True)
+SQL_TIMELINE_RESERVATIONS = named_query("timeline_reservations", "SELECT item_id, start_date, end_date, quantity FROM reservations WHERE end_date >= ? AND start_date <= ?")
+SQL_ITEM_CARD = named_query("item_card", """
+    SELECT i.name, c.name, i.quantity, i.comment, i.image_hash
+    FROM items i
+    JOIN categories c ON i.category_id = c.id
+    WHERE i.id = ?
+""")
+SQL_ITEM_CARD_RESERVATIONS = named_query("item_card_reservations", """
+    SELECT start_date, end_date, quantity, username, event_name
+    FROM reservations
+    WHERE item_id = ? AND end_date >= ?
+    ORDER BY start_date
+""")
+SQL_USER_RESERVATIONS = named_query("user_reservations", """
+    SELECT r.id, i.name, c.name, r.quantity, r.start_date, r.end_date, r.event_name
+    FROM reservations r
+    JOIN items i ON r.item_id = i.id
+    JOIN categories c ON i.category_id = c.id
+    WHERE r.user_id = ? AND r.end_date >= ?
+    ORDER BY r.end_date
+""")
+SQL_REMINDERS_ENDING = named_query("reminders_ending", """
+    SELECT r.id, i.name, r.end_date, r.user_id, r.username, r.event_name
+    FROM reservations r
+    JOIN items i ON r.item_id = i.id
+    WHERE r.end_date <= ? AND r.end_date >= ?
+    ORDER BY r.end_date
+""")
+SQL_REMINDERS_OVERDUE = named_query("reminders_overdue", """
+    SELECT r.id, i.name, r.end_date, r.user_id, r.username, r.event_name
+    FROM reservations r
+    JOIN items i ON r.item_id = i.id
+    WHERE r.end_date < ?
+    ORDER BY r.end_date
+""")
+SQL_REMINDER_DUE_RESERVATIONS = named_query("reminder_due_reservations", """
+    SELECT r.id, r.user_id, i.name, r.end_date, r.event_name
+    FROM reservations r
+    JOIN items i ON r.item_id = i.id
+    WHERE r.id IN ({placeholders}) AND r.user_id IS NOT NULL
+""")
+SQL_REMINDER_LOG_CLAIM = named_query("reminder_log_claim", "INSERT INTO reminder_log (reservation_id, offset_days) VALUES (?, ?) ON CONFLICT DO NOTHING")
+SQL_REMINDER_LOG_RELEASE = named_query("reminder_log_release", "DELETE FROM reminder_log WHERE reservation_id = ? AND offset_days = ?")
+SQL_BROADCAST_RESERVATIONS = named_query("broadcast_reservations", """
+    SELECT r.user_id, i.name, r.end_date, r.event_name
+    FROM reservations r
+    JOIN items i ON r.item_id = i.id
+    WHERE r.end_date >= ? AND r.user_id IS NOT NULL
+    ORDER BY r.user_id, r.end_date
+""", allow_scan=True)
+SQL_HEALTH_CHECK = named_query("health_check", "SELECT 1")
+
+def today_iso(offset_days=0):
+    """Дата (сегодня + offset_days) в формате YYYY-MM-DD, как она хранится в БД"""
+    return (datetime.now().date() + timedelta(days=offset_days)).isoformat()
+
+def read_file_bytes(path):
+    """Чтение файла целиком (вызывается вне event loop)"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+def write_file_atomic(path, data):
+    """Запись файла через временный файл, чтобы не оставить недописанное фото (вне event loop)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# Хранилище фотографий позиций
+def pick_photo_size(sizes, target_side=IMAGE_TARGET_SIDE):
+    """Наименьший PhotoSize с большей стороной не меньше target_side (если такого нет - самый крупный)"""
+    fitting = [size for size in sizes if max(size.width, size.height) >= target_side]
+    if fitting:
+        return min(fitting, key=lambda size: size.width * size.height)
+    return max(sizes, key=lambda size: size.width * size.height)
+
+class ImageStore:
+    """Фотографии позиций, адресуемые по SHA-256 содержимого.
+
+    Файл лежит в IMAGES_DIR/<первые 2 символа хэша>/<хэш>.jpg, одинаковые фото
+    хранятся один раз. В таблице images запоминается file_id Telegram: карточки
+    отправляются по file_id без повторной загрузки байтов, а локальная копия
+    нужна, только если Telegram перестал принимать file_id.
+
+    Локальные копии укладываются в бюджет budget_bytes: при превышении удаляются
+    давно не использованные (path становится NULL), и при необходимости фото
+    заново скачивается по file_id.
+    """
+
+    def __init__(self, directory, budget_bytes=IMAGES_BUDGET_BYTES):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self._used = {}
+        self._budget_lock = asyncio.Lock()
+
+    def path_for(self, digest):
+        return os.path.join(self.directory, digest[:2], f"{digest}.jpg")
+
+    async def save_photo(self, photo):
+        """Сохраняет PhotoSize из сообщения и возвращает хэш содержимого"""
+        # То же фото, пересланное повторно, Telegram отдает с тем же file_unique_id
+        known = await db.fetchone(SQL_IMAGE_BY_UNIQUE_ID, (photo.file_unique_id,))
+        if known:
+            self.touch(known[0])
+            return known[0]
+        
+        tg_file = await photo.get_file()
+        data = bytes(await tg_file.download_as_bytearray())
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if not await asyncio.to_thread(os.path.exists, path):
+            await asyncio.to_thread(write_file_atomic, path, data)
+        await db.execute(
+            SQL_IMAGE_INSERT,
+            (digest, photo.file_id, photo.file_unique_id, path, len(data), int(time.time())),
+        )
+        await self.enforce_budget()
+        return digest
+
+    async def flush_usage(self):
+        """Записывает накопленные времена использования фото"""
+        if self._used:
+            used = [(last_used_at, digest) for digest, last_used_at in self._used.items()]
+            self._used.clear()
+            async with db.transaction() as tx:
+                await tx.executemany(SQL_IMAGE_TOUCH, used)
+
+    def touch(self, digest):
+        """Отмечает использование фото; время записывается в БД пачкой при проверке бюджета"""
+        self._used[digest] = int(time.time())
+
+    async def read(self, bot, digest):
+        """Байты фото: локальная копия, а если ее нет - повторная загрузка по file_id"""
+        image = await db.fetchone(SQL_IMAGE_FILE, (digest,))
+        if image is None:
+            return None
+        file_id, path = image
+        if path and await asyncio.to_thread(os.path.exists, path):
+            return await asyncio.to_thread(read_file_bytes, path)
+        if not file_id:
+            return None
+        
+        try:
+            tg_file = await bot.get_file(file_id)
+            data = bytes(await tg_file.download_as_bytearray())
+        except BadRequest as e:
+            logger.warning(f"Не удалось скачать фото {digest[:12]} по file_id: {e}")
+            return None
+        path = self.path_for(digest)
+        await asyncio.to_thread(write_file_atomic, path, data)
+        await db.execute(SQL_IMAGE_RESTORE_COPY, (path, len(data), int(time.time()), digest))
+        logger.info(f"Локальная копия фото {digest[:12]} восстановлена по file_id")
+        await self.enforce_budget()
+        return data
+
+    async def enforce_budget(self):
+        """Удаляет давно не использованные локальные копии, пока их объем превышает бюджет"""
+        async with self._budget_lock:
+            await self.flush_usage()
+            
+            (total,) = await db.fetchone(SQL_IMAGES_LOCAL_SIZE)
+            if total <= self.budget_bytes:
+                return
+            
+            # Удалять можно только копии, которые восстанавливаются по file_id
+            candidates = await db.fetchall(SQL_IMAGES_EVICTION_CANDIDATES)
+            evicted = []
+            for digest, path, size in candidates:
+                if total <= self.budget_bytes:
+                    break
+                if await asyncio.to_thread(os.path.exists, path):
+                    await asyncio.to_thread(os.remove, path)
+                evicted.append((digest,))
+                total -= size
+            if evicted:
+                async with db.transaction() as tx:
+                    await tx.executemany(SQL_IMAGE_EVICT, evicted)
+                logger.info(f"Удалено локальных копий фото: {len(evicted)}, занято {total // 1024} КБ")
+
+    async def send(self, bot, chat_id, digest, caption):
+        """Отправляет фото по file_id, а если его нет или он не принят - файлом с диска.
+
+        Возвращает False, если фото отправить нечем.
+        """
+        image = await db.fetchone(SQL_IMAGE_FILE_ID, (digest,))
+        if image is None:
+            return False
+        (file_id,) = image
+        
+        self.touch(digest)
+        
+        if file_id:
+            try:
+                await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+                return True
+            except BadRequest as e:
+                logger.warning(f"Telegram не принял file_id фото {digest[:12]}, отправляем файл: {e}")
+        
+        data = await self.read(bot, digest)
+        if data is None:
+            return False
+        sent = await bot.send_photo(chat_id=chat_id, photo=data, caption=caption)
+        # Следующие отправки снова пойдут по file_id
+        await db.execute(
+            SQL_IMAGE_SET_FILE_ID,
+            (sent.photo[-1].file_id, sent.photo[-1].file_unique_id, digest),
+        )
+        return True
+
+    async def release(self, digest):
+        """Удаляет фото, если на него больше не ссылается ни одна позиция"""
+        image = await db.fetchone(SQL_IMAGE_PATH, (digest,))
+        if image is None:
+            return
+        deleted = await db.execute(SQL_IMAGE_RELEASE, (digest, digest))
+        if deleted and image[0] and await asyncio.to_thread(os.path.exists, image[0]):
+            await asyncio.to_thread(os.remove, image[0])
+
+    def _adopt_file(self, legacy_path):
+        """Переносит файл старого формата в хранилище: (хэш, путь, размер) или None"""
+        if not os.path.exists(legacy_path):
+            return None
+        data = read_file_bytes(legacy_path)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            os.remove(legacy_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(legacy_path, path)
+        return digest, path, len(data)
+
+    async def adopt_legacy(self):
+        """Переносит фото, сохраненные как IMAGES_DIR/{timestamp}.jpg, в хранилище по хэшу"""
+        rows = await db.fetchall(SQL_ITEMS_LEGACY_IMAGES)
+        adopted = 0
+        for (legacy_path,) in rows:
+            stored = await asyncio.to_thread(self._adopt_file, legacy_path)
+            if stored is None:
+                continue
+            digest, path, size = stored
+            async with db.transaction() as tx:
+                await tx.execute(SQL_IMAGE_ADOPT, (digest, path, size, int(time.time())))
+                adopted += await tx.execute(SQL_ITEMS_ADOPT_IMAGE, (digest, legacy_path))
+        if adopted:
+            logger.info(f"Фото перенесены в хранилище по хэшу: {adopted} позиций")
+
+image_store = ImageStore(IMAGES_DIR)
+
+# Очередь напоминаний: сроки броней в куче, ежедневный запуск берет только наступившие
+class ReminderSchedule:
+    """Сроки напоминаний по броням.
+
+    Для каждой брони в кучу кладется (день, id брони, смещение) по каждому
+    смещению из REMINDER_OFFSETS: 3 - за три дня до окончания, -1 - на следующий
+    день после него. Возвращенные брони из кучи не удаляются: при снятии срока
+    они отсеиваются запросом к БД. Брони, закончившиеся раньше окна
+    напоминаний (самое позднее отрицательное смещение), не загружаются и не
+    напоминаются.
+    """
+
+    def __init__(self, offsets=REMINDER_OFFSETS):
+        self.offsets = offsets
+        # Сколько дней после окончания брони о ней еще напоминают
+        self.window = max([0] + [-offset for offset in offsets])
+        self._heap = []
+        self._known = set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def reservation_added(self, reservation_id, end_date):
+        if reservation_id in self._known:
+            return
+        self._known.add(reservation_id)
+        end = date.fromisoformat(end_date)
+        for offset in self.offsets:
+            heapq.heappush(self._heap, ((end - timedelta(days=offset)).isoformat(), reservation_id, offset))
+
+    def reservation_removed(self, reservation_id):
+        self._known.discard(reservation_id)
+
+    def requeue(self, reservation_id, offset, day):
+        """Повторить напоминание в день day (не удалось доставить)"""
+        heapq.heappush(self._heap, (day, reservation_id, offset))
+
+    async def load(self, item_id=None):
+        """Загружает сроки броней окна напоминаний (всех или одной позиции) - при старте и по оповещению реплик"""
+        since = today_iso(-self.window)
+        if item_id is None:
+            rows = await db.fetchall(SQL_RESERVATION_DEADLINES, (since,))
+        else:
+            rows = await db.fetchall(SQL_ITEM_RESERVATION_DEADLINES, (item_id, since))
+        for reservation_id, end_date in rows:
+            self.reservation_added(reservation_id, end_date)
+
+    def pop_due(self, today):
+        """Снимает наступившие сроки: {id брони: наименьшее из наступивших смещений}"""
+        due = {}
+        last_offset = min(self.offsets)
+        oldest_end = (date.fromisoformat(today) - timedelta(days=self.window)).isoformat()
+        while self._heap and self._heap[0][0] <= today:
+            day, reservation_id, offset = heapq.heappop(self._heap)
+            if offset == last_offset:
+                self._known.discard(reservation_id)
+            # Бронь закончилась раньше окна напоминаний (бот долго не работал) - срок пропускается
+            if (date.fromisoformat(day) + timedelta(days=offset)).isoformat() < oldest_end:
+                continue
+            # Из нескольких пропущенных сроков важен только самый поздний
+            due[reservation_id] = min(offset, due.get(reservation_id, offset))
+        return due
+
+reminders = ReminderSchedule()
+
+# Кэш готовых ответов. Любая запись в склад увеличивает поколение, и все
+# сохраненные ответы прежних поколений становятся недействительными.
+inventory_generation = 0
+
+# Задачи перезагрузки по оповещениям реплик: ссылки держатся до завершения, иначе их может собрать GC
+reload_tasks = set()
+
+def start_reload(coroutine):
+    task = asyncio.get_running_loop().create_task(coroutine)
+    reload_tasks.add(task)
+    task.add_done_callback(reload_tasks.discard)
+
+def inventory_changed(item_id=None, remote=False):
+    """Отмечает изменение склада; remote - изменение сделала другая реплика"""
+    global inventory_generation
+    inventory_generation += 1
+    if remote:
+        if item_id is None:
+            start_reload(inventory.load())
+            start_reload(reminders.load())
+        else:
+            start_reload(inventory.reload_item(item_id))
+            start_reload(reminders.load(item_id))
+
+async def publish_inventory_change(item_id=None):
+    """Сбрасывает кэши после записи и оповещает другие реплики"""
+    inventory_changed(item_id)
+    try:
+        await db.notify_change(item_id)
+    except Exception as e:
+        logger.error(f"Не удалось оповестить реплики об изменении: {e}")
+
+class ResponseCache:
+    """LRU-кэш готовых ответов, действительных до следующей записи в склад"""
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        generation, value = entry
+        if generation != inventory_generation:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, generation):
+        """Сохраняет ответ, построенный по данным поколения generation"""
+        if generation != inventory_generation or self.max_size <= 0:
+            return
+        self._entries[key] = (generation, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+response_cache = ResponseCache()
+
+# Модель склада в памяти: списки выбора, остатки и inline-поиск (@bot запрос)
+def word_trigrams(text, prefix=False):
+    """Триграммы слов текста; слово дополняется пробелами, чтобы учитывались начала слов.
+
+    Для запроса (prefix=True) конец последнего слова не дополняется: пользователь
+    еще печатает, и "ваз" должно находить "ваза".
+    """
+    trigrams = set()
+    words = text.casefold().split()
+    for n, word in enumerate(words):
+        padded = "  " + word + ("" if prefix and n == len(words) - 1 else " ")
+        trigrams.update(padded[k:k + 3] for k in range(len(padded) - 2))
+    return trigrams
+
+def sorted_contains(ids, values):
+    """Какие из values есть в отсортированном массиве ids (маска numpy)"""
+    if not len(ids):
+        return np.zeros(len(values), dtype=bool)
+    return ids[np.minimum(np.searchsorted(ids, values), len(ids) - 1)] == values
+
+class SortedIds:
+    """Id позиций, упорядоченные функцией ключа, кусками ограниченной длины.
+
+    Вставка в сплошной список сдвигает в среднем половину его элементов, и при
+    100 тысячах позиций этот сдвиг дороже самого поиска места. Здесь сдвигается
+    только один кусок не длиннее CHUNK_SIZE; кусок нужного id находится по
+    наибольшим ключам кусков. Ключ id не должен меняться, пока id в списке.
+    """
+
+    CHUNK_SIZE = 1024
+
+    def __init__(self, key, ids=()):
+        self.key = key
+        ordered = sorted(ids, key=key)
+        step = self.CHUNK_SIZE // 2
+        self._chunks = [ordered[n:n + step] for n in range(0, len(ordered), step)]
+        self._maxes = [key(chunk[-1]) for chunk in self._chunks]
+        self._len = len(ordered)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._chunks)
+
+    def _locate(self, key):
+        """Номер куска и место в нем первого id с ключом не меньше key"""
+        n = bisect.bisect_left(self._maxes, key)
+        if n == len(self._chunks):
+            return n, 0
+        return n, bisect.bisect_left(self._chunks[n], key, key=self.key)
+
+    def add(self, item_id):
+        key = self.key(item_id)
+        if not self._chunks:
+            self._chunks.append([item_id])
+            self._maxes.append(key)
+            self._len = 1
+            return
+        n, pos = self._locate(key)
+        if n == len(self._chunks):
+            n, pos = n - 1, len(self._chunks[-1])
+            self._maxes[n] = key
+        chunk = self._chunks[n]
+        chunk.insert(pos, item_id)
+        self._len += 1
+        if len(chunk) > self.CHUNK_SIZE:
+            half = len(chunk) // 2
+            self._chunks[n:n + 1] = [chunk[:half], chunk[half:]]
+            self._maxes.insert(n, self.key(chunk[half - 1]))
+
+    def remove(self, item_id):
+        n, pos = self._locate(self.key(item_id))
+        if n == len(self._chunks) or self._chunks[n][pos] != item_id:
+            return
+        chunk = self._chunks[n]
+        del chunk[pos]
+        self._len -= 1
+        if not chunk:
+            del self._chunks[n]
+            del self._maxes[n]
+        elif pos == len(chunk):
+            self._maxes[n] = self.key(chunk[-1])
+
+    def ceiling(self, key):
+        """Первый id с ключом не меньше key или None"""
+        n, pos = self._locate(key)
+        return self._chunks[n][pos] if n < len(self._chunks) else None
+
+    def walk(self, item_id, backward=False):
+        """Id после (или до) item_id в порядке списка; None, если item_id в списке нет"""
+        n, pos = self._locate(self.key(item_id))
+        if n == len(self._chunks) or self._chunks[n][pos] != item_id:
+            return None
+        if backward:
+            return itertools.chain(
+                reversed(self._chunks[n][:pos]),
+                itertools.chain.from_iterable(map(reversed, reversed(self._chunks[:n]))),
+            )
+        return itertools.chain(
+            itertools.islice(self._chunks[n], pos + 1, None),
+            itertools.chain.from_iterable(self._chunks[n + 1:]),
+        )
+
+class InventoryItem:
+    """Позиция склада в памяти"""
+
+    __slots__ = ("id", "category_id", "name", "quantity", "comment")
+
+    def __init__(self, item_id, category_id, name, quantity, comment):
+        self.id = item_id
+        self.category_id = category_id
+        self.name = name
+        self.quantity = quantity
+        self.comment = comment
+
+class Inventory:
+    """Модель склада в памяти: позиции, категории и индексы для списков и inline-поиска.
+
+    Загружается при старте, обработчики записи обновляют ее сразу после
+    фиксации транзакции, изменения других реплик подтягиваются через
+    reload_item. Индексы хранят только id позиций: весь склад упорядочен по
+    (категория, название, id), каждая категория - по (название, id), а
+    триграммы ссылаются на отсортированные массивы id (4 байта на ссылку).
+    Поиск терпим к опечаткам: позиция подходит, если с запросом совпадает
+    заданная доля триграмм. Совпадения последних запросов запоминаются, и
+    следующий символ при наборе считается от совпадений префикса.
+
+    Перезагрузки идут по одной. Записи обработчиков, пришедшие пока
+    перезагрузка читает базу, повторяются поверх прочитанного: снимок,
+    прочитанный до фиксации записи, не затирает ее. По окончании
+    перезагрузки поколение склада увеличивается, и кэши ответов сбрасываются.
+
+    Запись обходится в десятки микросекунд на 100 тысячах позиций: списки
+    порядка хранятся кусками (SortedIds), а массивы триграмм сдвигаются
+    целиком - самые длинные из них (триграммы названия категории) растут
+    с размером категории.
+    """
+
+    # Совпадения скольких последних запросов хранятся и до какого размера
+    SEARCH_CACHE_SIZE = 64
+    SEARCH_CACHE_MAX_MATCHES = 20000
+
+    def __init__(self):
+        self.categories = {}
+        self.items = {}
+        self.ordered = SortedIds(self.order_key)
+        self.by_category = {}
+        self.postings = {}
+        self._reload_lock = asyncio.Lock()
+        self._pending = None
+        self._positions = None
+        self._search_matches = collections.OrderedDict()
+
+    @contextlib.asynccontextmanager
+    async def _reloading(self):
+        global inventory_generation
+        async with self._reload_lock:
+            self._pending = []
+            try:
+                yield
+                for method, args in self._pending:
+                    method(*args)
+            finally:
+                self._pending = None
+                # Ответы, построенные пока перезагрузка читала базу, собраны по старой модели
+                # под уже новым поколением - после применения строк они сбрасываются еще раз
+                inventory_generation += 1
+
+    async def load(self):
+        async with self._reloading():
+            categories = dict(await db.fetchall(SQL_CATEGORIES_ALL))
+            rows = await db.fetchall(SQL_INVENTORY_ITEMS)
+            self._build(categories, rows)
+        logger.info(f"Модель склада загружена: {len(self.items)} позиций")
+
+    def _build(self, categories, rows):
+        self.categories = categories
+        self.items = {row[0]: InventoryItem(*row) for row in rows}
+        self.ordered = SortedIds(self.order_key, self.items)
+        by_category = collections.defaultdict(list)
+        for item_id, item in self.items.items():
+            by_category[item.category_id].append(item_id)
+        self.by_category = {
+            category_id: SortedIds(self.category_key, ids) for category_id, ids in by_category.items()
+        }
+        postings = collections.defaultdict(list)
+        for item_id in sorted(self.items):
+            item = self.items[item_id]
+            for trigram in self._terms(item.category_id, item.name):
+                postings[trigram].append(item_id)
+        self.postings = {trigram: array.array("I", ids) for trigram, ids in postings.items()}
+        self._indexes_changed()
+
+    async def reload_item(self, item_id):
+        async with self._reloading():
+            row = await db.fetchone(SQL_INVENTORY_ITEM, (item_id,))
+            if row is None:
+                self._remove(item_id)
+            else:
+                self._put(*row)
+
+    def order_key(self, item_id):
+        item = self.items[item_id]
+        return self.categories.get(item.category_id, ""), item.name, item_id
+
+    def category_key(self, item_id):
+        item = self.items[item_id]
+        return item.name, item_id
+
+    def category_items(self, category_id):
+        """Упорядоченные id позиций категории (пустой список, если их нет)"""
+        return self.by_category.get(category_id) or SortedIds(self.category_key)
+
+    def sorted_categories(self):
+        return sorted(self.categories.items(), key=lambda category: category[1])
+
+    def _terms(self, category_id, name):
+        return word_trigrams(f"{name} {self.categories.get(category_id, '')}")
+
+    def put(self, item_id, category_id, name, quantity, comment):
+        """Запись обработчика после фиксации транзакции"""
+        if self._pending is not None:
+            self._pending.append((self._put, (item_id, category_id, name, quantity, comment)))
+        self._put(item_id, category_id, name, quantity, comment)
+
+    def remove(self, item_id):
+        """Удаление обработчиком после фиксации транзакции"""
+        if self._pending is not None:
+            self._pending.append((self._remove, (item_id,)))
+        self._remove(item_id)
+
+    def _put(self, item_id, category_id, name, quantity, comment):
+        item = self.items.get(item_id)
+        if item is not None and item.category_id == category_id and item.name == name:
+            # Место в индексах не меняется
+            item.quantity = quantity
+            item.comment = comment
+            return
+        self._remove(item_id)
+        self._indexes_changed()
+        self.items[item_id] = InventoryItem(item_id, category_id, name, quantity, comment)
+        self.ordered.add(item_id)
+        if category_id not in self.by_category:
+            self.by_category[category_id] = SortedIds(self.category_key)
+        self.by_category[category_id].add(item_id)
+        for trigram in self._terms(category_id, name):
+            bisect.insort(self.postings.setdefault(trigram, array.array("I")), item_id)
+
+    def _remove(self, item_id):
+        item = self.items.get(item_id)
+        if item is None:
+            return
+        self._indexes_changed()
+        self.ordered.remove(item_id)
+        ids = self.by_category[item.category_id]
+        ids.remove(item_id)
+        if not ids:
+            del self.by_category[item.category_id]
+        del self.items[item_id]
+        for trigram in self._terms(item.category_id, item.name):
+            ids = self.postings.get(trigram)
+            if ids is not None:
+                pos = bisect.bisect_left(ids, item_id)
+                if pos < len(ids) and ids[pos] == item_id:
+                    del ids[pos]
+                if not ids:
+                    del self.postings[trigram]
+
+    def find(self, category_id, name):
+        """Позиция категории с точно таким названием или None"""
+        item_id = self.category_items(category_id).ceiling((name,))
+        if item_id is not None and self.items[item_id].name == name:
+            return self.items[item_id]
+        return None
+
+    def page(self, ids, cursor=None, backward=False, size=PICKER_PAGE_SIZE, where=None):
+        """Позиции страницы после (или до) позиции-курсора в упорядоченном ids (SortedIds) и признак продолжения"""
+        if cursor is None:
+            following = iter(ids)
+        else:
+            if cursor not in self.items:
+                return [], False
+            following = ids.walk(cursor, backward)
+            if following is None:
+                return [], False
+        items = []
+        for item_id in following:
+            item = self.items[item_id]
+            if where is None or where(item):
+                items.append(item)
+                if len(items) > size:
+                    break
+        has_more = len(items) > size
+        items = items[:size]
+        if backward:
+            items.reverse()
+        return items, has_more
+
+    def search(self, text, limit=INLINE_RESULTS_LIMIT, min_share=0.5):
+        """Позиции, похожие на запрос: (item_id, category, name, quantity, comment).
+
+        Выше - позиции с большим числом совпавших триграмм, при равенстве - в
+        порядке остатков (категория, название).
+        """
+        key = " ".join(text.casefold().split())
+        trigrams = word_trigrams(key, prefix=True)
+        if not trigrams:
+            return []
+        needed = max(1, math.ceil(len(trigrams) * min_share))
+        ids, counts = self._matches(key, trigrams, needed)
+        rank = (len(trigrams) - counts) * (len(self.ordered) + 1) + self._order_positions()[ids]
+        top = np.argpartition(rank, limit)[:limit] if len(rank) > limit else np.arange(len(rank))
+        results = []
+        for item_id in ids[top[np.argsort(rank[top])]].tolist():
+            item = self.items[item_id]
+            results.append((item_id, self.categories.get(item.category_id, ""), item.name, item.quantity, item.comment))
+        return results
+
+    def _matches(self, key, trigrams, needed):
+        """id позиций, совпавших с needed и более триграммами запроса, и число совпадений (массивы numpy).
+
+        Позиция с needed совпадениями из n есть хотя бы в одном из n - needed + 1
+        самых коротких списков: кандидаты берутся из них, а по длинным спискам
+        частых триграмм только проверяются. Если запрос продолжает недавний
+        (добавлены символы), кандидаты - совпадения префикса и позиции из списков
+        добавленных триграмм: остальные получили бы не больше совпадений, чем у
+        префикса, а порог с длиной запроса не снижается.
+        """
+        postings = {trigram: np.frombuffer(self.postings.get(trigram, b""), dtype=np.uintc) for trigram in trigrams}
+        lists = sorted(postings.values(), key=len)
+        rare = lists[:len(lists) - needed + 1]
+        prefix = self._search_prefix(key, trigrams, needed)
+        added = [postings[trigram] for trigram in trigrams - prefix[0]] if prefix else []
+        # Оценка числа просмотренных id: новая частая триграмма (начало слова) дешевле считается заново
+        fresh_cost = sum(map(len, rare)) + len(rare[-1]) * (len(lists) - len(rare))
+        if prefix and len(prefix[1]) * len(added) + sum(map(len, added)) * len(prefix[0]) < fresh_cost:
+            prefix_trigrams, prefix_ids, prefix_counts = prefix
+            new_ids = np.setdiff1d(np.unique(np.concatenate(added + [prefix_ids[:0]])), prefix_ids, assume_unique=True)
+            new_counts = np.zeros(len(new_ids), dtype=np.int64)
+            for trigram in prefix_trigrams:
+                new_counts += sorted_contains(postings[trigram], new_ids)
+            ids = np.concatenate([prefix_ids, new_ids])
+            counts = np.concatenate([prefix_counts, new_counts])
+            for other in added:
+                counts += sorted_contains(other, ids)
+        else:
+            ids, counts = np.unique(np.concatenate(rare), return_counts=True)
+            for other in lists[len(rare):]:
+                counts += sorted_contains(other, ids)
+        matched = counts >= needed
+        ids, counts = ids[matched], counts[matched]
+        if len(ids) <= self.SEARCH_CACHE_MAX_MATCHES:
+            self._search_matches[key] = (trigrams, ids, counts, needed)
+            while len(self._search_matches) > self.SEARCH_CACHE_SIZE:
+                self._search_matches.popitem(last=False)
+        return ids, counts
+
+    def _search_prefix(self, key, trigrams, needed):
+        """Сохраненные (триграммы, id, совпадения) самого длинного недавнего префикса запроса или None"""
+        for end in range(len(key) - 1, 0, -1):
+            entry = self._search_matches.get(key[:end])
+            # Префикс годится, если его триграммы входят в запрос, а порог был не выше
+            if entry is not None and entry[0] <= trigrams and entry[3] <= needed:
+                self._search_matches.move_to_end(key[:end])
+                return entry[:3]
+        return None
+
+    def _order_positions(self):
+        """Место каждой позиции в ordered (массив numpy по id), строится заново после изменения индексов"""
+        if self._positions is None:
+            ordered = np.fromiter(self.ordered, dtype=np.int64, count=len(self.ordered))
+            self._positions = np.zeros(int(ordered.max()) + 1 if len(ordered) else 0, dtype=np.int64)
+            self._positions[ordered] = np.arange(len(ordered))
+        return self._positions
+
+    def _indexes_changed(self):
+        self._positions = None
+        self._search_matches.clear()
+
+inventory = Inventory()
+inline_cache = ResponseCache(INLINE_CACHE_SIZE)
+
+async def apply_day_usage(tx, item_id, start, end, delta):
+    """Изменяет занятость позиции в item_day_usage на delta для каждого дня брони"""
+    today = today_iso()
+    await tx.executemany(
+        SQL_DAY_USAGE_ADD,
+        [(day, item_id, delta) for day in reservation_days(max(start, today), end)],
+    )
+    if delta < 0:
+        await tx.execute(SQL_DAY_USAGE_CLEANUP, (start, end, item_id))
+
+class WriteBatcher:
+    """Групповая фиксация записей обработчиков.
+
+    Одна задача берет операции из очереди и выполняет пришедшие за
+    WRITE_BATCH_MS в одной транзакции, каждую - в своей точке сохранения:
+    ошибка операции откатывает только ее. Вызывающий получает свой результат
+    или свою ошибку после фиксации всей группы.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._task = None
+
+    async def run(self, operation):
+        """Выполняет operation(tx) в ближайшей групповой транзакции и возвращает ее результат"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._writer())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future))
+        return await future
+
+    async def close(self):
+        """Фиксирует записи, уже стоящие в очереди, и останавливает задачу"""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            request = await self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            stopping = False
+            # Одиночная запись не ждет окна: группа набирается, только когда очередь уже не пуста
+            deadline = loop.time() + (WRITE_BATCH_MS / 1000 if not self._queue.empty() else 0)
+            while len(batch) < WRITE_BATCH_MAX:
+                try:
+                    timeout = deadline - loop.time()
+                    if timeout > 0:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    else:
+                        request = self._queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            await self._commit(batch)
+            if stopping:
+                return
+
+    async def _apply(self, batch):
+        results = []
+        async with db.transaction() as tx:
+            for operation, future in batch:
+                if future.done():
+                    # Вызывающий отменен - его запись не выполняется
+                    results.append(None)
+                    continue
+                try:
+                    async with tx.savepoint():
+                        results.append((True, await operation(tx)))
+                except Exception as e:
+                    results.append((False, e))
+        return results
+
+    async def _commit(self, batch):
+        try:
+            # Занятая база - повтор всей группы: писать в это время все равно нельзя
+            results = await with_write_retries(lambda: self._apply(batch))
+        except Exception as e:
+            logger.error(f"Ошибка групповой транзакции из {len(batch)} записей: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        metrics.write_batch_size.observe(db.dialect, len(batch))
+        for (_, future), result in zip(batch, results):
+            if result is None or future.done():
+                continue
+            succeeded, value = result
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+write_batcher = WriteBatcher()
+
+async def add_stock(category_id, name, quantity, image_hash=None, comment=None):
+    """Создает позицию или прибавляет количество к существующей; возвращает (id, новое количество)"""
+    item_id, new_quantity, stored_comment = await write_batcher.run(
+        lambda tx: tx.fetchone(SQL_ITEM_ADD_STOCK, (category_id, name, quantity, image_hash, comment))
+    )
+    inventory.put(item_id, category_id, name, new_quantity, stored_comment)
+    return item_id, new_quantity
+
+class KeyedLocks:
+    """asyncio-блокировки по ключу; запись удаляется, когда блокировку никто не держит и не ждет"""
+
+    def __init__(self):
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        # [блокировка, число держащих и ждущих]
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+# Брони одной позиции оформляются по очереди, разных - параллельно
+item_locks = KeyedLocks()
+
+async def with_write_retries(operation, attempts=WRITE_RETRIES):
+    """Выполняет транзакцию operation(), повторяя ее при занятой базе с паузами со случайным разбросом"""
+    for attempt in range(attempts):
+        try:
+            return await operation()
+        except Exception as e:
+            if attempt == attempts - 1 or not db.is_busy_error(e):
+                raise
+            delay = WRITE_RETRY_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(f"База занята ({e}), повтор через {delay * 1000:.0f} мс")
+            await asyncio.sleep(delay)
+
+async def book_reservation(item_id, quantity, start, end, user_id, username, first_name, event_name):
+    """Проверяет доступность и создает бронь в одной транзакции.
+
+    Занятость берется из item_day_usage внутри той же транзакции, поэтому две
+    одновременные брони последних единиц не пройдут обе. Возвращает
+    (id брони или None, название позиции или None, доступное количество).
+    """
+    async def booking(tx):
+        await tx.lock_item(item_id)
+        row = await tx.fetchone(SQL_BOOKING_CHECK, (max(start, today_iso()), end, item_id))
+        if row is None:
+            return None, None, 0
+        total_quantity, item_name, reserved = row
+        available = max(0, total_quantity - reserved)
+        if quantity > available:
+            return None, item_name, available
+        reservation_id = await tx.insert(
+            SQL_RESERVATION_INSERT,
+            (item_id, quantity, start, end, user_id, username, first_name, event_name),
+        )
+        await apply_day_usage(tx, item_id, start, end, quantity)
+        return reservation_id, item_name, available - quantity
+
+    # Повторы при занятой базе - внутри write_batcher, для всей группы
+    async with item_locks.hold(item_id):
+        return await write_batcher.run(booking)
+
+async def apply_return(reserve_id):
+    """Удаляет бронь и снимает ее занятость в одной транзакции.
+
+    Возвращает (название позиции, username, мероприятие, id позиции) или None,
+    если бронь уже вернули.
+    """
+    async def returning(tx):
+        row = await tx.fetchone(SQL_RESERVATION_FOR_RETURN, (reserve_id,))
+        if row is None:
+            return None
+        item_name, username, event_name, item_id, start_date, end_date, quantity = row
+        await tx.execute(SQL_RESERVATION_DELETE, (reserve_id,))
+        await apply_day_usage(tx, item_id, start_date, end_date, -quantity)
+        await tx.execute(SQL_REMINDER_LOG_DELETE, (reserve_id,))
+        return item_name, username, event_name, item_id
+
+    return await write_batcher.run(returning)
+
+async def apply_item_delete(item_id):
+    """Удаляет позицию с ее бронями в одной транзакции; возвращает (название, хэш фото) или None"""
+    async def deleting(tx):
+        row = await tx.fetchone(SQL_ITEM_NAME_IMAGE, (item_id,))
+        if row is None:
+            return None
+        await tx.execute(SQL_REMINDER_LOG_DELETE_ITEM, (item_id,))
+        await tx.execute(SQL_RESERVATIONS_DELETE_ITEM, (item_id,))
+        await tx.execute(SQL_DAY_USAGE_DELETE_ITEM, (item_id,))
+        await tx.execute(SQL_ITEM_DELETE, (item_id,))
+        return row
+
+    return await write_batcher.run(deleting)
+
 async def start(update: Update, context: CallbackContext) -> None:
     """Обработчик команды start"""
     try:
@@ -217,6 +2220,7 @@ async def start(update: Update, context: CallbackContext) -> None:
             ["Вернуть бронь", "Удалить позицию"],
             ["Текущие остатки", "Остатки на дату"],
             ["Просмотр позиции", "Мои бронирования"],
+            ["График доступности"],
         ]
         await update.message.reply_text(
             "🏭 Бот управления складом\n\nВыберите действие:",
@@ -229,11 +2233,7 @@ async def start(update: Update, context: CallbackContext) -> None:
 async def add_item_start(update: Update, context: CallbackContext) -> int:
     """Начало процесса добавления товара"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, name FROM categories ORDER BY name")
-        categories = cur.fetchall()
-        conn.close()
+        categories = inventory.sorted_categories()
         
         if not categories:
             await update.message.reply_text("❌ Нет доступных категорий!")
@@ -260,17 +2260,12 @@ async def category_selection(update: Update, context: CallbackContext) -> int:
         category_id = int(query.data.split("_")[1])
         context.user_data["category_id"] = category_id
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT name FROM categories WHERE id = ?", (category_id,))
-        result = cur.fetchone()
-        conn.close()
+        category_name = inventory.categories.get(category_id)
         
-        if not result:
+        if category_name is None:
             await query.edit_message_text("❌ Категория не найдена!")
             return ConversationHandler.END
             
-        category_name = result[0]
         await query.edit_message_text(f"📁 Категория: {category_name}\n\nВведите название позиции:")
         return ITEM_NAME
     except Exception as e:
@@ -289,20 +2284,14 @@ async def item_name_input(update: Update, context: CallbackContext) -> int:
         context.user_data["item_name"] = item_name
         category_id = context.user_data["category_id"]
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, quantity, image_path, comment FROM items WHERE category_id = ? AND name = ?",
-            (category_id, item_name)
-        )
-        existing_item = cur.fetchone()
-        conn.close()
+        existing_item = inventory.find(category_id, item_name)
+        # Сохраняется только признак: количество прибавит upsert на следующем шаге
+        context.user_data["item_exists"] = existing_item is not None
         
         if existing_item:
-            context.user_data["existing_item"] = existing_item
             await update.message.reply_text(
                 f"✅ Позиция '{item_name}' уже существует!\n"
-                f"Текущее количество: {existing_item[1]} шт.\n\n"
+                f"Текущее количество: {existing_item.quantity} шт.\n\n"
                 "🔢 Введите количество для добавления:"
             )
             return ITEM_QUANTITY
@@ -327,27 +2316,17 @@ async def item_quantity_input(update: Update, context: CallbackContext) -> int:
             await update.message.reply_text("❌ Количество должно быть больше 0! Введите корректное количество:")
             return ITEM_QUANTITY
             
-        if "existing_item" in context.user_data:
-            existing_item = context.user_data["existing_item"]
-            item_id, old_quantity, image_path, comment = existing_item
-            new_quantity = old_quantity + quantity
-            
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute(
-                "UPDATE items SET quantity = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                (new_quantity, item_id)
+        if context.user_data.pop("item_exists", False):
+            item_id, new_quantity = await add_stock(
+                context.user_data["category_id"], context.user_data["item_name"], quantity
             )
-            conn.commit()
-            conn.close()
+            await publish_inventory_change(item_id)
             
             await update.message.reply_text(
                 f"✅ Позиция обновлена!\n"
                 f"📦 {context.user_data['item_name']}\n"
                 f"📊 Новое количество: {new_quantity} шт."
             )
-            if "existing_item" in context.user_data:
-                del context.user_data["existing_item"]
             return ConversationHandler.END
         else:
             context.user_data["quantity"] = quantity
@@ -363,7 +2342,7 @@ async def item_image_input(update: Update, context: CallbackContext) -> int:
     """Обработчик загрузки фото товара"""
     try:
         if update.message.text and update.message.text.lower() == 'пропустить':
-            context.user_data["image_path"] = None
+            context.user_data["image_hash"] = None
             await update.message.reply_text("📝 Введите комментарий к товару:")
             return ITEM_COMMENT
             
@@ -371,13 +2350,7 @@ async def item_image_input(update: Update, context: CallbackContext) -> int:
             await update.message.reply_text("❌ Пожалуйста, загрузите фото или отправьте 'пропустить'!")
             return ITEM_IMAGE
         
-        os.makedirs(IMAGES_DIR, exist_ok=True)
-        photo_file = await update.message.photo[-1].get_file()
-        timestamp = int(datetime.now().timestamp())
-        image_path = os.path.join(IMAGES_DIR, f"{timestamp}.jpg")
-        
-        await photo_file.download_to_drive(image_path)
-        context.user_data["image_path"] = image_path
+        context.user_data["image_hash"] = await image_store.save_photo(pick_photo_size(update.message.photo))
         
         await update.message.reply_text("📝 Введите комментарий к товару:")
         return ITEM_COMMENT
@@ -391,25 +2364,19 @@ async def item_comment_input(update: Update, context: CallbackContext) -> int:
     try:
         comment = update.message.text
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO items (category_id, name, quantity, image_path, comment) VALUES (?, ?, ?, ?, ?)",
-            (
-                context.user_data["category_id"],
-                context.user_data["item_name"],
-                context.user_data["quantity"],
-                context.user_data.get("image_path"),
-                comment,
-            ),
+        item_id, quantity = await add_stock(
+            context.user_data["category_id"],
+            context.user_data["item_name"],
+            context.user_data["quantity"],
+            context.user_data.get("image_hash"),
+            comment,
         )
-        conn.commit()
-        conn.close()
+        await publish_inventory_change(item_id)
         
         await update.message.reply_text(
             f"✅ Позиция успешно добавлена на склад!\n"
             f"📦 {context.user_data['item_name']}\n"
-            f"📊 Количество: {context.user_data['quantity']} шт."
+            f"📊 Количество: {quantity} шт."
         )
         return ConversationHandler.END
     except Exception as e:
@@ -465,36 +2432,217 @@ def generate_calendar(year=None, month=None, selection_type="start"):
         logger.error(f"Ошибка в generate_calendar: {e}")
         return InlineKeyboardMarkup([])
 
+# Постраничные списки выбора
+def button_text(text):
+    """Обрезает подпись кнопки до 60 символов"""
+    return text if len(text) <= 60 else text[:57] + "..."
+
+class Picker:
+    """Постраничный список кнопок: страницы отсчитываются от строки-курсора.
+
+    В callback_data хранится только id строки-курсора; строки страницы дает
+    fetch подкласса, первым элементом строки должен быть этот id.
+    """
+
+    def __init__(self, kind, button, params=lambda arg, context: ()):
+        self.kind = kind
+        self.button = button
+        self.params = params
+
+    async def fetch(self, params, cursor=None, backward=False):
+        """Строки страницы и признак того, что в этом направлении есть еще строки"""
+        raise NotImplementedError
+
+    def markup(self, rows, has_prev, has_next, arg=""):
+        buttons = [[InlineKeyboardButton(text, callback_data=data)] for text, data in map(self.button, rows)]
+        suffix = f"_{arg}" if arg != "" else ""
+        nav = []
+        if has_prev:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"pg_{self.kind}_p_{rows[0][0]}{suffix}"))
+        if has_next:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"pg_{self.kind}_n_{rows[-1][0]}{suffix}"))
+        if nav:
+            buttons.append(nav)
+        return InlineKeyboardMarkup(buttons)
+
+    async def first_page(self, context, arg=""):
+        """Разметка первой страницы или None, если список пуст"""
+        rows, has_next = await self.fetch(self.params(arg, context))
+        if not rows:
+            return None
+        return self.markup(rows, False, has_next, arg)
+
+class QueryPicker(Picker):
+    """Список выбора с keyset-пагинацией в базе.
+
+    Страница выбирается условием по ключу сортировки относительно строки-курсора
+    (key > key(cursor) ORDER BY key LIMIT n), поэтому каждая страница - один
+    небольшой индексированный запрос независимо от размера склада.
+    """
+
+    def __init__(self, kind, columns, source, key, id_column, button, where="", params=lambda arg, context: (),
+                 allow_scan=False):
+        super().__init__(kind, button, params)
+        self.columns = columns
+        self.source = source
+        self.key = key
+        self.id_column = id_column
+        self.where = where
+        # Первая страница и страницы вперед/назад от курсора - три запроса в реестре
+        self._queries = {
+            (with_cursor, backward): named_query(f"picker_{kind}_{suffix}", self._sql(with_cursor, backward), allow_scan)
+            for with_cursor, backward, suffix in ((False, False, "first"), (True, False, "next"), (True, True, "prev"))
+        }
+
+    def _sql(self, with_cursor, backward):
+        key = ", ".join(self.key)
+        conditions = [self.where] if self.where else []
+        if with_cursor:
+            op = "<" if backward else ">"
+            cursor_where = f"{self.where} AND " if self.where else ""
+            conditions.append(f"({key}) {op} (SELECT {key} {self.source} WHERE {cursor_where}{self.id_column} = ?)")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = ", ".join(f"{column} DESC" if backward else column for column in self.key)
+        return f"SELECT {self.columns} {self.source} {where} ORDER BY {order} LIMIT ?"
+
+    async def fetch(self, params, cursor=None, backward=False):
+        # Условие отбора повторяется в подзапросе курсора вместе со своими параметрами
+        args = (*params, *params, cursor) if cursor is not None else tuple(params)
+        rows = await db.fetchall(self._queries[cursor is not None, backward], (*args, PICKER_PAGE_SIZE + 1))
+        has_more = len(rows) > PICKER_PAGE_SIZE
+        rows = rows[:PICKER_PAGE_SIZE]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+
+class InventoryPicker(Picker):
+    """Список выбора по модели склада в памяти, без запросов к базе"""
+
+    def __init__(self, kind, index, row, button, where=None, params=lambda arg, context: ()):
+        super().__init__(kind, button, params)
+        # index(*params) -> упорядоченные id (SortedIds)
+        self.index = index
+        self.row = row
+        self.where = where
+
+    async def fetch(self, params, cursor=None, backward=False):
+        items, has_more = inventory.page(self.index(*params), cursor, backward, PICKER_PAGE_SIZE, self.where)
+        return [self.row(item) for item in items], has_more
+
+def stock_row(item):
+    return item.id, inventory.categories.get(item.category_id, ""), item.name, item.quantity
+
+ITEMS_SOURCE = "FROM items i JOIN categories c ON i.category_id = c.id"
+
+def fts_phrase(term):
+    """Поисковый запрос как одна фраза FTS5 (кавычки внутри экранируются)"""
+    return '"' + term.replace('"', '""') + '"'
+
+PICKERS = {
+    picker.kind: picker
+    for picker in (
+        InventoryPicker(
+            "ritem",
+            lambda: inventory.ordered,
+            stock_row,
+            lambda row: (f"{row[1]} - {row[2]} ({row[3]}шт)", f"ritem_{row[0]}"),
+            where=lambda item: item.quantity > 0,
+        ),
+        InventoryPicker(
+            "del",
+            lambda: inventory.ordered,
+            stock_row,
+            lambda row: (button_text(f"{row[1]} - {row[2]} ({row[3]}шт)"), f"del_{row[0]}"),
+        ),
+        QueryPicker(
+            "ret",
+            "r.id, c.name, i.name, r.quantity, r.start_date, r.end_date",
+            "FROM reservations r JOIN items i ON r.item_id = i.id JOIN categories c ON i.category_id = c.id",
+            ("r.start_date", "r.id"),
+            "r.id",
+            lambda row: (button_text(f"{row[1]} - {row[2]} ({row[3]}шт) {row[4]} - {row[5]}"), f"ret_{row[0]}"),
+            where="r.end_date >= ?",
+            params=lambda arg, context: (today_iso(),),
+        ),
+        InventoryPicker(
+            "vcat",
+            lambda category_id: inventory.category_items(category_id),
+            lambda item: (item.id, item.name, item.quantity),
+            lambda row: (button_text(f"{row[1]} ({row[2]}шт)"), f"viewitem_{row[0]}"),
+            params=lambda arg, context: (int(arg),),
+        ),
+        # Полнотекстовый поиск: триграммный индекс FTS5, сортировка по релевантности
+        QueryPicker(
+            "fts",
+            "i.id, c.name, i.name, i.quantity",
+            ITEMS_SOURCE + " JOIN items_fts ON items_fts.rowid = i.id",
+            ("bm25(items_fts, 10.0, 2.0, 1.0)", "i.id"),
+            "i.id",
+            lambda row: (button_text(f"{row[1]} - {row[2]} ({row[3]}шт)"), f"viewitem_{row[0]}"),
+            where="items_fts MATCH ?",
+            params=lambda arg, context: (fts_phrase(context.user_data["search_term"]),),
+        ),
+        # Запросы короче триграммы и хранилища без FTS5: подстрока без учета регистра
+        QueryPicker(
+            "like",
+            "i.id, c.name, i.name, i.quantity",
+            ITEMS_SOURCE,
+            ("c.name", "i.name", "i.id"),
+            "i.id",
+            lambda row: (button_text(f"{row[1]} - {row[2]} ({row[3]}шт)"), f"viewitem_{row[0]}"),
+            where="(casefold(i.name) LIKE ? OR casefold(COALESCE(i.comment, '')) LIKE ? OR casefold(c.name) LIKE ?)",
+            params=lambda arg, context: (f"%{context.user_data['search_term'].casefold()}%",) * 3,
+            allow_scan=True,
+        ),
+    )
+}
+
+async def picker_navigation(update: Update, context: CallbackContext) -> None:
+    """Переключение страниц списка выбора (◀️ / ▶️)"""
+    try:
+        query = update.callback_query
+        await query.answer()
+        _, kind, direction, cursor, *rest = query.data.split("_")
+        picker = PICKERS[kind]
+        arg = rest[0] if rest else ""
+        
+        try:
+            params = picker.params(arg, context)
+        except KeyError:
+            await query.edit_message_text("❌ Список устарел, откройте его заново.")
+            return
+        
+        backward = direction == "p"
+        rows, has_more = await picker.fetch(params, int(cursor), backward)
+        if rows:
+            has_prev, has_next = (has_more, True) if backward else (True, has_more)
+        else:
+            # Строку-курсор удалили - начинаем список сначала
+            rows, has_next = await picker.fetch(params)
+            has_prev = False
+        
+        if not rows:
+            await query.edit_message_text("❌ Список пуст!")
+            return
+        
+        await query.edit_message_reply_markup(reply_markup=picker.markup(rows, has_prev, has_next, arg))
+    except Exception as e:
+        logger.error(f"Ошибка в picker_navigation: {e}")
+        await update.callback_query.edit_message_text("❌ Произошла ошибка при загрузке списка.")
+
 # Функции для бронирования
 async def reserve_item_start(update: Update, context: CallbackContext) -> int:
     """Начало процесса бронирования"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT i.id, i.name, c.name, i.quantity
-            FROM items i 
-            JOIN categories c ON i.category_id = c.id
-            WHERE i.quantity > 0
-            ORDER BY c.name, i.name
-        """)
-        items = cur.fetchall()
-        conn.close()
+        markup = await PICKERS["ritem"].first_page(context)
         
-        if not items:
+        if markup is None:
             await update.message.reply_text("❌ На складе нет доступных позиций!")
             return ConversationHandler.END
         
-        buttons = []
-        for item_id, item_name, category_name, quantity in items:
-            buttons.append([InlineKeyboardButton(
-                f"{category_name} - {item_name} ({quantity}шт)", 
-                callback_data=f"ritem_{item_id}"
-            )])
-        
         await update.message.reply_text(
             "📦 Выберите позицию для бронирования:",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=markup,
         )
         return RESERVE_ITEM_SELECTION
     except Exception as e:
@@ -509,17 +2657,10 @@ async def reserve_item_selection(update: Update, context: CallbackContext) -> in
         await query.answer()
         item_id = int(query.data.split("_")[1])
         context.user_data["reserve_item_id"] = item_id
+        context.user_data.pop("reserve_start_date", None)
+        context.user_data.pop("reserve_end_date", None)
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT i.name, c.name, i.quantity 
-            FROM items i 
-            JOIN categories c ON i.category_id = c.id 
-            WHERE i.id = ?
-        """, (item_id,))
-        result = cur.fetchone()
-        conn.close()
+        result = await db.fetchone(SQL_ITEM_RESERVE_CARD, (item_id,))
         
         if not result:
             await query.edit_message_text("❌ Товар не найден!")
@@ -559,6 +2700,23 @@ async def reserve_quantity_input(update: Update, context: CallbackContext) -> in
                 "Введите новое количество:"
             )
             return RESERVE_QUANTITY
+        
+        # Повторный ввод после отказа: период уже выбран, проверяем доступность на нем
+        # тем же запросом по item_day_usage, что и при создании брони
+        start_date = context.user_data.get("reserve_start_date")
+        end_date = context.user_data.get("reserve_end_date")
+        if start_date and end_date:
+            row = await db.fetchone(
+                SQL_BOOKING_CHECK, (max(start_date, today_iso()), end_date, context.user_data["reserve_item_id"])
+            )
+            available_quantity = max(0, row[0] - row[2]) if row else 0
+            if reserve_quantity > available_quantity:
+                await update.message.reply_text(
+                    f"❌ Недостаточно товара в период {start_date} - {end_date}! "
+                    f"Доступно только {available_quantity} шт.\n"
+                    "Введите новое количество:"
+                )
+                return RESERVE_QUANTITY
             
         context.user_data["reserve_quantity"] = reserve_quantity
         
@@ -659,56 +2817,34 @@ async def reserve_event_input(update: Update, context: CallbackContext) -> int:
         start_date = datetime.fromisoformat(context.user_data["reserve_start_date"]).date()
         end_date = datetime.fromisoformat(context.user_data["reserve_end_date"]).date()
         
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user = update.effective_user
+        user_id = user.id
+        username = f"@{user.username}" if user.username else user.first_name or "Пользователь"
+        first_name = user.first_name or ""
         
-        cur.execute("SELECT quantity, name FROM items WHERE id = ?", (item_id,))
-        result = cur.fetchone()
-        if not result:
+        reservation_id, item_name, available_quantity = await book_reservation(
+            item_id,
+            reserve_quantity,
+            context.user_data["reserve_start_date"],
+            context.user_data["reserve_end_date"],
+            user_id,
+            username,
+            first_name,
+            event_name,
+        )
+        if item_name is None:
             await update.message.reply_text("❌ Товар не найден!")
             return ConversationHandler.END
-            
-        total_quantity, item_name = result
         
-        cur.execute("""
-            SELECT SUM(quantity) FROM reservations 
-            WHERE item_id = ? 
-            AND ((start_date <= ? AND end_date >= ?) 
-                 OR (start_date <= ? AND end_date >= ?)
-                 OR (start_date >= ? AND end_date <= ?))
-        """, (item_id, start_date, start_date, end_date, end_date, start_date, end_date))
-        
-        result = cur.fetchone()
-        reserved_quantity = result[0] or 0 if result else 0
-        available_quantity = total_quantity - reserved_quantity
-        
-        if reserve_quantity > available_quantity:
+        if reservation_id is None:
             await update.message.reply_text(
                 f"❌ Недостаточно товара в указанный период! Доступно только {available_quantity} шт.\n\n"
                 "Введите новое количество для бронирования:"
             )
             return RESERVE_QUANTITY
         
-        user = update.effective_user
-        user_id = user.id
-        username = f"@{user.username}" if user.username else user.first_name or "Пользователь"
-        first_name = user.first_name or ""
-        
-        cur.execute(
-            "INSERT INTO reservations (item_id, quantity, start_date, end_date, user_id, username, first_name, event_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                item_id,
-                reserve_quantity,
-                context.user_data["reserve_start_date"],
-                context.user_data["reserve_end_date"],
-                user_id,
-                username,
-                first_name,
-                event_name,
-            ),
-        )
-        conn.commit()
-        conn.close()
+        reminders.reservation_added(reservation_id, context.user_data["reserve_end_date"])
+        await publish_inventory_change(item_id)
         
         await update.message.reply_text(
             f"✅ Бронь успешно создана!\n\n"
@@ -729,37 +2865,15 @@ async def reserve_event_input(update: Update, context: CallbackContext) -> int:
 async def return_reservation(update: Update, context: CallbackContext) -> None:
     """Показ активных бронирований для возврата"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT r.id, i.name, c.name, r.quantity, r.start_date, r.end_date, r.username, r.event_name
-            FROM reservations r 
-            JOIN items i ON r.item_id = i.id
-            JOIN categories c ON i.category_id = c.id
-            WHERE r.end_date >= date('now')
-            ORDER BY r.start_date
-        """)
-        reservations = cur.fetchall()
-        conn.close()
+        markup = await PICKERS["ret"].first_page(context)
         
-        if not reservations:
+        if markup is None:
             await update.message.reply_text("❌ Нет активных бронирований!")
             return
         
-        buttons = []
-        for res_id, item_name, cat_name, quantity, start_date, end_date, username, event_name in reservations:
-            event_text = f" - {event_name}" if event_name else ""
-            display_text = f"{cat_name} - {item_name} ({quantity}шт) {start_date} - {end_date}"
-            if len(display_text) > 60:
-                display_text = display_text[:57] + "..."
-            buttons.append([InlineKeyboardButton(
-                display_text, 
-                callback_data=f"ret_{res_id}"
-            )])
-        
         await update.message.reply_text(
             "📦 Выберите бронь для возврата:",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=markup,
         )
     except Exception as e:
         logger.error(f"Ошибка в return_reservation: {e}")
@@ -772,27 +2886,15 @@ async def return_selection(update: Update, context: CallbackContext) -> None:
         await query.answer()
         reserve_id = int(query.data.split("_")[1])
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT i.name, r.username, r.event_name 
-            FROM reservations r 
-            JOIN items i ON r.item_id = i.id 
-            WHERE r.id = ?
-        """, (reserve_id,))
-        result = cur.fetchone()
+        result = await apply_return(reserve_id)
         
         if not result:
             await query.edit_message_text("❌ Бронь не найдена!")
-            conn.close()
             return
             
-        item_name, username, event_name = result
-        
-        cur.execute("DELETE FROM reservations WHERE id = ?", (reserve_id,))
-        conn.commit()
-        conn.close()
+        item_name, username, event_name, item_id = result
+        reminders.reservation_removed(reserve_id)
+        await publish_inventory_change(item_id)
         
         event_text = f" для мероприятия '{event_name}'" if event_name else ""
         await query.edit_message_text(f"✅ Бронь '{item_name}'{event_text} от {username} успешно возвращена!")
@@ -804,34 +2906,15 @@ async def return_selection(update: Update, context: CallbackContext) -> None:
 async def delete_item(update: Update, context: CallbackContext) -> None:
     """Показ позиций для удаления"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT i.id, i.name, c.name, i.quantity
-            FROM items i 
-            JOIN categories c ON i.category_id = c.id
-            ORDER BY c.name, i.name
-        """)
-        items = cur.fetchall()
-        conn.close()
+        markup = await PICKERS["del"].first_page(context)
         
-        if not items:
+        if markup is None:
             await update.message.reply_text("❌ Нет позиций для удаления!")
             return
         
-        buttons = []
-        for item_id, item_name, cat_name, quantity in items:
-            display_text = f"{cat_name} - {item_name} ({quantity}шт)"
-            if len(display_text) > 60:
-                display_text = display_text[:57] + "..."
-            buttons.append([InlineKeyboardButton(
-                display_text, 
-                callback_data=f"del_{item_id}"
-            )])
-        
         await update.message.reply_text(
             "🗑️ Выберите позицию для удаления:",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=markup,
         )
     except Exception as e:
         logger.error(f"Ошибка в delete_item: {e}")
@@ -844,29 +2927,21 @@ async def delete_selection(update: Update, context: CallbackContext) -> None:
         await query.answer()
         item_id = int(query.data.split("_")[1])
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT name, image_path FROM items WHERE id = ?", (item_id,))
-        result = cur.fetchone()
+        result = await apply_item_delete(item_id)
         
         if not result:
             await query.edit_message_text("❌ Позиция не найдена!")
-            conn.close()
             return
             
-        item_name, image_path = result
+        item_name, image_hash = result
         
-        if image_path and os.path.exists(image_path):
+        if image_hash:
             try:
-                os.remove(image_path)
+                await image_store.release(image_hash)
             except Exception as e:
-                logger.error(f"Ошибка при удалении изображения: {e}")
-        
-        cur.execute("DELETE FROM reservations WHERE item_id = ?", (item_id,))
-        cur.execute("DELETE FROM items WHERE id = ?", (item_id,))
-        conn.commit()
-        conn.close()
+                logger.error(f"Ошибка при удалении изображения: {e}")
+        inventory.remove(item_id)
+        await publish_inventory_change(item_id)
         
         await query.edit_message_text(f"✅ Позиция '{item_name}' успешно удалена!")
     except Exception as e:
@@ -877,40 +2952,33 @@ async def delete_selection(update: Update, context: CallbackContext) -> None:
 async def current_stock(update: Update, context: CallbackContext) -> None:
     """Показ текущих остатков"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT c.name, i.name, i.quantity, i.comment
-            FROM items i 
-            JOIN categories c ON i.category_id = c.id
-            ORDER BY c.name, i.name
-        """)
-        items = cur.fetchall()
-        conn.close()
-        
-        if not items:
-            await update.message.reply_text("📭 Склад пуст!")
-            return
-        
-        response = "📦 Текущие остатки на складе:\n\n"
-        current_category = ""
-        
-        for cat, name, qty, comment in items:
-            if cat != current_category:
-                response += f"📁 {cat}:\n"
-                current_category = cat
-            response += f"  • {name}: {qty}шт"
-            if comment:
-                response += f" ({comment})"
-            response += "\n"
+        parts = response_cache.get("stock")
+        if parts is None:
+            generation = inventory_generation
+            
+            if not inventory.ordered:
+                parts = ["📭 Склад пуст!"]
+            else:
+                response = "📦 Текущие остатки на складе:\n\n"
+                current_category = ""
+                
+                for item_id in inventory.ordered:
+                    item = inventory.items[item_id]
+                    cat = inventory.categories.get(item.category_id, "")
+                    if cat != current_category:
+                        response += f"📁 {cat}:\n"
+                        current_category = cat
+                    response += f"  • {item.name}: {item.quantity}шт"
+                    if item.comment:
+                        response += f" ({item.comment})"
+                    response += "\n"
+                
+                # Разбиваем длинные сообщения на части
+                parts = split_message(response)
+            response_cache.put("stock", parts, generation)
         
-        # Разбиваем длинные сообщения на части
-        if len(response) > 4096:
-            parts = [response[i:i+4096] for i in range(0, len(response), 4096)]
-            for part in parts:
-                await update.message.reply_text(part)
-        else:
-            await update.message.reply_text(response)
+        for part in parts:
+            await update.message.reply_text(part)
     except Exception as e:
         logger.error(f"Ошибка в current_stock: {e}")
         await update.message.reply_text("❌ Произошла ошибка при загрузке остатков.")
@@ -951,25 +3019,7 @@ async def date_stock_check(update: Update, context: CallbackContext) -> int:
                 await query.answer("❌ Дата не может быть в прошлом!", show_alert=True)
                 return CHECK_DATE
                 
-            conn = get_db_connection()
-            cur = conn.cursor()
-            
-            cur.execute("""
-                SELECT 
-                    c.name,
-                    i.name,
-                    i.quantity - IFNULL(SUM(r.quantity), 0) as available
-                FROM items i
-                JOIN categories c ON i.category_id = c.id
-                LEFT JOIN reservations r ON i.id = r.item_id 
-                    AND r.start_date <= ? 
-                    AND r.end_date >= ?
-                GROUP BY i.id
-                ORDER BY c.name, i.name
-            """, (target_date.isoformat(), target_date.isoformat()))
-            
-            items = cur.fetchall()
-            conn.close()
+            items = await db.fetchall(SQL_STOCK_ON_DATE, (target_date.isoformat(),))
             
             if not items:
                 await query.edit_message_text(f"📭 На {target_date} нет позиций на складе!")
@@ -994,6 +3044,119 @@ async def date_stock_check(update: Update, context: CallbackContext) -> int:
         await update.callback_query.edit_message_text("❌ Произошла ошибка при проверке остатков.")
         return ConversationHandler.END
 
+# График доступности на период
+def split_message(text, limit=4096):
+    """Разбивает текст на части не длиннее лимита Telegram, по возможности по строкам"""
+    parts = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return parts
+
+def build_availability_timeline(items, reservations, first_day, days):
+    """Матрица доступности позиций по дням.
+
+    items - список (item_id, category, name, quantity), reservations - список
+    (item_id, start_date, end_date, quantity). Брони раскладываются в матрицу
+    изменений [позиция x день], доступность получается накопительной суммой по
+    дням. Возвращает массив кодов категорий позиций и матрицу available[позиция, день].
+    """
+    index = {item[0]: n for n, item in enumerate(items)}
+    quantities = np.fromiter((item[3] or 0 for item in items), dtype=np.int32, count=len(items))
+    deltas = np.zeros((len(items), days + 1), dtype=np.int32)
+
+    if reservations:
+        res = [r for r in reservations if r[0] in index]
+        rows = np.fromiter((index[r[0]] for r in res), dtype=np.int64, count=len(res))
+        origin = date.fromisoformat(first_day).toordinal()
+        starts = np.fromiter((date.fromisoformat(r[1]).toordinal() - origin for r in res), dtype=np.int64, count=len(res))
+        ends = np.fromiter((date.fromisoformat(r[2]).toordinal() - origin + 1 for r in res), dtype=np.int64, count=len(res))
+        amounts = np.fromiter((r[3] for r in res), dtype=np.int32, count=len(res))
+        width = days + 1
+        cells = np.concatenate((rows * width + np.clip(starts, 0, days), rows * width + np.clip(ends, 0, days)))
+        weights = np.concatenate((amounts, -amounts))
+        deltas += np.bincount(cells, weights=weights, minlength=deltas.size).astype(np.int32).reshape(deltas.shape)
+
+    reserved = np.cumsum(deltas[:, :days], axis=1, dtype=np.int32)
+    categories, category_codes = np.unique([item[1] for item in items], return_inverse=True)
+    return categories, category_codes, quantities[:, None] - reserved
+
+def format_timeline_report(items, first_day, days, categories, category_codes, available):
+    """Сводка по категориям: минимум доступности категории и самые загруженные позиции.
+
+    Перебронированная позиция дает в сумму категории 0, а не минус: перебронь
+    показывается отдельной строкой у позиции.
+    """
+    quantities = np.fromiter((item[3] or 0 for item in items), dtype=np.int64, count=len(items))
+    def day_label(offset):
+        return (date.fromisoformat(first_day) + timedelta(days=offset)).isoformat()
+
+    item_min = available.min(axis=1)
+    item_min_day = available.argmin(axis=1)
+    order = np.argsort(category_codes, kind="stable")
+    bounds = np.searchsorted(category_codes[order], np.arange(len(categories)))
+    category_totals = np.add.reduceat(np.maximum(available[order], 0), bounds, axis=0, dtype=np.int64)
+
+    response = f"📈 Доступность на {days} дн. ({first_day} - {day_label(days - 1)}):\n\n"
+    for code, category in enumerate(categories):
+        low = int(category_totals[code].argmin())
+        response += f"📁 {category}: минимум {int(category_totals[code, low])}шт ({day_label(low)})\n"
+        members = np.flatnonzero(category_codes == code)
+        # Позиции без остатка показываются, только если на них есть брони (перебронь)
+        short = members[(item_min[members] < quantities[members]) & ((quantities[members] > 0) | (item_min[members] < 0))]
+        short = short[np.argsort(item_min[short], kind="stable")]
+        for n in short[:TIMELINE_ITEMS_PER_CATEGORY]:
+            _, _, name, quantity = items[n]
+            low_day = day_label(int(item_min_day[n]))
+            if item_min[n] < 0:
+                response += f"  • {name}: ⚠️ перебронировано на {-int(item_min[n])}шт, всего {quantity or 0}шт ({low_day})\n"
+            else:
+                response += f"  • {name}: мин. {int(item_min[n])} из {quantity}шт ({low_day})\n"
+        if len(short) > TIMELINE_ITEMS_PER_CATEGORY:
+            response += f"  … и еще {len(short) - TIMELINE_ITEMS_PER_CATEGORY} поз. с бронями\n"
+    return response
+
+async def availability_timeline(update: Update, context: CallbackContext) -> None:
+    """График доступности всех позиций на несколько дней вперед"""
+    try:
+        days = TIMELINE_DEFAULT_DAYS
+        if context.args:
+            if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= TIMELINE_MAX_DAYS:
+                await update.message.reply_text(f"❌ Укажите количество дней от 1 до {TIMELINE_MAX_DAYS}!")
+                return
+            days = int(context.args[0])
+
+        first_day = today_iso()
+        last_day = today_iso(days - 1)
+        items = await db.fetchall(SQL_TIMELINE_ITEMS)
+        if not items:
+            await update.message.reply_text("📭 Склад пуст!")
+            return
+
+        reservations = await db.fetchall(SQL_TIMELINE_RESERVATIONS, (first_day, last_day))
+
+        def render():
+            categories, category_codes, available = build_availability_timeline(items, reservations, first_day, days)
+            return format_timeline_report(items, first_day, days, categories, category_codes, available)
+
+        response = await asyncio.to_thread(render)
+        for part in split_message(response):
+            await update.message.reply_text(part)
+    except Exception as e:
+        logger.error(f"Ошибка в availability_timeline: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при построении графика доступности.")
+
 # Улучшенные функции для просмотра позиции
 async def view_item_start(update: Update, context: CallbackContext) -> int:
     """Начало просмотра позиции"""
@@ -1020,11 +3183,7 @@ async def view_category_method(update: Update, context: CallbackContext) -> int:
         await query.answer()
         
         if query.data == "view_categories":
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT id, name FROM categories ORDER BY name")
-            categories = cur.fetchall()
-            conn.close()
+            categories = inventory.sorted_categories()
             
             if not categories:
                 await query.edit_message_text("❌ В базе нет категорий!")
@@ -1058,44 +3217,22 @@ async def view_category_selection(update: Update, context: CallbackContext) -> i
         await query.answer()
         category_id = int(query.data.split("_")[1])
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT i.id, i.name, i.quantity 
-            FROM items i 
-            WHERE i.category_id = ?
-            ORDER BY i.name
-        """, (category_id,))
-        items = cur.fetchall()
+        markup = await PICKERS["vcat"].first_page(context, category_id)
         
-        cur.execute("SELECT name FROM categories WHERE id = ?", (category_id,))
-        result = cur.fetchone()
-        conn.close()
+        category_name = inventory.categories.get(category_id)
         
-        if not result:
+        if category_name is None:
             await query.edit_message_text("❌ Категория не найдена!")
             return ConversationHandler.END
-            
-        category_name = result[0]
         
-        if not items:
+        if markup is None:
             await query.edit_message_text(f"❌ В категории '{category_name}' нет позиций!")
             return ConversationHandler.END
         
-        buttons = []
-        for item_id, item_name, quantity in items:
-            display_text = f"{item_name} ({quantity}шт)"
-            if len(display_text) > 60:
-                display_text = display_text[:57] + "..."
-            buttons.append([InlineKeyboardButton(
-                display_text, 
-                callback_data=f"viewitem_{item_id}"
-            )])
-        
         await query.edit_message_text(
             f"📁 Категория: {category_name}\n\n"
             "📦 Выберите позицию для просмотра:",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=markup,
         )
         return VIEW_ITEM_SELECTION
     except Exception as e:
@@ -1111,36 +3248,19 @@ async def search_item_input(update: Update, context: CallbackContext) -> int:
             await update.message.reply_text("❌ Введите поисковый запрос!")
             return SEARCH_ITEM
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT i.id, i.name, c.name, i.quantity 
-            FROM items i 
-            JOIN categories c ON i.category_id = c.id
-            WHERE i.name LIKE ?
-            ORDER BY c.name, i.name
-        """, (f"%{search_term}%",))
-        items = cur.fetchall()
-        conn.close()
+        context.user_data["search_term"] = search_term
+        # Триграммный индекс ищет только по запросам от 3 символов
+        kind = "fts" if db.fts_enabled and len(search_term) >= 3 else "like"
+        markup = await PICKERS[kind].first_page(context)
         
-        if not items:
+        if markup is None:
             await update.message.reply_text(f"❌ Не найдено позиций по запросу '{search_term}'!")
             return ConversationHandler.END
         
-        buttons = []
-        for item_id, item_name, category_name, quantity in items:
-            display_text = f"{category_name} - {item_name} ({quantity}шт)"
-            if len(display_text) > 60:
-                display_text = display_text[:57] + "..."
-            buttons.append([InlineKeyboardButton(
-                display_text, 
-                callback_data=f"viewitem_{item_id}"
-            )])
-        
         await update.message.reply_text(
             f"🔍 Результаты поиска по '{search_term}':\n\n"
             "📦 Выберите позицию для просмотра:",
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=markup,
         )
         return VIEW_ITEM_SELECTION
     except Exception as e:
@@ -1148,6 +3268,35 @@ async def search_item_input(update: Update, context: CallbackContext) -> int:
         await update.message.reply_text("❌ Произошла ошибка при поиске.")
         return ConversationHandler.END
 
+async def build_item_card(item_id):
+    """Текст карточки позиции и хэш фото, или None если позиции нет"""
+    item_info = await db.fetchone(SQL_ITEM_CARD, (item_id,))
+    
+    if not item_info:
+        return None
+    
+    item_name, category_name, quantity, comment, image_hash = item_info
+    
+    reservations = await db.fetchall(SQL_ITEM_CARD_RESERVATIONS, (item_id, today_iso()))
+    
+    message = f"📦 Карточка позиции\n\n"
+    message += f"📁 Категория: {category_name}\n"
+    message += f"📋 Название: {item_name}\n"
+    message += f"📊 Количество: {quantity} шт.\n"
+    
+    if comment:
+        message += f"📝 Комментарий: {comment}\n"
+    
+    if reservations:
+        message += f"\n📅 Активные брони:\n"
+        for start_date, end_date, res_quantity, username, event_name in reservations:
+            event_text = f" - {event_name}" if event_name else ""
+            message += f"  • {start_date} - {end_date}: {res_quantity} шт. ({username}{event_text})\n"
+    else:
+        message += f"\n✅ Нет активных броней"
+    
+    return message, image_hash
+
 async def view_item_selection(update: Update, context: CallbackContext) -> int:
     """Просмотр детальной информации о позиции"""
     try:
@@ -1160,61 +3309,28 @@ async def view_item_selection(update: Update, context: CallbackContext) -> int:
             
         item_id = int(query.data.split("_")[1])
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT i.name, c.name, i.quantity, i.comment, i.image_path
-            FROM items i 
-            JOIN categories c ON i.category_id = c.id 
-            WHERE i.id = ?
-        """, (item_id,))
-        item_info = cur.fetchone()
-        
-        if not item_info:
-            await query.edit_message_text("❌ Позиция не найдена!")
-            conn.close()
-            return ConversationHandler.END
-        
-        item_name, category_name, quantity, comment, image_path = item_info
+        # Карточка зависит от даты: вчерашние брони в нее уже не попадают
+        cache_key = ("card", item_id, today_iso())
+        card = response_cache.get(cache_key)
+        if card is None:
+            generation = inventory_generation
+            card = await build_item_card(item_id)
+            if card is None:
+                await query.edit_message_text("❌ Позиция не найдена!")
+                return ConversationHandler.END
+            response_cache.put(cache_key, card, generation)
         
-        cur.execute("""
-            SELECT start_date, end_date, quantity, username, event_name
-            FROM reservations 
-            WHERE item_id = ? AND end_date >= date('now')
-            ORDER BY start_date
-        """, (item_id,))
-        reservations = cur.fetchall()
-        
-        conn.close()
-        
-        message = f"📦 Карточка позиции\n\n"
-        message += f"📁 Категория: {category_name}\n"
-        message += f"📋 Название: {item_name}\n"
-        message += f"📊 Количество: {quantity} шт.\n"
-        
-        if comment:
-            message += f"📝 Комментарий: {comment}\n"
-        
-        if reservations:
-            message += f"\n📅 Активные брони:\n"
-            for start_date, end_date, res_quantity, username, event_name in reservations:
-                event_text = f" - {event_name}" if event_name else ""
-                message += f"  • {start_date} - {end_date}: {res_quantity} шт. ({username}{event_text})\n"
-        else:
-            message += f"\n✅ Нет активных броней"
+        message, image_hash = card
         
-        if image_path and os.path.exists(image_path):
+        if image_hash:
             try:
-                with open(image_path, 'rb') as photo:
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=photo,
-                        caption=message
-                    )
-                await query.edit_message_text("✅ Вот информация о позиции:")
+                sent = await image_store.send(context.bot, update.effective_chat.id, image_hash, message)
             except Exception as e:
                 logger.error(f"Ошибка при отправке фото: {e}")
+                sent = False
+            if sent:
+                await query.edit_message_text("✅ Вот информация о позиции:")
+            else:
                 await query.edit_message_text(f"{message}\n\n❌ Не удалось загрузить фото")
         else:
             await query.edit_message_text(message)
@@ -1232,18 +3348,7 @@ async def my_reservations(update: Update, context: CallbackContext) -> None:
         user = update.effective_user
         user_id = user.id
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT r.id, i.name, c.name, r.quantity, r.start_date, r.end_date, r.event_name
-            FROM reservations r 
-            JOIN items i ON r.item_id = i.id
-            JOIN categories c ON i.category_id = c.id
-            WHERE r.user_id = ? AND r.end_date >= date('now')
-            ORDER BY r.end_date
-        """, (user_id,))
-        reservations = cur.fetchall()
-        conn.close()
+        reservations = await db.fetchall(SQL_USER_RESERVATIONS, (user_id, today_iso()))
         
         if not reservations:
             await update.message.reply_text("📭 У вас нет активных бронирований!")
@@ -1277,28 +3382,9 @@ async def my_reservations(update: Update, context: CallbackContext) -> None:
 async def send_reminders(update: Update, context: CallbackContext) -> None:
     """Отправка напоминаний о бронированиях"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT r.id, i.name, r.end_date, r.user_id, r.username, r.event_name
-            FROM reservations r 
-            JOIN items i ON r.item_id = i.id
-            WHERE r.end_date <= date('now', '+3 days') AND r.end_date >= date('now')
-            ORDER BY r.end_date
-        """)
-        ending_reservations = cur.fetchall()
+        ending_reservations = await db.fetchall(SQL_REMINDERS_ENDING, (today_iso(3), today_iso()))
         
-        cur.execute("""
-            SELECT r.id, i.name, r.end_date, r.user_id, r.username, r.event_name
-            FROM reservations r 
-            JOIN items i ON r.item_id = i.id
-            WHERE r.end_date < date('now')
-            ORDER BY r.end_date
-        """)
-        overdue_reservations = cur.fetchall()
-        
-        conn.close()
+        overdue_reservations = await db.fetchall(SQL_REMINDERS_OVERDUE, (today_iso(),))
         
         if not ending_reservations and not overdue_reservations:
             await update.message.reply_text("✅ Нет бронирований для напоминаний!")
@@ -1333,61 +3419,292 @@ async def send_reminders(update: Update, context: CallbackContext) -> None:
         logger.error(f"Ошибка в send_reminders: {e}")
         await update.message.reply_text("❌ Произошла ошибка при загрузке напоминаний.")
 
+# Рассылка уведомлений с ограничением скорости
+class TokenBucket:
+    """Ведро токенов: в среднем rate операций в секунду, не более burst подряд"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов (ответ Telegram RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        # Ожидающие обслуживаются по очереди: lock удерживается и во время сна
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    self.updated = time.monotonic()
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SendLimiter:
+    """Лимиты Telegram на отправку: общий поток сообщений и не чаще chat_interval в один чат"""
+
+    def __init__(self, rate=BROADCAST_RATE, chat_interval=BROADCAST_CHAT_INTERVAL):
+        # Без запаса: сообщения идут равномерно, а не пачкой в начале рассылки
+        self.bucket = TokenBucket(rate, burst=1)
+        self.chat_interval = chat_interval
+        self._chat_ready = {}
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if len(self._chat_ready) > 10000:
+            self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+        ready = self._chat_ready.get(chat_id, 0.0)
+        self._chat_ready[chat_id] = max(now, ready) + self.chat_interval
+        if ready > now:
+            await asyncio.sleep(ready - now)
+        await self.bucket.acquire()
+
+send_limiter = SendLimiter()
+
+class Broadcast:
+    """Рассылка списка сообщений (chat_id, text) несколькими параллельными отправителями.
+
+    Скорость ограничивает SendLimiter; на RetryAfter вся рассылка приостанавливается
+    на указанное Telegram время и сообщение отправляется повторно.
+    """
+
+    active = set()
+
+    def __init__(self, messages, limiter=None, workers=BROADCAST_WORKERS):
+        self.messages = messages
+        self.limiter = limiter or send_limiter
+        self.workers = workers
+        self.total = len(messages)
+        self.sent = 0
+        self.failed = 0
+        self.delivered = set()
+        self.done = False
+        self.stopped = False
+        self._pending = collections.deque()
+
+    def stop(self):
+        """Прекращает рассылку: уже начатые отправки завершаются, остальные отменяются"""
+        self.stopped = True
+        self._pending.clear()
+
+    def progress(self):
+        return f"отправлено {self.sent} из {self.total}, ошибок {self.failed}"
+
+    async def _deliver(self, bot, chat_id, text):
+        for _ in range(BROADCAST_RETRIES):
+            await self.limiter.acquire(chat_id)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                logger.warning(f"Telegram ограничил рассылку, пауза {e.retry_after} с")
+                self.limiter.pause(e.retry_after)
+            except Forbidden as e:
+                logger.info(f"Пользователь {chat_id} недоступен для уведомлений: {e}")
+                return False
+            except Exception as e:
+                logger.error(f"Ошибка при отправке уведомления пользователю {chat_id}: {e}")
+                return False
+        return False
+
+    async def _worker(self, bot):
+        while self._pending:
+            chat_id, text = self._pending.popleft()
+            if await self._deliver(bot, chat_id, text):
+                self.sent += 1
+                self.delivered.add(chat_id)
+            else:
+                self.failed += 1
+
+    async def run(self, bot, on_progress=None):
+        """Отправляет все сообщения; on_progress вызывается раз в BROADCAST_PROGRESS_SECONDS"""
+        self._pending.extend(self.messages)
+        workers = {asyncio.create_task(self._worker(bot)) for _ in range(self.workers)}
+        Broadcast.active.add(self)
+        try:
+            while workers:
+                _, workers = await asyncio.wait(workers, timeout=BROADCAST_PROGRESS_SECONDS)
+                if workers and on_progress is not None:
+                    await on_progress(self)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            Broadcast.active.discard(self)
+            self.done = True
+
+current_broadcast = None
+
+def render_reminders(rows, today=None):
+    """Сообщения-напоминания по строкам (user_id, item_name, end_date, event_name),
+    отсортированным по user_id: список (user_id, text)"""
+    today = today or datetime.now().date()
+    messages = []
+    for user_id, user_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        message = "🔔 Напоминание о ваших бронированиях:\n\n"
+        for _, item_name, end_date, event_name in user_rows:
+            days_left = (date.fromisoformat(end_date) - today).days
+            event_text = f" ({event_name})" if event_name else ""
+            
+            status = "🟢" if days_left > 2 else "🟡" if days_left > 0 else "🔴"
+            message += f"{status} {item_name}{event_text}\n"
+            message += f"   📅 До {end_date} (осталось {days_left} дн.)\n\n"
+        
+        message += "⚠️ Пожалуйста, не забудьте вернуть позиции вовремя!"
+        messages.append((user_id, message))
+    return messages
+
+async def run_broadcast(broadcast, bot, status_message):
+    """Фоновая часть /notify_all: рассылка с обновлением сообщения о ходе"""
+    async def show_progress(broadcast):
+        try:
+            await status_message.edit_text(f"📤 Рассылка: {broadcast.progress()}")
+        except TelegramError as e:
+            logger.warning(f"Не удалось обновить ход рассылки: {e}")
+    
+    try:
+        await broadcast.run(bot, on_progress=show_progress)
+        logger.info(f"Рассылка завершена: {broadcast.progress()}")
+        if broadcast.stopped:
+            await status_message.edit_text(f"⏹ Рассылка прервана перезапуском бота: {broadcast.progress()}")
+            return
+        await status_message.edit_text(
+            f"✅ Уведомления отправлены {broadcast.sent} пользователям!"
+            + (f"\n❌ Не доставлено: {broadcast.failed}" if broadcast.failed else "")
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в run_broadcast: {e}")
+
+# Автоматические напоминания пользователям (JobQueue)
+def render_due_reminder(rows, today):
+    """Текст напоминания пользователю по его броням (item_name, end_date, event_name)"""
+    message = "🔔 Напоминание о ваших бронированиях:\n\n"
+    for item_name, end_date, event_name in rows:
+        days_left = (date.fromisoformat(end_date) - today).days
+        event_text = f" ({event_name})" if event_name else ""
+        if days_left < 0:
+            message += f"🔴 {item_name}{event_text}\n   📅 До {end_date} (просрочено на {-days_left} дн.)\n\n"
+        else:
+            status = "🟢" if days_left > 2 else "🟡" if days_left > 0 else "🔴"
+            message += f"{status} {item_name}{event_text}\n   📅 До {end_date} (осталось {days_left} дн.)\n\n"
+    message += "⚠️ Пожалуйста, не забудьте вернуть позиции вовремя!"
+    return message
+
+async def reminder_job(context: CallbackContext) -> None:
+    """Ежедневная отправка напоминаний по наступившим срокам"""
+    try:
+        today = today_iso()
+        due = reminders.pop_due(today)
+        if not due:
+            return
+        
+        reservation_ids = list(due)
+        rows = []
+        for start in range(0, len(reservation_ids), 500):
+            chunk = reservation_ids[start:start + 500]
+            rows += await db.fetchall(with_placeholders(SQL_REMINDER_DUE_RESERVATIONS, len(chunk)), chunk)
+        
+        # Запись в журнал до отправки: при нескольких репликах напоминание уйдет один раз
+        claimed = []
+        async with db.transaction() as tx:
+            for row in rows:
+                if await tx.execute(SQL_REMINDER_LOG_CLAIM, (row[0], due[row[0]])):
+                    claimed.append(row)
+        if not claimed:
+            return
+        
+        claimed.sort(key=lambda row: (row[1], row[3]))
+        messages = []
+        today_date = date.fromisoformat(today)
+        for user_id, user_rows in itertools.groupby(claimed, key=lambda row: row[1]):
+            messages.append((user_id, render_due_reminder([row[2:] for row in user_rows], today_date)))
+        
+        broadcast = Broadcast(messages)
+        await broadcast.run(context.bot)
+        logger.info(f"Напоминания по срокам: {broadcast.progress()}")
+        
+        # Недоставленные напоминания повторяются на следующий день
+        failed = [row for row in claimed if row[1] not in broadcast.delivered]
+        if failed:
+            async with db.transaction() as tx:
+                await tx.executemany(
+                    SQL_REMINDER_LOG_RELEASE,
+                    [(row[0], due[row[0]]) for row in failed],
+                )
+            for row in failed:
+                reminders.requeue(row[0], due[row[0]], today_iso(1))
+    except Exception as e:
+        logger.error(f"Ошибка в reminder_job: {e}")
+
 # Функция для отправки уведомлений всем пользователям
 async def notify_all_users(update: Update, context: CallbackContext) -> None:
     """Отправка уведомлений всем пользователям"""
+    global current_broadcast
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT DISTINCT user_id, username
-            FROM reservations 
-            WHERE end_date >= date('now') AND user_id IS NOT NULL
-        """)
-        users = cur.fetchall()
+        if current_broadcast is not None and not current_broadcast.done:
+            await update.message.reply_text(f"⏳ Рассылка уже идет: {current_broadcast.progress()}")
+            return
         
-        notified_count = 0
-        for user_id, username in users:
-            try:
-                cur.execute("""
-                    SELECT i.name, r.end_date, r.event_name
-                    FROM reservations r 
-                    JOIN items i ON r.item_id = i.id
-                    WHERE r.user_id = ? AND r.end_date >= date('now')
-                    ORDER BY r.end_date
-                """, (user_id,))
-                user_reservations = cur.fetchall()
-                
-                if user_reservations:
-                    message = "🔔 Напоминание о ваших бронированиях:\n\n"
-                    
-                    today = datetime.now().date()
-                    for item_name, end_date, event_name in user_reservations:
-                        end_date_obj = datetime.strptime(end_date, "%Y-%m-%d").date()
-                        days_left = (end_date_obj - today).days
-                        event_text = f" ({event_name})" if event_name else ""
-                        
-                        status = "🟢" if days_left > 2 else "🟡" if days_left > 0 else "🔴"
-                        message += f"{status} {item_name}{event_text}\n"
-                        message += f"   📅 До {end_date} (осталось {days_left} дн.)\n\n"
-                    
-                    message += "⚠️ Пожалуйста, не забудьте вернуть позиции вовремя!"
-                    
-                    await context.bot.send_message(chat_id=user_id, text=message)
-                    notified_count += 1
-                    await asyncio.sleep(0.1)  # Задержка чтобы не превысить лимиты Telegram
-                    
-            except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления пользователю {username}: {e}")
+        # Все активные брони одним запросом, по пользователям
+        rows = await db.fetchall(SQL_BROADCAST_RESERVATIONS, (today_iso(),))
         
-        conn.close()
+        messages = render_reminders(rows)
+        if not messages:
+            await update.message.reply_text("✅ Нет активных бронирований для уведомлений!")
+            return
         
-        await update.message.reply_text(f"✅ Уведомления отправлены {notified_count} пользователям!")
+        status_message = await update.message.reply_text(f"📤 Рассылка запущена: {len(messages)} пользователей")
+        current_broadcast = Broadcast(messages)
+        # Рассылка идет в фоне и не занимает обработчик
+        context.application.create_task(run_broadcast(current_broadcast, context.bot, status_message))
     except Exception as e:
         logger.error(f"Ошибка в notify_all_users: {e}")
         await update.message.reply_text("❌ Произошла ошибка при отправке уведомлений.")
 
+# Inline-режим: мгновенный поиск позиций из любого чата
+async def inline_search(update: Update, context: CallbackContext) -> None:
+    """Обработчик inline-запросов: @bot ваза"""
+    try:
+        text = update.inline_query.query.strip()
+        if not text:
+            await update.inline_query.answer([], cache_time=INLINE_CACHE_SECONDS)
+            return
+        
+        # Кэш по тексту запроса: при быстром наборе одинаковые префиксы не пересчитываются
+        key = text.casefold()
+        results = inline_cache.get(key)
+        if results is None:
+            results = []
+            for item_id, category_name, item_name, quantity, comment in inventory.search(text):
+                card = f"📦 {item_name}\n📁 Категория: {category_name}\n📊 Количество: {quantity} шт."
+                if comment:
+                    card += f"\n📝 Комментарий: {comment}"
+                results.append(InlineQueryResultArticle(
+                    id=str(item_id),
+                    title=item_name,
+                    description=f"{category_name} • {quantity} шт.",
+                    input_message_content=InputTextMessageContent(card),
+                ))
+            inline_cache.put(key, results, inventory_generation)
+        
+        await update.inline_query.answer(results, cache_time=INLINE_CACHE_SECONDS)
+    except Exception as e:
+        logger.error(f"Ошибка в inline_search: {e}")
+
 async def cancel(update: Update, context: CallbackContext) -> int:
     """Отмена текущей операции"""
     await update.message.reply_text("❌ Операция отменена.")
@@ -1408,11 +3725,18 @@ async def help_command(update: Update, context: CallbackContext) -> None:
 📅 Остатки на дату - посчитать остатки на будущую дату
 👀 Просмотр позиции - посмотреть детальную информацию о позиции
 📋 Мои бронирования - посмотреть свои активные брони
+📈 График доступности - минимальные остатки по категориям на 60 дней вперед
+/timeline N - то же на N дней (до 365)
+
+Поиск из любого чата: наберите @имя_бота и часть названия позиции
+(inline-режим включается у @BotFather командой /setinline)
 
 Административные команды:
 /reminders - показать бронирования, требующие внимания
 /notify_all - отправить уведомления всем пользователям
 
+Напоминания о сроках возврата бот присылает сам: за 3 дня, за 1 день и после окончания брони
+
 Для начала работы нажмите /start
     """
     await update.message.reply_text(help_text)
@@ -1429,9 +3753,133 @@ async def error_handler(update: Update, context: CallbackContext) -> None:
     except Exception as e:
         logger.error(f"Ошибка при отправке сообщения об ошибке: {e}")
 
+async def post_init(application: Application) -> None:
+    """Подключение к хранилищу перед началом обработки обновлений"""
+    logger.info(f"Инициализация базы данных ({db.dialect})...")
+    await db.open()
+    await inventory.load()
+    await image_store.adopt_legacy()
+    
+    await reminders.load()
+    if application.job_queue is None:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]) - автоматические напоминания отключены")
+    else:
+        application.job_queue.run_daily(reminder_job, time=REMINDER_TIME, name="reminders")
+        # Сроки, наступившие пока бот не работал
+        application.job_queue.run_once(reminder_job, when=30, name="reminders_catch_up")
+        logger.info(f"Напоминания запланированы на {REMINDER_TIME.strftime('%H:%M')} UTC, сроков в очереди: {len(reminders)}")
+
+async def post_shutdown(application: Application) -> None:
+    """Запись накопленного состояния и закрытие соединений с хранилищем после остановки"""
+    try:
+        await image_store.flush_usage()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении статистики фото: {e}")
+    await write_batcher.close()
+    await db.close()
+    logger.info("Хранилище закрыто")
+
+# Параллельная обработка обновлений
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей обрабатываются параллельно, одного - строго по очереди.
+
+    Шаги диалогов ConversationHandler одного пользователя идут под его
+    блокировкой в порядке поступления. Одновременно выполняется не более
+    concurrency обработчиков; слот берется уже под блокировкой пользователя,
+    поэтому пачка сообщений от одного пользователя не занимает слоты остальных.
+    Inline-запросы не связаны с диалогами и в очередь пользователя не встают.
+    """
+
+    __slots__ = ("_slots", "_locks", "_running", "_aborted")
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING):
+        # Лимит базового класса ограничивает только число ожидающих обновлений
+        super().__init__(max_pending)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._locks = {}
+        self._running = set()
+        self._aborted = False
+
+    @staticmethod
+    def sequence_key(update):
+        """Ключ очереди обновления или None, если порядок не важен"""
+        if not isinstance(update, Update) or update.inline_query is not None:
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.sequence_key(update)
+        if key is None:
+            async with self._slots:
+                await self._run(coroutine)
+            return
+        
+        # [блокировка, число обновлений пользователя в работе и в очереди]
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def _run(self, coroutine):
+        if self._aborted:
+            coroutine.close()
+            return
+        task = asyncio.ensure_future(coroutine)
+        self._running.add(task)
+        try:
+            await task
+        except asyncio.CancelledError:
+            # Отмена через abort() - обычное завершение: Application ждет task_done для каждого обновления
+            if not (self._aborted and task.cancelled()):
+                raise
+        finally:
+            self._running.discard(task)
+
+    def load(self):
+        """(выполняется, ждет очереди) - число обновлений в обработке и ожидающих"""
+        queued = sum(entry[1] for entry in self._locks.values())
+        running = len(self._running)
+        return running, max(queued - running, 0)
+
+    def abort(self):
+        """Отменяет выполняющиеся обработчики и не запускает ожидающие (при остановке по сроку)"""
+        self._aborted = True
+        for task in self._running:
+            task.cancel()
+        return len(self._running)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 def setup_application():
     """Настройка и создание приложения"""
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(BOT_API_URL)
+        .base_file_url(BOT_API_FILE_URL)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Обработчики диалогов
     add_item_conv = ConversationHandler(
@@ -1489,13 +3937,16 @@ def setup_application():
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("reminders", send_reminders))
     application.add_handler(CommandHandler("notify_all", notify_all_users))
+    application.add_handler(CommandHandler("timeline", availability_timeline))
     
     application.add_handler(add_item_conv)
     application.add_handler(reserve_conv)
     application.add_handler(date_check_conv)
     application.add_handler(view_item_conv)
+    application.add_handler(InlineQueryHandler(inline_search))
     
     # Обработчики callback-запросов
+    application.add_handler(CallbackQueryHandler(picker_navigation, pattern="^pg_"))
     application.add_handler(CallbackQueryHandler(return_selection, pattern="^ret_"))
     application.add_handler(CallbackQueryHandler(delete_selection, pattern="^del_"))
     
@@ -1504,48 +3955,369 @@ def setup_application():
     application.add_handler(MessageHandler(filters.Regex("^Удалить позицию$"), delete_item))
     application.add_handler(MessageHandler(filters.Regex("^Текущие остатки$"), current_stock))
     application.add_handler(MessageHandler(filters.Regex("^Мои бронирования$"), my_reservations))
+    application.add_handler(MessageHandler(filters.Regex("^График доступности$"), availability_timeline))
 
     # Обработчик ошибок
     application.add_error_handler(error_handler)
     
+    # Замер длительности каждого обработчика для /metrics
+    for handlers in application.handlers.values():
+        instrument_handlers(handlers)
+    
     return application
 
-def signal_handler(signum, frame):
-    """Обработчик сигналов для graceful shutdown"""
-    logger.info(f"Получен сигнал {signum}. Завершение работы...")
-    if bot_application:
-        bot_application.stop()
-    sys.exit(0)
+# Режим webhook: встроенный HTTP-сервер вместо long polling
+class HTTPServer:
+    """Минимальный HTTP/1.1 сервер на asyncio с таблицей маршрутов.
+
+    routes сопоставляет (метод, путь) обработчику, который принимает заголовки
+    и тело запроса и возвращает (статус, тело ответа). Соединения держатся
+    открытыми (keep-alive), клиенты переиспользуют их.
+    """
+
+    MAX_BODY = 1024 * 1024
+    IDLE_TIMEOUT = 75
+
+    def __init__(self, host, port, routes=None):
+        self.host = host
+        self.port = port
+        self.routes = dict(routes or {})
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"HTTP-сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+                
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, target, version = (request_line.split(" ") + ["", "", ""])[:3]
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+                
+                # Content-Length - только десятичные цифры, иначе границы тела не определить
+                length = headers.get("content-length") or "0"
+                if not length.isascii() or not length.isdigit():
+                    await self._respond(writer, 400, b"bad content-length", keep_alive=False)
+                    return
+                length = int(length)
+                if length > self.MAX_BODY:
+                    await self._respond(writer, 413, b"too large", keep_alive=False)
+                    return
+                body = await reader.readexactly(length) if length else b""
+                
+                handler = self.routes.get((method, target.split("?", 1)[0]))
+                if handler is None:
+                    status, payload = 404, b"not found"
+                else:
+                    try:
+                        status, payload = await handler(headers, body)
+                    except Exception as e:
+                        logger.error(f"Ошибка в обработчике HTTP {method} {target}: {e}")
+                        status, payload = 500, b"error"
+                
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload, keep_alive, content_type="text/plain; charset=utf-8"):
+        reason = HTTPStatus(status).phrase
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+            + payload
+        )
+        await writer.drain()
+
+class WebhookServer(HTTPServer):
+    """HTTP-сервер бота: прием обновлений от Telegram и служебные адреса.
+
+    POST на WEBHOOK_PATH проверяет секретный заголовок, кладет обновление в
+    update_queue приложения и сразу отвечает 200 - обработка идет отдельно.
+    GET /metrics отдает метрики Prometheus, GET /healthz - состояние для Render.
+    Без path (режим polling) сервер обслуживает только служебные адреса.
+    """
+
+    def __init__(self, application, host="0.0.0.0", port=PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        super().__init__(host, port, {
+            ("GET", "/"): self._health,
+            ("GET", "/healthz"): self._healthz,
+            ("GET", "/metrics"): self._metrics,
+        })
+        self.application = application
+        self.secret = secret
+        if path:
+            self.routes[("POST", path)] = self._telegram_update
+
+    async def _health(self, headers, body):
+        return 200, b"ok"
+
+    async def _healthz(self, headers, body):
+        if not self.application.running:
+            return 503, b"stopping"
+        try:
+            await asyncio.wait_for(db.fetchone(SQL_HEALTH_CHECK), 2)
+        except Exception as e:
+            logger.error(f"Проверка состояния: хранилище недоступно: {e}")
+            return 503, b"database unavailable"
+        return 200, b"ok"
+
+    async def _metrics(self, headers, body):
+        return 200, metrics.render(self.application).encode()
+
+    async def _telegram_update(self, headers, body):
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            logger.warning("Запрос к webhook с неверным секретным токеном")
+            return 403, b"forbidden"
+        try:
+            data = json.loads(body)
+            # Update.de_json ждет объект: на массив или число он падает с AttributeError, и клиент получил бы 500
+            if not isinstance(data, dict):
+                raise ValueError(f"ожидался JSON-объект, получен {type(data).__name__}")
+            update = Update.de_json(data, self.application.bot)
+            if update is None:
+                raise ValueError("пустое обновление")
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Некорректное обновление в webhook: {e}")
+            return 400, b"bad request"
+        await self.application.update_queue.put(update)
+        return 200, b"ok"
+
+async def drain_updates(application, timeout=SHUTDOWN_DRAIN_SECONDS):
+    """Ждет завершения обновлений в работе; по истечении срока прерывает оставшиеся"""
+    # Фоновые рассылки могут идти минутами - они прекращаются, не дожидаясь конца
+    for broadcast in list(Broadcast.active):
+        broadcast.stop()
+    try:
+        await asyncio.wait_for(application.update_queue.join(), timeout)
+        logger.info("Обновления в работе обработаны")
+    except asyncio.TimeoutError:
+        aborted = 0
+        if isinstance(application.update_processor, PerUserUpdateProcessor):
+            aborted = application.update_processor.abort()
+        logger.warning(f"За {timeout} с обработаны не все обновления, прервано обработчиков: {aborted}")
+
+async def process_backlog(application):
+    """Обрабатывает обновления, накопившиеся пока бот не работал, пачками по 100.
+
+    Пачка подтверждается в Telegram (offset следующего запроса) только после
+    того, как она обработана, поэтому перезапуск посреди разбора ничего не теряет.
+    Inline-запросы из очереди пропускаются: отвечать на них уже поздно.
+    """
+    offset = None
+    processed = 0
+    skipped = 0
+    while True:
+        updates = await application.bot.get_updates(offset=offset, limit=100, timeout=0)
+        if not updates:
+            break
+        for update in updates:
+            if update.inline_query is not None or update.chosen_inline_result is not None:
+                skipped += 1
+                continue
+            await application.update_queue.put(update)
+            processed += 1
+        await application.update_queue.join()
+        offset = updates[-1].update_id + 1
+    if offset is not None:
+        # Подтверждает последнюю пачку; новые обновления получит Updater
+        await application.bot.get_updates(offset=offset, limit=1, timeout=0)
+        logger.info(f"Обработаны обновления, накопившиеся за время простоя: {processed}, пропущено inline: {skipped}")
+
+async def run_bot(application):
+    """Запуск бота (polling или webhook) до сигнала остановки с корректным завершением.
+
+    При остановке сначала прекращается прием обновлений, затем в пределах
+    SHUTDOWN_DRAIN_SECONDS дорабатываются начатые, после чего закрывается хранилище.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_event.set)
+    
+    # post_init/post_shutdown вызывает только run_polling, здесь - вручную
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    server = None
+    try:
+        await application.start()
+        if BOT_MODE == "webhook" or SERVE_HTTP:
+            server = WebhookServer(application, path=WEBHOOK_PATH if BOT_MODE == "webhook" else None)
+            await server.start()
+        if BOT_MODE == "webhook":
+            if WEBHOOK_URL:
+                # Накопившиеся обновления Telegram доставит сам, как только webhook зарегистрирован
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=False,
+                )
+                logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            else:
+                logger.info("WEBHOOK_URL не задан - webhook не регистрируется, обновления принимаются только POST-запросами")
+        else:
+            await application.bot.delete_webhook(drop_pending_updates=False)
+            await process_backlog(application)
+            # Long polling сам ждет новых обновлений; пауза между запросами только добавляла задержку ответа
+            await application.updater.start_polling(
+                poll_interval=0.0,
+                timeout=30,
+                drop_pending_updates=False,
+            )
+        
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки. Завершение работы...")
+    finally:
+        # Прием новых обновлений прекращается первым
+        if server is not None:
+            await server.stop()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await drain_updates(application)
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def seed_synthetic_data(conn, items=2000, reservations=10000, users=500, seed=1):
+    """Заполняет пустую базу SQLite синтетическими позициями, бронями и занятостью по дням.
+
+    Брони раскиданы на два года назад и четыре месяца вперед, длительность - в
+    основном несколько дней: активной остается примерно каждая седьмая бронь.
+    """
+    rng = random.Random(seed)
+    category_ids = [row[0] for row in conn.execute("SELECT id FROM categories")]
+    words = ["Кабель", "Микрофон", "Колонка", "Стойка", "Пульт", "Прожектор", "Шнур", "Штатив", "Экран", "Удлинитель"]
+    item_rows = [
+        (rng.choice(category_ids), f"{rng.choice(words)} {n}", rng.randint(1, 50), None, f"Комментарий {n}")
+        for n in range(items)
+    ]
+    conn.executemany(
+        "INSERT INTO items (category_id, name, quantity, image_hash, comment) VALUES (?, ?, ?, ?, ?)", item_rows
+    )
+    item_ids = [row[0] for row in conn.execute("SELECT id FROM items")]
+    today = datetime.now().date()
+    for batch_start in range(0, reservations, 100000):
+        reservation_rows = []
+        for n in range(batch_start, min(batch_start + 100000, reservations)):
+            start = today + timedelta(days=rng.randint(-730, 120))
+            end = start + timedelta(days=min(int(rng.expovariate(1 / 3)), 30))
+            user_id = rng.randint(1, users)
+            reservation_rows.append((
+                rng.choice(item_ids), rng.randint(1, 3), start.isoformat(), end.isoformat(),
+                user_id, f"user{user_id}", f"Имя {user_id}", f"Мероприятие {n % 300}",
+            ))
+        conn.executemany(
+            "INSERT INTO reservations (item_id, quantity, start_date, end_date, user_id, username, first_name, event_name) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            reservation_rows,
+        )
+    active = conn.execute(
+        "SELECT item_id, start_date, end_date, quantity FROM reservations WHERE end_date >= ?", (today.isoformat(),)
+    ).fetchall()
+    conn.executemany(
+        "INSERT INTO item_day_usage (day, item_id, reserved) VALUES (?, ?, ?)",
+        [(day, item_id, reserved) for item_id, day, reserved in day_usage_rows(active, today.isoformat())],
+    )
+    conn.execute("INSERT INTO reminder_log (reservation_id, offset_days) SELECT id, 1 FROM reservations WHERE id % 10 = 0")
+    conn.commit()
+
+def scanned_tables(query, plan):
+    """Строки плана с полным просмотром items или reservations (в том числе под псевдонимом)"""
+    keywords = {"WHERE", "SET", "JOIN", "LEFT", "INNER", "ON", "ORDER", "GROUP", "LIMIT", "VALUES", "USING"}
+    names = set()
+    for table, alias in re.findall(r"\b(items|reservations)\b(?:\s+(?:AS\s+)?(\w+))?", query, re.IGNORECASE):
+        names.add(table)
+        if alias and alias.upper() not in keywords:
+            names.add(alias)
+    return [detail for detail in plan if (match := re.match(r"SCAN (?:TABLE )?(\w+)", detail)) and match.group(1) in names]
+
+def check_query_plans():
+    """Режим --check-queries: EXPLAIN QUERY PLAN каждого запроса из реестра на заполненной базе"""
+    global DB_NAME
+    with tempfile.TemporaryDirectory() as directory:
+        DB_NAME = os.path.join(directory, "check.db")
+        if not init_db() or not migrate_database():
+            print("Не удалось создать проверочную базу")
+            return 2
+        create_search_index()
+        conn = get_db_connection()
+        try:
+            seed_synthetic_data(conn)
+            conn.execute("ANALYZE")
+            violations = 0
+            for name, query in sorted(QUERIES.items()):
+                if query.dialect not in (None, "sqlite"):
+                    print(f"{'-':<6}  {name}: только {query.dialect}, план не проверяется")
+                    continue
+                sql = query.replace("{placeholders}", "?, ?")
+                try:
+                    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?"))]
+                except sqlite3.Error as e:
+                    print(f"ОШИБКА  {name}: {e}")
+                    violations += 1
+                    continue
+                scans = scanned_tables(sql, plan)
+                if not scans:
+                    status = "ok"
+                elif query.allow_scan:
+                    status = "скан"
+                else:
+                    status = "СКАН"
+                    violations += 1
+                print(f"{status:<6}  {name}: {'; '.join(plan)}")
+        finally:
+            conn.close()
+    print(f"Запросов: {len(QUERIES)}, нарушений: {violations}")
+    return 1 if violations else 0
 
 def main() -> None:
     """Основная функция запуска бота"""
     global bot_application
     
-    # Регистрация обработчиков сигналов
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    setup_logging()
+    if "--check-queries" in sys.argv[1:]:
+        sys.exit(check_query_plans())
     
     # Создаем папку для изображений
     os.makedirs(IMAGES_DIR, exist_ok=True)
     
-    logger.info("Инициализация базы данных...")
-    if not init_db():
-        logger.error("Не удалось инициализировать базу данных. Завершение работы.")
-        return
-    
-    logger.info("Выполнение миграции базы данных...")
-    migrate_database()
-    
     logger.info("Настройка приложения...")
     try:
         bot_application = setup_application()
         
-        logger.info("Бот запущен...")
-        bot_application.run_polling(
-            poll_interval=1.0,
-            timeout=30,
-            drop_pending_updates=True
-        )
+        if BOT_MODE == "webhook":
+            logger.info(f"Бот запущен в режиме webhook (порт {PORT})...")
+        else:
+            logger.info("Бот запущен...")
+        asyncio.run(run_bot(bot_application))
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}")
     finally: